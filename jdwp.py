@@ -0,0 +1,1819 @@
+"""
+Copyright (c) 2012 Fredrik Ehnbom, 2014 Jason Gardner
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+   1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+
+   2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+
+   3. This notice may not be removed or altered from any source
+   distribution.
+"""
+import socket
+import struct
+import threading
+import traceback
+import re
+import collections
+import queue as Queue
+
+HANDSHAKE = b"JDWP-Handshake"
+HEADER_SIZE = 11
+REPLY_FLAG = 0x80
+
+## (command set, command) of the JDWP commands used
+VM_VERSION = (1, 1)
+VM_CLASSES_BY_SIGNATURE = (1, 2)
+VM_ALL_THREADS = (1, 4)
+VM_DISPOSE = (1, 6)
+VM_ID_SIZES = (1, 7)
+VM_RESUME = (1, 9)
+VM_CREATE_STRING = (1, 11)
+RT_SIGNATURE = (2, 1)
+RT_FIELDS = (2, 4)
+RT_METHODS = (2, 5)
+RT_GET_VALUES = (2, 6)
+RT_SOURCE_FILE = (2, 7)
+CT_SUPERCLASS = (3, 1)
+CT_INVOKE_METHOD = (3, 3)
+M_LINE_TABLE = (6, 1)
+M_VARIABLE_TABLE = (6, 2)
+OR_REFERENCE_TYPE = (9, 1)
+OR_GET_VALUES = (9, 2)
+OR_INVOKE_METHOD = (9, 6)
+SR_VALUE = (10, 1)
+TR_NAME = (11, 1)
+TR_STATUS = (11, 4)
+TR_THREAD_GROUP = (11, 5)
+TR_FRAMES = (11, 6)
+TGR_NAME = (12, 1)
+AR_LENGTH = (13, 1)
+AR_GET_VALUES = (13, 2)
+ER_SET = (15, 1)
+ER_CLEAR = (15, 2)
+SF_GET_VALUES = (16, 1)
+SF_THIS_OBJECT = (16, 3)
+EVENT_COMPOSITE = (64, 100)
+
+SINGLE_STEP = 1
+BREAKPOINT = 2
+EXCEPTION = 4
+THREAD_START = 6
+THREAD_DEATH = 7
+CLASS_PREPARE = 8
+CLASS_UNLOAD = 9
+FIELD_ACCESS = 20
+FIELD_MODIFICATION = 21
+METHOD_ENTRY = 40
+METHOD_EXIT = 41
+VM_START = 90
+VM_DEATH = 99
+
+SUSPEND_NONE = 0
+SUSPEND_ALL = 2
+
+MOD_COUNT = 1
+MOD_CLASS_MATCH = 5
+MOD_CLASS_EXCLUDE = 6
+MOD_LOCATION_ONLY = 7
+MOD_EXCEPTION_ONLY = 8
+MOD_FIELD_ONLY = 9
+MOD_STEP = 10
+
+STEP_MIN = 0
+STEP_LINE = 1
+STEP_INTO = 0
+STEP_OVER = 1
+STEP_OUT = 2
+
+INVOKE_SINGLE_THREADED = 1
+
+ERROR_ABSENT_INFORMATION = 101
+ERROR_NATIVE_METHOD = 511
+
+## Untagged sizes and struct formats of the primitive value tags
+PRIMITIVE_FORMATS = {
+    "B": ">b", "C": ">H", "D": ">d", "F": ">f", "I": ">i", "J": ">q", "S": ">h", "Z": ">?"
+}
+PRIMITIVE_NAMES = {
+    "B": "byte", "C": "char", "D": "double", "F": "float", "I": "int", "J": "long",
+    "S": "short", "Z": "boolean", "V": "void"
+}
+THREAD_STATUS = {0: "zombie", 1: "running", 2: "sleeping", 3: "waiting in a monitor", 4: "cond. waiting"}
+## Classes "step" doesn't go into, as with jdb
+STEP_EXCLUDES = ("java.*", "javax.*", "sun.*", "com.sun.*", "jdk.*")
+
+JDWPValue = collections.namedtuple("JDWPValue", "tag value")
+JDWPLocation = collections.namedtuple("JDWPLocation", "type_tag class_id method_id index")
+JDWPEvent = collections.namedtuple("JDWPEvent", "kind request_id thread location data")
+JDWPMethod = collections.namedtuple("JDWPMethod", "id name signature modifiers")
+JDWPField = collections.namedtuple("JDWPField", "id name signature modifiers")
+JDWPVariable = collections.namedtuple("JDWPVariable", "code_index name signature length slot")
+
+NULL = JDWPValue("L", 0)
+
+
+class JDWPError(Exception):
+    """
+    A JDWP command answered with an error code, or a connection that went away
+    """
+    def __init__(self, message, code=None):
+        super(JDWPError, self).__init__(message)
+        self.code = code
+
+
+class JDWPEvalError(Exception):
+    """
+    An expression that can't be evaluated, with jdb's wording for it
+    """
+    pass
+
+
+def signature_name(signature):
+    """
+    Java name for a type signature, "Ljava/lang/String;" -> "java.lang.String", "[I" -> "int[]"
+    """
+    dims = len(signature) - len(signature.lstrip("["))
+    signature = signature[dims:]
+    if signature.startswith("L"):
+        name = signature[1:-1].replace("/", ".")
+    else:
+        name = PRIMITIVE_NAMES.get(signature, signature)
+    return name + "[]" * dims
+
+
+def class_signature(class_name):
+    return "L%s;" % class_name.replace(".", "/")
+
+
+def parameter_signatures(signature):
+    """
+    Type signatures of the parameters of a method signature, "(I[JLjava/lang/String;)V"
+    """
+    params = []
+    pos = 1
+    while signature[pos] != ")":
+        start = pos
+        while signature[pos] == "[":
+            pos += 1
+        if signature[pos] == "L":
+            pos = signature.index(";", pos)
+        pos += 1
+        params.append(signature[start:pos])
+    return params
+
+
+class JDWPWriter(object):
+    """
+    Builds the data of a command packet
+    """
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.parts = []
+
+    def byte(self, value):
+        self.parts.append(struct.pack(">B", value))
+        return self
+
+    def boolean(self, value):
+        self.parts.append(struct.pack(">?", value))
+        return self
+
+    def int(self, value):
+        self.parts.append(struct.pack(">i", value))
+        return self
+
+    def long(self, value):
+        self.parts.append(struct.pack(">q", value))
+        return self
+
+    def string(self, value):
+        data = value.encode("utf-8")
+        self.parts.append(struct.pack(">i", len(data)))
+        self.parts.append(data)
+        return self
+
+    def id(self, kind, value):
+        self.parts.append(value.to_bytes(self.sizes[kind], "big"))
+        return self
+
+    def location(self, location):
+        self.byte(location.type_tag)
+        self.id("reference_type", location.class_id)
+        self.id("method", location.method_id)
+        self.parts.append(struct.pack(">Q", location.index))
+        return self
+
+    def value(self, value):
+        self.byte(ord(value.tag))
+        if value.tag in PRIMITIVE_FORMATS:
+            self.parts.append(struct.pack(PRIMITIVE_FORMATS[value.tag], value.value))
+        elif value.tag != "V":
+            self.id("object", value.value)
+        return self
+
+    def data(self):
+        return b"".join(self.parts)
+
+
+class JDWPReader(object):
+    """
+    Reads the fields of a reply or event packet in order
+    """
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+        self.pos = 0
+
+    def take(self, size):
+        if self.pos + size > len(self.data):
+            raise JDWPError("Truncated JDWP packet")
+        data = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.take(struct.calcsize(fmt)))[0]
+
+    def byte(self):
+        return self.unpack(">B")
+
+    def boolean(self):
+        return self.unpack(">?")
+
+    def int(self):
+        return self.unpack(">i")
+
+    def long(self):
+        return self.unpack(">q")
+
+    def string(self):
+        return self.take(self.int()).decode("utf-8", "replace")
+
+    def id(self, kind):
+        return int.from_bytes(self.take(self.sizes[kind]), "big")
+
+    def location(self):
+        type_tag = self.byte()
+        class_id = self.id("reference_type")
+        method_id = self.id("method")
+        return JDWPLocation(type_tag, class_id, method_id, self.unpack(">Q"))
+
+    def untagged(self, tag):
+        if tag in PRIMITIVE_FORMATS:
+            return JDWPValue(tag, self.unpack(PRIMITIVE_FORMATS[tag]))
+        if tag == "V":
+            return JDWPValue(tag, None)
+        return JDWPValue(tag, self.id("object"))
+
+    def value(self):
+        return self.untagged(chr(self.byte()))
+
+
+class JDWPWaiter(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+        self.data = None
+
+
+class JDWPConnection(object):
+    """
+    A debugger connection to a VM started with -agentlib:jdwp=transport=dt_socket,server=y.
+    Commands can be sent from any thread and wait for their reply.  Event packets are handed to
+    on_event, and on_close is called once the connection is gone, both from the reader thread
+    """
+    def __init__(self, on_event, on_close):
+        self.on_event = on_event
+        self.on_close = on_close
+        self.sock = None
+        self.sizes = dict.fromkeys(("field", "method", "object", "reference_type", "frame"), 8)
+        self.lock = threading.Lock()
+        self.packet_id = 0
+        self.waiters = {}
+        self.closed = False
+
+    def connect(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.sendall(HANDSHAKE)
+        try:
+            handshake = self.receive(len(HANDSHAKE))
+        except EOFError:
+            handshake = None
+        if handshake != HANDSHAKE:
+            self.sock.close()
+            raise JDWPError("%s:%d did not answer the JDWP handshake" % (host, port))
+        self.sock.settimeout(None)
+        t = threading.Thread(target=self.read_packets)
+        t.daemon = True
+        t.start()
+        reply = self.command(VM_ID_SIZES, timeout=timeout)
+        for kind in ("field", "method", "object", "reference_type", "frame"):
+            self.sizes[kind] = reply.int()
+
+    def receive(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise EOFError()
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def writer(self):
+        return JDWPWriter(self.sizes)
+
+    def command(self, cmd, data=None, timeout=None):
+        """
+        Send a command and wait for its reply, returned as a JDWPReader
+        """
+        if isinstance(data, JDWPWriter):
+            data = data.data()
+        data = data or b""
+        waiter = JDWPWaiter()
+        with self.lock:
+            if self.closed:
+                raise JDWPError("The VM is not connected")
+            self.packet_id += 1
+            packet_id = self.packet_id
+            self.waiters[packet_id] = waiter
+            header = struct.pack(">IIBBB", HEADER_SIZE + len(data), packet_id, 0, cmd[0], cmd[1])
+            try:
+                self.sock.sendall(header + data)
+            except OSError as e:
+                self.waiters.pop(packet_id, None)
+                raise JDWPError("Cannot send to the VM: %s" % e)
+        if not waiter.event.wait(timeout):
+            with self.lock:
+                self.waiters.pop(packet_id, None)
+            raise JDWPError("Timed out waiting for the VM to answer command %d/%d" % cmd)
+        if waiter.error:
+            raise JDWPError("JDWP error %d for command %d/%d" % ((waiter.error,) + cmd), waiter.error)
+        return JDWPReader(waiter.data, self.sizes)
+
+    def read_packets(self):
+        try:
+            while True:
+                header = self.receive(HEADER_SIZE)
+                length, packet_id, flags = struct.unpack(">IIB", header[:9])
+                data = self.receive(length - HEADER_SIZE)
+                if flags & REPLY_FLAG:
+                    with self.lock:
+                        waiter = self.waiters.pop(packet_id, None)
+                    if waiter is not None:
+                        waiter.error = struct.unpack(">H", header[9:11])[0]
+                        waiter.data = data
+                        waiter.event.set()
+                elif (header[9], header[10]) == EVENT_COMPOSITE:
+                    self.on_event(JDWPReader(data, self.sizes))
+        except (OSError, EOFError):
+            pass
+        except:
+            traceback.print_exc()
+        with self.lock:
+            self.closed = True
+            waiters = list(self.waiters.values())
+            self.waiters.clear()
+        for waiter in waiters:
+            waiter.error = -1
+            waiter.event.set()
+        self.on_close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def read_events(reader):
+    """
+    The suspend policy and events of a composite event packet
+    """
+    suspend_policy = reader.byte()
+    events = []
+    for i in range(reader.int()):
+        kind = reader.byte()
+        request_id = reader.int()
+        thread = None
+        location = None
+        data = {}
+        if kind in (VM_START, THREAD_START, THREAD_DEATH):
+            thread = reader.id("object")
+        elif kind in (SINGLE_STEP, BREAKPOINT, METHOD_ENTRY, METHOD_EXIT):
+            thread = reader.id("object")
+            location = reader.location()
+        elif kind == EXCEPTION:
+            thread = reader.id("object")
+            location = reader.location()
+            data["exception"] = reader.value()
+            data["catch_location"] = reader.location()
+        elif kind == CLASS_PREPARE:
+            thread = reader.id("object")
+            data["type_tag"] = reader.byte()
+            data["type_id"] = reader.id("reference_type")
+            data["signature"] = reader.string()
+            data["status"] = reader.int()
+        elif kind == CLASS_UNLOAD:
+            data["signature"] = reader.string()
+        elif kind in (FIELD_ACCESS, FIELD_MODIFICATION):
+            thread = reader.id("object")
+            location = reader.location()
+            data["type_tag"] = reader.byte()
+            data["type_id"] = reader.id("reference_type")
+            data["field_id"] = reader.id("field")
+            data["object"] = reader.value()
+            if kind == FIELD_MODIFICATION:
+                data["value"] = reader.value()
+        elif kind != VM_DEATH:
+            ## Never asked for, and the rest of the packet can't be read past it
+            break
+        events.append(JDWPEvent(kind, request_id, thread, location, data))
+    return suspend_policy, events
+
+
+class JDWPVirtualMachine(object):
+    """
+    The JDWP commands the debugger uses, with the replies decoded.  What can't change while the
+    VM is connected (signatures, methods, line tables...) is cached
+    """
+    def __init__(self, connection, timeout=None):
+        self.connection = connection
+        self.timeout = timeout
+        self.cache = {}
+
+    def command(self, cmd, writer=None):
+        return self.connection.command(cmd, writer, self.timeout)
+
+    def writer(self):
+        return self.connection.writer()
+
+    def cached(self, key, fetch):
+        if key not in self.cache:
+            self.cache[key] = fetch()
+        return self.cache[key]
+
+    def version(self):
+        reply = self.command(VM_VERSION)
+        description = reply.string()
+        reply.int()
+        reply.int()
+        version = reply.string()
+        return description, version, reply.string()
+
+    def classes_by_signature(self, signature):
+        reply = self.command(VM_CLASSES_BY_SIGNATURE, self.writer().string(signature))
+        classes = []
+        for i in range(reply.int()):
+            type_tag = reply.byte()
+            classes.append((type_tag, reply.id("reference_type"), reply.int()))
+        return classes
+
+    def find_class(self, class_name):
+        """
+        (type tag, reference type id) of a loaded class, or None
+        """
+        classes = self.classes_by_signature(class_signature(class_name))
+        return classes[0][:2] if len(classes) > 0 else None
+
+    def all_threads(self):
+        reply = self.command(VM_ALL_THREADS)
+        return [reply.id("object") for i in range(reply.int())]
+
+    def create_string(self, text):
+        return self.command(VM_CREATE_STRING, self.writer().string(text)).id("object")
+
+    def resume(self):
+        self.command(VM_RESUME)
+
+    def dispose(self):
+        self.command(VM_DISPOSE)
+
+    def signature(self, ref):
+        return self.cached(("signature", ref),
+                           lambda: self.command(RT_SIGNATURE, self.writer().id("reference_type", ref)).string())
+
+    def class_name(self, ref):
+        return signature_name(self.signature(ref))
+
+    def source_file(self, ref):
+        def fetch():
+            try:
+                return self.command(RT_SOURCE_FILE, self.writer().id("reference_type", ref)).string()
+            except JDWPError as e:
+                if e.code != ERROR_ABSENT_INFORMATION:
+                    raise
+                return None
+        return self.cached(("source_file", ref), fetch)
+
+    def fields(self, ref):
+        def fetch():
+            reply = self.command(RT_FIELDS, self.writer().id("reference_type", ref))
+            return [JDWPField(reply.id("field"), reply.string(), reply.string(), reply.int())
+                    for i in range(reply.int())]
+        return self.cached(("fields", ref), fetch)
+
+    def methods(self, ref):
+        def fetch():
+            reply = self.command(RT_METHODS, self.writer().id("reference_type", ref))
+            return [JDWPMethod(reply.id("method"), reply.string(), reply.string(), reply.int())
+                    for i in range(reply.int())]
+        return self.cached(("methods", ref), fetch)
+
+    def method(self, ref, method_id):
+        for method in self.methods(ref):
+            if method.id == method_id:
+                return method
+        return None
+
+    def superclass(self, ref):
+        return self.cached(("superclass", ref),
+                           lambda: self.command(CT_SUPERCLASS, self.writer().id("reference_type", ref)).id("reference_type"))
+
+    def hierarchy(self, ref):
+        """
+        A class followed by its superclasses
+        """
+        while ref:
+            yield ref
+            ref = self.superclass(ref)
+
+    def static_values(self, ref, fields):
+        writer = self.writer().id("reference_type", ref).int(len(fields))
+        for field in fields:
+            writer.id("field", field.id)
+        reply = self.command(RT_GET_VALUES, writer)
+        return [reply.value() for i in range(reply.int())]
+
+    def line_table(self, ref, method_id):
+        """
+        (start, end, [(code index, line)]) of a method, None without line info
+        """
+        def fetch():
+            try:
+                reply = self.command(M_LINE_TABLE, self.writer().id("reference_type", ref).id("method", method_id))
+            except JDWPError as e:
+                if e.code not in (ERROR_ABSENT_INFORMATION, ERROR_NATIVE_METHOD):
+                    raise
+                return None
+            start = reply.long()
+            end = reply.long()
+            lines = []
+            for i in range(reply.int()):
+                code_index = reply.long()
+                lines.append((code_index, reply.int()))
+            lines.sort()
+            return start, end, lines
+        return self.cached(("line_table", ref, method_id), fetch)
+
+    def line_number(self, location):
+        table = self.line_table(location.class_id, location.method_id)
+        if table is None:
+            return None
+        line = None
+        for code_index, line_number in table[2]:
+            if code_index > location.index:
+                break
+            line = line_number
+        return line
+
+    def variable_table(self, ref, method_id):
+        """
+        (argument count, [JDWPVariable]) of a method, None without variable info
+        """
+        def fetch():
+            try:
+                reply = self.command(M_VARIABLE_TABLE, self.writer().id("reference_type", ref).id("method", method_id))
+            except JDWPError as e:
+                if e.code not in (ERROR_ABSENT_INFORMATION, ERROR_NATIVE_METHOD):
+                    raise
+                return None
+            arg_count = reply.int()
+            variables = []
+            for i in range(reply.int()):
+                code_index = reply.long()
+                name = reply.string()
+                signature = reply.string()
+                length = reply.int()
+                variables.append(JDWPVariable(code_index, name, signature, length, reply.int()))
+            return arg_count, variables
+        return self.cached(("variable_table", ref, method_id), fetch)
+
+    def object_type(self, obj):
+        reply = self.command(OR_REFERENCE_TYPE, self.writer().id("object", obj))
+        reply.byte()
+        return reply.id("reference_type")
+
+    def object_values(self, obj, fields):
+        writer = self.writer().id("object", obj).int(len(fields))
+        for field in fields:
+            writer.id("field", field.id)
+        reply = self.command(OR_GET_VALUES, writer)
+        return [reply.value() for i in range(reply.int())]
+
+    def invoke(self, obj, thread, ref, method_id, args, static=False):
+        """
+        Run a method in a suspended thread, returning (value, exception object id)
+        """
+        if static:
+            writer = self.writer().id("reference_type", ref).id("object", thread).id("method", method_id)
+            cmd = CT_INVOKE_METHOD
+        else:
+            writer = self.writer().id("object", obj).id("object", thread).id("reference_type", ref).id("method", method_id)
+            cmd = OR_INVOKE_METHOD
+        writer.int(len(args))
+        for arg in args:
+            writer.value(arg)
+        writer.int(INVOKE_SINGLE_THREADED)
+        reply = self.command(cmd, writer)
+        value = reply.value()
+        return value, reply.value().value
+
+    def string_value(self, obj):
+        return self.command(SR_VALUE, self.writer().id("object", obj)).string()
+
+    def thread_name(self, thread):
+        return self.command(TR_NAME, self.writer().id("object", thread)).string()
+
+    def thread_status(self, thread):
+        """
+        (thread status, suspend status)
+        """
+        reply = self.command(TR_STATUS, self.writer().id("object", thread))
+        return reply.int(), reply.int()
+
+    def thread_group_name(self, thread):
+        group = self.command(TR_THREAD_GROUP, self.writer().id("object", thread)).id("object")
+        return self.cached(("group_name", group),
+                           lambda: self.command(TGR_NAME, self.writer().id("object", group)).string())
+
+    def frames(self, thread):
+        """
+        (frame id, location) of the frames of a suspended thread, innermost first
+        """
+        reply = self.command(TR_FRAMES, self.writer().id("object", thread).int(0).int(-1))
+        frames = []
+        for i in range(reply.int()):
+            frame_id = reply.id("frame")
+            frames.append((frame_id, reply.location()))
+        return frames
+
+    def frame_values(self, thread, frame_id, slots):
+        writer = self.writer().id("object", thread).id("frame", frame_id).int(len(slots))
+        for slot, signature in slots:
+            writer.int(slot).byte(ord(signature[0]))
+        reply = self.command(SF_GET_VALUES, writer)
+        return [reply.value() for i in range(reply.int())]
+
+    def this_object(self, thread, frame_id):
+        return self.command(SF_THIS_OBJECT, self.writer().id("object", thread).id("frame", frame_id)).value()
+
+    def array_length(self, array):
+        return self.command(AR_LENGTH, self.writer().id("object", array)).int()
+
+    def array_values(self, array, first, length):
+        reply = self.command(AR_GET_VALUES, self.writer().id("object", array).int(first).int(length))
+        tag = chr(reply.byte())
+        count = reply.int()
+        if tag in PRIMITIVE_FORMATS:
+            return [reply.untagged(tag) for i in range(count)]
+        return [reply.value() for i in range(count)]
+
+    def set_event(self, kind, suspend_policy, modifiers):
+        """
+        Ask for events of a kind, modifiers being (modifier kind, args...) tuples.  Returns the request id
+        """
+        writer = self.writer().byte(kind).byte(suspend_policy).int(len(modifiers))
+        for modifier in modifiers:
+            writer.byte(modifier[0])
+            if modifier[0] == MOD_COUNT:
+                writer.int(modifier[1])
+            elif modifier[0] in (MOD_CLASS_MATCH, MOD_CLASS_EXCLUDE):
+                writer.string(modifier[1])
+            elif modifier[0] == MOD_LOCATION_ONLY:
+                writer.location(modifier[1])
+            elif modifier[0] == MOD_EXCEPTION_ONLY:
+                writer.id("reference_type", modifier[1]).boolean(modifier[2]).boolean(modifier[3])
+            elif modifier[0] == MOD_FIELD_ONLY:
+                writer.id("reference_type", modifier[1]).id("field", modifier[2])
+            elif modifier[0] == MOD_STEP:
+                writer.id("object", modifier[1]).int(modifier[2]).int(modifier[3])
+        return self.command(ER_SET, writer).int()
+
+    def clear_event(self, kind, request_id):
+        self.command(ER_CLEAR, self.writer().byte(kind).int(request_id))
+
+
+expression_token_regex = re.compile(r"""\s*(?:
+    (?P<number>0[xX][0-9a-fA-F]+[lL]?|(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?[lLfFdD]?)|
+    (?P<string>"(?:[^"\\]|\\.)*")|
+    (?P<char>'(?:[^'\\]|\\.)')|
+    (?P<name>[A-Za-z_$][\w$]*)|
+    (?P<op>&&|\|\||==|!=|<=|>=|[-+*/%<>!().,\[\]])
+)""", re.X)
+
+## Binding strength of the binary operators
+BINARY_OPERATORS = {
+    "||": 1, "&&": 2, "==": 3, "!=": 3, "<": 4, "<=": 4, ">": 4, ">=": 4,
+    "+": 5, "-": 5, "*": 6, "/": 6, "%": 6
+}
+
+
+def tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = expression_token_regex.match(expression, pos)
+        if m is None or m.end() == pos:
+            raise JDWPEvalError("Unexpected '%s' in expression" % expression[pos:].strip())
+        tokens.append((m.lastgroup, m.group(m.lastgroup)))
+        pos = m.end()
+    return tokens
+
+
+class JDWPExpressionParser(object):
+    """
+    Parses the Java expressions jdb's "print" takes into a tree of tuples:  names, field access,
+    array elements, method calls, literals and unary/binary operators
+    """
+    def __init__(self, expression):
+        self.tokens = tokenize(expression)
+        self.pos = 0
+
+    def parse(self):
+        node = self.binary(0)
+        if self.pos < len(self.tokens):
+            raise JDWPEvalError("Unexpected '%s' in expression" % self.tokens[self.pos][1])
+        return node
+
+    def peek(self):
+        return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            raise JDWPEvalError("Unexpected end of expression")
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def expect(self, op):
+        kind, text = self.next()
+        if text != op:
+            raise JDWPEvalError("Expected '%s' instead of '%s'" % (op, text))
+
+    def binary(self, min_strength):
+        node = self.unary()
+        while self.peek() in BINARY_OPERATORS and BINARY_OPERATORS[self.peek()] > min_strength:
+            op = self.next()[1]
+            node = ("binary", op, node, self.binary(BINARY_OPERATORS[op]))
+        return node
+
+    def unary(self):
+        if self.peek() in ("!", "-"):
+            op = self.next()[1]
+            return ("unary", op, self.unary())
+        return self.postfix(self.primary())
+
+    def primary(self):
+        kind, text = self.next()
+        if kind == "number":
+            return ("literal", parse_number(text))
+        if kind == "string":
+            return ("literal", JDWPValue("$", unescape(text[1:-1])))
+        if kind == "char":
+            return ("literal", JDWPValue("C", ord(unescape(text[1:-1]))))
+        if kind == "name":
+            if text in ("true", "false"):
+                return ("literal", JDWPValue("Z", text == "true"))
+            if text == "null":
+                return ("literal", NULL)
+            if self.peek() == "(":
+                return ("call", None, text, self.arguments())
+            return ("name", text)
+        if text == "(":
+            node = self.binary(0)
+            self.expect(")")
+            return node
+        raise JDWPEvalError("Unexpected '%s' in expression" % text)
+
+    def postfix(self, node):
+        while True:
+            if self.peek() == ".":
+                self.next()
+                kind, name = self.next()
+                if kind != "name":
+                    raise JDWPEvalError("Expected a name after '.'")
+                if self.peek() == "(":
+                    node = ("call", node, name, self.arguments())
+                else:
+                    node = ("field", node, name)
+            elif self.peek() == "[":
+                self.next()
+                index = self.binary(0)
+                self.expect("]")
+                node = ("index", node, index)
+            else:
+                return node
+
+    def arguments(self):
+        self.expect("(")
+        args = []
+        if self.peek() == ")":
+            self.next()
+            return args
+        while True:
+            args.append(self.binary(0))
+            if self.next()[1] == ")":
+                return args
+
+
+def parse_number(text):
+    suffix = text[-1].lower()
+    if text.lower().startswith("0x"):
+        ## Hex literals spell out the bits, 0xFFFFFFFF being -1
+        tag = "J" if suffix == "l" else "I"
+        return JDWPValue(tag, wrap_integer(int(text.rstrip("lL"), 16), tag))
+    if suffix == "l":
+        return JDWPValue("J", int(text[:-1]))
+    if suffix in ("f", "d"):
+        return JDWPValue(suffix.upper(), float(text[:-1]))
+    if any(c in text for c in ".eE"):
+        return JDWPValue("D", float(text))
+    return JDWPValue("I", int(text))
+
+
+def unescape(text):
+    return text.encode("latin-1", "backslashreplace").decode("unicode_escape")
+
+
+def wrap_integer(value, tag):
+    bits = 64 if tag == "J" else 32
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+
+class JDWPProcess(object):
+    """
+    Stands in for the jdb process of a session:  takes the same commands on stdin and answers
+    them in jdb's words, but talks JDWP to the VM over a socket, so there's no jdb JVM to start.
+    The listener gets the output the way the session's jdb output reader hands it on:
+    on_prompt(output) for the answer to a command, on_thread_marker(output, marker) when the VM
+    stops, on_deferred(target, error) once a deferred breakpoint got set (or failed to),
+    on_notice(output) for anything else and on_output_ended() once the VM is gone.
+    Frames, threads, variables and breakpoints are also available without going through text,
+    see call()
+    """
+    def __init__(self, host, port, listener, timeout=None):
+        self.host = host
+        self.port = port
+        self.listener = listener
+        self.timeout = timeout
+        self.connection = JDWPConnection(self.on_event, self.on_close)
+        self.vm = JDWPVirtualMachine(self.connection, timeout)
+        self.stdin = self
+        self.returncode = None
+        self.items = Queue.Queue()
+        ## jdb's current thread and frame
+        self.thread = None
+        self.frame_index = 0
+        self.frames = {}
+        self.at_breakpoint = None
+        self.step_request = None
+        ## spec -> [(event kind, request id)] of what's set in the VM, spec -> (class name, setter, target)
+        ## of what waits for its class to be loaded, class name -> its class prepare request id
+        self.requests = {}
+        self.deferred = collections.OrderedDict()
+        self.prepare_requests = {}
+        ## A VM started with suspend=y is left suspended until the session has set its breakpoints
+        self.start_suspended = False
+        self.attached = False
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.start()
+
+    def poll(self):
+        return self.returncode
+
+    def write(self, data):
+        for line in data.decode("utf-8").split("\n"):
+            if line.strip():
+                self.items.put(("command", line.strip()))
+
+    def flush(self):
+        pass
+
+    def resume_attached(self):
+        """
+        Called once the session is set up, to let a VM that waits on its debugger run
+        """
+        self.items.put(("attached", None))
+
+    def call(self, name, args, callback):
+        """
+        Run one of the structured requests (stack_frames, thread_list, local_values, field_values,
+        evaluation, set_breakpoint, clear_breakpoint) in turn with the commands, handing
+        callback(result, error) its result or the JDWPError it failed with
+        """
+        self.items.put(("call", (name, args, callback)))
+        ## Once run() has ended its queue is never read again
+        if self.returncode is not None:
+            self.fail_calls()
+
+    def on_event(self, reader):
+        self.items.put(("events", read_events(reader)))
+
+    def on_close(self):
+        self.items.put(None)
+
+    def run(self):
+        try:
+            self.connection.connect(self.host, self.port, self.timeout)
+            description, version, vm_name = self.vm.version()
+            ## Like jdb's first prompt, this tells the session the VM can be talked to
+            self.listener.on_prompt("Connected to %s %s" % (vm_name, version))
+        except (OSError, JDWPError) as e:
+            self.listener.on_notice("Cannot attach to %s:%d: %s" % (self.host, self.port, e))
+            self.returncode = 1
+            self.fail_calls()
+            self.listener.on_output_ended()
+            return
+        while True:
+            item = self.items.get()
+            if item is None:
+                break
+            try:
+                if item[0] == "command":
+                    self.handle_command(item[1])
+                elif item[0] == "call":
+                    self.handle_call(*item[1])
+                elif item[0] == "events":
+                    self.handle_events(*item[1])
+                elif item[0] == "attached":
+                    self.attached = True
+                    if self.start_suspended:
+                        self.start_suspended = False
+                        self.resume()
+            except:
+                traceback.print_exc()
+        self.returncode = 0
+        self.fail_calls()
+        self.listener.on_output_ended()
+
+    def fail_calls(self):
+        ## Nobody is going to answer what's still queued
+        while True:
+            try:
+                item = self.items.get_nowait()
+            except Queue.Empty:
+                return
+            if item is not None and item[0] == "call":
+                item[1][2](None, JDWPError("Connection closed"))
+
+    def handle_call(self, name, args, callback):
+        try:
+            result = getattr(self, name)(*args)
+        except (JDWPError, JDWPEvalError) as e:
+            callback(None, e)
+            return
+        except:
+            traceback.print_exc()
+            callback(None, JDWPError("Internal error in %s" % name))
+            return
+        callback(result, None)
+
+    def handle_command(self, line):
+        words = line.split(None, 1)
+        name = words[0]
+        args = words[1] if len(words) > 1 else ""
+        if line == "step up":
+            name, args = "step_up", ""
+        handler = getattr(self, "cmd_%s" % name, None)
+        try:
+            if handler is None:
+                output = "Unrecognized command: '%s'.  Try help..." % name
+            else:
+                output = handler(args)
+        except JDWPEvalError as e:
+            output = str(e)
+        except JDWPError as e:
+            output = "Error: %s" % e
+        ## Commands that resume the VM don't get a prompt until it stops again
+        if output is not None:
+            self.listener.on_prompt(output)
+
+    def resume(self):
+        self.frames = {}
+        self.frame_index = 0
+        self.at_breakpoint = None
+        self.vm.resume()
+
+    ## Events
+
+    def handle_events(self, suspend_policy, events):
+        stops = []
+        for event in events:
+            if event.kind == VM_START:
+                self.thread = event.thread
+                self.start_suspended = suspend_policy != SUSPEND_NONE and not self.attached
+                if suspend_policy != SUSPEND_NONE and self.attached:
+                    ## Too late to hold it for the breakpoints, just let it go
+                    self.resume()
+                return
+            if event.kind == VM_DEATH:
+                self.listener.on_notice("The application exited")
+            elif event.kind == CLASS_PREPARE:
+                self.class_prepared(event)
+            elif event.thread is not None and event.location is not None:
+                stops.append(self.describe_stop(event))
+        if len(stops) > 0:
+            self.clear_step()
+            self.thread = events[-1].thread
+            self.frame_index = 0
+            self.frames = {}
+            marker = "%s[1]" % self.vm.thread_name(self.thread)
+            self.listener.on_thread_marker("\n".join(stops), marker)
+        elif suspend_policy != SUSPEND_NONE:
+            self.resume()
+
+    def describe_stop(self, event):
+        where = "\"thread=%s\", %s" % (self.vm.thread_name(event.thread), self.describe_location(event.location))
+        if event.kind == BREAKPOINT:
+            self.at_breakpoint = event.thread
+            return "Breakpoint hit: %s" % where
+        if event.kind == SINGLE_STEP:
+            return "Step completed: %s" % where
+        if event.kind == EXCEPTION:
+            exception = self.vm.class_name(self.vm.object_type(event.data["exception"].value))
+            catch = event.data["catch_location"]
+            if catch.class_id == 0:
+                return "Exception occurred: %s (uncaught)%s" % (exception, where)
+            return "Exception occurred: %s (to be caught at: %s)%s" % (exception, self.describe_location(catch), where)
+        if event.kind in (FIELD_ACCESS, FIELD_MODIFICATION):
+            field = "%s.%s" % (self.vm.class_name(event.data["type_id"]),
+                               self.field_name(event.data["type_id"], event.data["field_id"]))
+            if event.kind == FIELD_ACCESS:
+                return "Field (%s) access encountered: %s" % (field, where)
+            return "Field (%s) is %s, will be %s: %s" % (
+                field, self.format_value(self.field_value(event)), self.format_value(event.data["value"]), where)
+        return "Stopped: %s" % where
+
+    def describe_location(self, location):
+        """
+        Where an event happened, as jdb puts it:  Class.method(), line=12 bci=3
+        """
+        method = self.vm.method(location.class_id, location.method_id)
+        line = self.vm.line_number(location)
+        return "%s.%s(), line=%s bci=%d" % (self.vm.class_name(location.class_id),
+                                            method.name if method is not None else "?",
+                                            "%d" % line if line is not None else "-1",
+                                            location.index)
+
+    def field_name(self, ref, field_id):
+        for field in self.vm.fields(ref):
+            if field.id == field_id:
+                return field.name
+        return "?"
+
+    def field_value(self, event):
+        for field in self.vm.fields(event.data["type_id"]):
+            if field.id == event.data["field_id"]:
+                if event.data["object"].value == 0:
+                    return self.vm.static_values(event.data["type_id"], [field])[0]
+                return self.vm.object_values(event.data["object"].value, [field])[0]
+        return NULL
+
+    def class_prepared(self, event):
+        class_name = signature_name(event.data["signature"])
+        for spec, (deferred_class, setter, target) in list(self.deferred.items()):
+            if deferred_class != class_name:
+                continue
+            del self.deferred[spec]
+            try:
+                setter((event.data["type_tag"], event.data["type_id"]))
+                self.listener.on_notice("Set deferred %s" % spec)
+                self.listener.on_deferred(target, None)
+            except JDWPEvalError as e:
+                self.listener.on_notice("Unable to set deferred %s : %s" % (spec, e))
+                self.listener.on_deferred(target, str(e))
+        if not any(deferred[0] == class_name for deferred in self.deferred.values()):
+            request_id = self.prepare_requests.pop(class_name, None)
+            if request_id is not None:
+                self.vm.clear_event(CLASS_PREPARE, request_id)
+
+    ## Breakpoints
+
+    def add_request(self, spec, class_name, describe, setter, target):
+        """
+        Set a breakpoint-like request now if its class is loaded, otherwise once it is.  Returns
+        (status, message), status being "set", "deferred" or "failed".  target is what the
+        breakpoint is on (Class:line, Class.method, the exception class or Class.field)
+        """
+        if spec in self.requests:
+            return "set", "%s is already set" % describe
+        if spec in self.deferred:
+            return "deferred", "%s is already set" % describe
+        cls = self.vm.find_class(class_name)
+        if cls is None:
+            self.deferred[spec] = (class_name, setter, target)
+            if class_name not in self.prepare_requests:
+                self.prepare_requests[class_name] = self.vm.set_event(CLASS_PREPARE, SUSPEND_ALL,
+                                                                      [(MOD_CLASS_MATCH, class_name)])
+            return "deferred", "Deferring %s.\nIt will be set after the class is loaded." % describe
+        try:
+            setter(cls)
+        except JDWPEvalError as e:
+            return "failed", "Unable to set %s : %s" % (describe, e)
+        return "set", "Set %s" % describe
+
+    def remove_request(self, spec, describe):
+        """
+        (found, message) for clearing a breakpoint-like request
+        """
+        if self.deferred.pop(spec, None) is not None:
+            return True, "Removed: %s" % describe
+        requests = self.requests.pop(spec, None)
+        if requests is None:
+            return False, "Not found: %s" % describe
+        for kind, request_id in requests:
+            self.vm.clear_event(kind, request_id)
+        return True, "Removed: %s" % describe
+
+    def set_breakpoint(self, cmd):
+        """
+        Structured "stop", "catch" or "watch":  (status, message) as for add_request
+        """
+        name, sep, args = cmd.partition(" ")
+        handler = {"stop": self.stop_request, "catch": self.catch_request, "watch": self.watch_request}.get(name)
+        if handler is None:
+            return "failed", "Unrecognized command: '%s'" % name
+        return handler(args)
+
+    def clear_breakpoint(self, cmd):
+        """
+        Structured "clear", "ignore" or "unwatch":  whether there was such a breakpoint
+        """
+        name, sep, args = cmd.partition(" ")
+        handler = {"clear": self.clear_request, "ignore": self.ignore_request, "unwatch": self.unwatch_request}.get(name)
+        return handler is not None and handler(args)[0]
+
+    def line_setter(self, spec, line):
+        def setter(cls):
+            locations = []
+            for method in self.vm.methods(cls[1]):
+                table = self.vm.line_table(cls[1], method.id)
+                if table is None:
+                    continue
+                for code_index, line_number in table[2]:
+                    if line_number == line:
+                        locations.append(JDWPLocation(cls[0], cls[1], method.id, code_index))
+            if not locations:
+                raise JDWPEvalError("No code at line %d in %s" % (line, self.vm.class_name(cls[1])))
+            ## Like jdb, stop at every piece of code for the line:  other methods on it, lambdas
+            ## and the copies of finally blocks
+            for location in locations:
+                self.add_breakpoint(spec, location)
+        return setter
+
+    def method_setter(self, spec, method_name):
+        def setter(cls):
+            found = False
+            for method in self.vm.methods(cls[1]):
+                if method.name != method_name:
+                    continue
+                table = self.vm.line_table(cls[1], method.id)
+                self.add_breakpoint(spec, JDWPLocation(cls[0], cls[1], method.id, table[0] if table is not None else 0))
+                found = True
+            if not found:
+                raise JDWPEvalError("%s is not a valid method name" % method_name)
+        return setter
+
+    def add_breakpoint(self, spec, location):
+        request_id = self.vm.set_event(BREAKPOINT, SUSPEND_ALL, [(MOD_LOCATION_ONLY, location)])
+        self.requests.setdefault(spec, []).append((BREAKPOINT, request_id))
+
+    def stop_request(self, args):
+        words = args.split(None, 1)
+        if len(words) < 2 or words[0] not in ("at", "in"):
+            return "failed", "Usage: stop at <class>:<line> or stop in <class>.<method>"
+        spec = words[1]
+        if words[0] == "at":
+            class_name, sep, line = spec.rpartition(":")
+            if not sep or not line.isdigit():
+                return "failed", "%s is not a valid line number" % spec
+            setter = self.line_setter(spec, int(line))
+        else:
+            class_name, sep, method = spec.split("(", 1)[0].rpartition(".")
+            if not sep:
+                return "failed", "%s is not a valid method name" % spec
+            setter = self.method_setter(spec, method)
+        return self.add_request(spec, class_name, "breakpoint %s" % spec, setter, spec)
+
+    def cmd_stop(self, args):
+        return self.stop_request(args)[1]
+
+    def clear_request(self, args):
+        spec = args.strip()
+        if not spec:
+            return False, "Usage: clear <class>:<line> or clear <class>.<method>"
+        return self.remove_request(spec, "breakpoint %s" % spec)
+
+    def cmd_clear(self, args):
+        return self.clear_request(args)[1]
+
+    def exception_args(self, args):
+        words = args.split()
+        mode = words[0] if len(words) > 1 and words[0] in ("caught", "uncaught", "all") else "all"
+        return mode, words[-1] if len(words) > 0 else ""
+
+    def catch_request(self, args):
+        mode, class_name = self.exception_args(args)
+        spec = "%s %s" % (mode, class_name)
+
+        def setter(cls):
+            request_id = self.vm.set_event(EXCEPTION, SUSPEND_ALL, [
+                (MOD_EXCEPTION_ONLY, cls[1], mode in ("caught", "all"), mode in ("uncaught", "all"))
+            ])
+            self.requests[spec] = [(EXCEPTION, request_id)]
+        return self.add_request(spec, class_name, spec, setter, class_name)
+
+    def cmd_catch(self, args):
+        return self.catch_request(args)[1]
+
+    def ignore_request(self, args):
+        mode, class_name = self.exception_args(args)
+        spec = "%s %s" % (mode, class_name)
+        return self.remove_request(spec, spec)
+
+    def cmd_ignore(self, args):
+        return self.ignore_request(args)[1]
+
+    def watch_args(self, args):
+        words = args.split()
+        mode = words[0] if len(words) > 1 and words[0] in ("access", "all") else "modification"
+        field = words[-1] if len(words) > 0 else ""
+        kinds = {"access": [FIELD_ACCESS], "all": [FIELD_ACCESS, FIELD_MODIFICATION]}.get(mode, [FIELD_MODIFICATION])
+        describe = "watch %s of %s" % ("accesses" if mode == "access" else mode, field)
+        if mode == "all":
+            describe = "watch accesses and modification of %s" % field
+        return field, kinds, describe
+
+    def watch_request(self, args):
+        field_spec, kinds, describe = self.watch_args(args)
+        class_name, sep, field_name = field_spec.rpartition(".")
+        if not sep:
+            return "failed", "%s is not a valid field name" % field_spec
+
+        def setter(cls):
+            for field in self.vm.fields(cls[1]):
+                if field.name == field_name:
+                    self.requests[describe] = [
+                        (kind, self.vm.set_event(kind, SUSPEND_ALL, [(MOD_FIELD_ONLY, cls[1], field.id)]))
+                        for kind in kinds
+                    ]
+                    return
+            raise JDWPEvalError("No field %s in %s" % (field_name, class_name))
+        return self.add_request(describe, class_name, describe, setter, field_spec)
+
+    def cmd_watch(self, args):
+        return self.watch_request(args)[1]
+
+    def unwatch_request(self, args):
+        field_spec, kinds, describe = self.watch_args(args)
+        return self.remove_request(describe, describe)
+
+    def cmd_unwatch(self, args):
+        return self.unwatch_request(args)[1]
+
+    ## Running
+
+    def cmd_cont(self, args):
+        self.resume()
+        return None
+
+    def step(self, depth, size=STEP_LINE):
+        if self.thread is None:
+            self.listener.on_notice("No thread specified.")
+            return None
+        self.clear_step()
+        modifiers = [(MOD_STEP, self.thread, size, depth), (MOD_COUNT, 1)]
+        if depth != STEP_OUT:
+            modifiers.extend((MOD_CLASS_EXCLUDE, pattern) for pattern in STEP_EXCLUDES)
+        self.step_request = self.vm.set_event(SINGLE_STEP, SUSPEND_ALL, modifiers)
+        self.resume()
+        return None
+
+    def clear_step(self):
+        if self.step_request is not None:
+            try:
+                self.vm.clear_event(SINGLE_STEP, self.step_request)
+            except JDWPError:
+                pass
+            self.step_request = None
+
+    def cmd_next(self, args):
+        return self.step(STEP_OVER)
+
+    def cmd_step(self, args):
+        return self.step(STEP_INTO)
+
+    def cmd_step_up(self, args):
+        return self.step(STEP_OUT)
+
+    def cmd_stepi(self, args):
+        return self.step(STEP_INTO, STEP_MIN)
+
+    def cmd_quit(self, args):
+        try:
+            self.vm.dispose()
+        except JDWPError:
+            pass
+        self.connection.close()
+        return None
+
+    ## Threads and frames
+
+    def current_frames(self):
+        if self.thread is None:
+            raise JDWPEvalError("No thread specified.")
+        if self.thread not in self.frames:
+            self.frames[self.thread] = self.vm.frames(self.thread)
+        return self.frames[self.thread]
+
+    def current_frame(self):
+        frames = self.current_frames()
+        if self.frame_index >= len(frames):
+            raise JDWPEvalError("No frames on the current call stack")
+        return frames[self.frame_index]
+
+    def stack_frames(self):
+        """
+        [(class name, method name, source file, line)] of the current thread, innermost first.
+        Source file and line are None for native methods and code without line info
+        """
+        frames = []
+        for frame_id, location in self.current_frames():
+            method = self.vm.method(location.class_id, location.method_id)
+            line = self.vm.line_number(location)
+            source = self.vm.source_file(location.class_id)
+            if location.index == 0xffffffffffffffff or line is None or source is None:
+                source, line = None, None
+            frames.append((self.vm.class_name(location.class_id), method.name if method is not None else "?", source, line))
+        return frames
+
+    def cmd_where(self, args):
+        lines = []
+        for i, ((frame_id, location), (class_name, method, source, line)) in enumerate(zip(self.current_frames(), self.stack_frames())):
+            if location.index == 0xffffffffffffffff:
+                where = "native method"
+            elif line is None:
+                where = "unknown source"
+            else:
+                where = "%s:%d" % (source, line)
+            lines.append("  [%d] %s.%s (%s)" % (i + 1, class_name, method, where))
+        return "\n".join(lines) if len(lines) > 0 else "No frames on the current call stack"
+
+    def thread_list(self):
+        """
+        [(group, type name, id, description)] of every thread, grouped by thread group
+        """
+        groups = collections.OrderedDict()
+        for thread in self.vm.all_threads():
+            try:
+                status, suspended = self.vm.thread_status(thread)
+                description = "%s %s%s" % (self.vm.thread_name(thread), THREAD_STATUS.get(status, "unknown"),
+                                           " (at breakpoint)" if thread == self.at_breakpoint else "")
+                groups.setdefault(self.vm.thread_group_name(thread), []).append(
+                    (self.vm.class_name(self.vm.object_type(thread)), "0x%x" % thread, description))
+            except JDWPError:
+                ## Gone in the meantime
+                pass
+        return [(group,) + thread for group, threads in groups.items() for thread in threads]
+
+    def cmd_threads(self, args):
+        lines = []
+        group = None
+        for thread in self.thread_list():
+            if thread[0] != group:
+                group = thread[0]
+                lines.append("Group %s:" % group)
+            lines.append("  (%s)%s %s" % thread[1:])
+        return "\n".join(lines)
+
+    def cmd_thread(self, args):
+        text = args.strip()
+        try:
+            thread = int(text, 16) if text.lower().startswith("0x") else int(text)
+        except ValueError:
+            return "Invalid thread id: %s" % text
+        if thread not in self.vm.all_threads():
+            return "\"%s\" is not a valid thread id." % text
+        self.thread = thread
+        self.frame_index = 0
+        return ""
+
+    def move_frame(self, args, direction):
+        count = int(args) if args.strip().isdigit() else 1
+        index = self.frame_index + direction * count
+        if index < 0 or index >= len(self.current_frames()):
+            return "End of stack."
+        self.frame_index = index
+        return ""
+
+    def cmd_up(self, args):
+        return self.move_frame(args, 1)
+
+    def cmd_down(self, args):
+        return self.move_frame(args, -1)
+
+    ## Variables
+
+    def visible_variables(self):
+        """
+        (arguments, locals) of the current frame, as [(JDWPVariable, value)], None without variable info
+        """
+        frame_id, location = self.current_frame()
+        table = self.vm.variable_table(location.class_id, location.method_id)
+        if table is None:
+            return None
+        arg_count, variables = table
+        visible = [v for v in variables
+                   if v.code_index <= location.index < v.code_index + v.length and v.name != "this"]
+        values = self.vm.frame_values(self.thread, frame_id, [(v.slot, v.signature) for v in visible])
+        arguments = [(v, value) for v, value in zip(visible, values) if v.slot < arg_count]
+        local_vars = [(v, value) for v, value in zip(visible, values) if v.slot >= arg_count]
+        return arguments, local_vars
+
+    def local_values(self):
+        """
+        [(name, value, description)] of the arguments and locals of the current frame, objects
+        shown through toString() as "print" does, along with their "instance of" description
+        """
+        variables = self.visible_variables()
+        if variables is None:
+            return []
+        arguments, local_vars = variables
+        return [(v.name, self.print_value(value), self.format_value(value)) for v, value in arguments + local_vars]
+
+    def field_values(self, expression):
+        """
+        [(name, value, description)] of the instance fields of the object an expression evaluates
+        to, as "dump" shows them.  Empty for anything that isn't an object
+        """
+        try:
+            value = self.evaluate(expression)
+        except JDWPEvalError:
+            return []
+        if value.tag in ("[", "s", "$") or value.tag in PRIMITIVE_FORMATS or value.value == 0:
+            return []
+        fields = []
+        for ref in self.vm.hierarchy(self.vm.object_type(value.value)):
+            instance_fields = [field for field in self.vm.fields(ref) if not field.modifiers & 0x8]
+            for field, field_value in zip(instance_fields, self.vm.object_values(value.value, instance_fields) if instance_fields else []):
+                shown = self.format_value(field_value)
+                fields.append((field.name, shown, shown))
+        return fields
+
+    def evaluation(self, expression):
+        """
+        (value, None) of an expression as "print" shows it, or (None, error message)
+        """
+        try:
+            return self.print_value(self.evaluate(expression)), None
+        except JDWPEvalError as e:
+            return None, str(e)
+
+    def cmd_locals(self, args):
+        variables = self.visible_variables()
+        if variables is None:
+            return "Local variable information not available.  Compile with -g to generate variable information"
+        arguments, local_vars = variables
+        if len(arguments) == 0 and len(local_vars) == 0:
+            return "No local variables"
+        lines = ["Method arguments:"]
+        lines.extend("%s = %s" % (v.name, self.format_value(value)) for v, value in arguments)
+        lines.append("Local variables:")
+        lines.extend("%s = %s" % (v.name, self.format_value(value)) for v, value in local_vars)
+        return "\n".join(lines)
+
+    def cmd_print(self, args):
+        expression = args.strip()
+        return " %s = %s" % (expression, self.print_value(self.evaluate(expression)))
+
+    cmd_eval = cmd_print
+
+    def cmd_dump(self, args):
+        expression = args.strip()
+        fields = self.field_values(expression)
+        if len(fields) == 0:
+            return " %s = %s" % (expression, self.format_value(self.evaluate(expression)))
+        lines = [" %s = {" % expression]
+        lines.extend("    %s: %s" % (name, value) for name, value, description in fields)
+        lines.append("}")
+        return "\n".join(lines)
+
+    def print_value(self, value):
+        """
+        A value the way jdb shows it in "print":  objects through their toString()
+        """
+        if value.tag in ("L", "t", "g", "l", "c") and value.value != 0:
+            return "\"%s\"" % self.to_string(value)
+        return self.format_value(value)
+
+    def format_value(self, value):
+        """
+        A value the way jdb shows it in "locals" and "dump"
+        """
+        if value.tag == "Z":
+            return "true" if value.value else "false"
+        if value.tag == "C":
+            return chr(value.value)
+        if value.tag == "F":
+            return repr(float("%.7g" % value.value))
+        if value.tag in PRIMITIVE_FORMATS:
+            return repr(value.value)
+        if value.tag == "V":
+            return "<void value>"
+        if value.tag == "$":
+            return "\"%s\"" % value.value
+        if value.value == 0:
+            return "null"
+        if value.tag == "s":
+            return "\"%s\"" % self.vm.string_value(value.value)
+        type_name = self.vm.class_name(self.vm.object_type(value.value))
+        if value.tag == "[":
+            ## The length goes on the first dimension:  int[3][]
+            element, sep, dims = type_name.partition("[]")
+            return "instance of %s[%d]%s (id=%d)" % (element, self.vm.array_length(value.value), dims, value.value)
+        return "instance of %s(id=%d)" % (type_name, value.value)
+
+    def to_string(self, value):
+        result = self.invoke(value, "toString", [])
+        if result.value == 0:
+            return "null"
+        return self.vm.string_value(result.value)
+
+    def text(self, value):
+        """
+        Python string for a value taking part in a string concatenation
+        """
+        if value.tag == "$":
+            return value.value
+        if value.tag == "s" and value.value != 0:
+            return self.vm.string_value(value.value)
+        if value.tag in ("L", "t", "g", "l", "c") and value.value != 0:
+            return self.to_string(value)
+        return self.format_value(value)
+
+    ## Expressions
+
+    def evaluate(self, expression):
+        return self.eval_node(JDWPExpressionParser(expression).parse())
+
+    def eval_node(self, node):
+        kind = node[0]
+        if kind == "literal":
+            return node[1]
+        if kind == "name":
+            value = self.lookup_name(node[1])
+            if value is None:
+                raise JDWPEvalError("Name unknown: %s" % node[1])
+            return value
+        if kind == "field":
+            cls = self.class_of_node(node[1])
+            if cls is not None:
+                return self.static_field(cls, node[2])
+            return self.instance_field(self.eval_node(node[1]), node[2])
+        if kind == "index":
+            array = self.eval_node(node[1])
+            index = self.eval_node(node[2])
+            if array.tag != "[" or array.value == 0:
+                raise JDWPEvalError("Not an array")
+            if index.tag not in ("B", "C", "S", "I", "J"):
+                raise JDWPEvalError("Array index must be an integer")
+            if not 0 <= index.value < self.vm.array_length(array.value):
+                raise JDWPEvalError("Array index out of bounds: %d" % index.value)
+            return self.vm.array_values(array.value, index.value, 1)[0]
+        if kind == "call":
+            args = [self.eval_node(arg) for arg in node[3]]
+            if node[1] is None:
+                frame_id, location = self.current_frame()
+                this = self.vm.this_object(self.thread, frame_id)
+                if this.value != 0:
+                    return self.invoke(this, node[2], args)
+                return self.invoke_static(location.class_id, node[2], args)
+            cls = self.class_of_node(node[1])
+            if cls is not None:
+                return self.invoke_static(cls, node[2], args)
+            return self.invoke(self.eval_node(node[1]), node[2], args)
+        if kind == "unary":
+            value = self.eval_node(node[2])
+            if node[1] == "!":
+                if value.tag != "Z":
+                    raise JDWPEvalError("Operand of ! must be boolean")
+                return JDWPValue("Z", not value.value)
+            if value.tag not in ("B", "C", "S", "I", "J", "F", "D"):
+                raise JDWPEvalError("Operand of - must be a number")
+            tag = value.tag if value.tag in ("J", "F", "D") else "I"
+            return JDWPValue(tag, wrap_integer(-value.value, tag) if tag in ("I", "J") else -value.value)
+        return self.binary(node[1], node[2], node[3])
+
+    def lookup_name(self, name):
+        """
+        A local variable, a field of "this" or a static field of the current class, None if
+        there's none of that name
+        """
+        frame_id, location = self.current_frame()
+        if name == "this":
+            return self.vm.this_object(self.thread, frame_id)
+        variables = self.visible_variables()
+        if variables is not None:
+            for v, value in variables[0] + variables[1]:
+                if v.name == name:
+                    return value
+        this = self.vm.this_object(self.thread, frame_id)
+        ref = self.vm.object_type(this.value) if this.value != 0 else location.class_id
+        for cls in self.vm.hierarchy(ref):
+            for field in self.vm.fields(cls):
+                if field.name == name:
+                    if field.modifiers & 0x8 or this.value == 0:
+                        return self.vm.static_values(cls, [field])[0]
+                    return self.vm.object_values(this.value, [field])[0]
+        return None
+
+    def class_of_node(self, node):
+        """
+        The class a (dotted) name stands for, when it isn't a variable
+        """
+        names = []
+        while node[0] == "field":
+            names.insert(0, node[2])
+            node = node[1]
+        if node[0] != "name":
+            return None
+        names.insert(0, node[1])
+        ## A variable hides any class of the same name
+        if self.lookup_name(names[0]) is not None:
+            return None
+        class_name = ".".join(names)
+        candidates = [class_name, "java.lang.%s" % class_name]
+        frame_id, location = self.current_frame()
+        package = self.vm.class_name(location.class_id).rpartition(".")[0]
+        if package:
+            candidates.insert(0, "%s.%s" % (package, class_name))
+        for candidate in candidates:
+            cls = self.vm.find_class(candidate)
+            if cls is not None:
+                return cls[1]
+        return None
+
+    def static_field(self, cls, name):
+        for ref in self.vm.hierarchy(cls):
+            for field in self.vm.fields(ref):
+                if field.name == name and field.modifiers & 0x8:
+                    return self.vm.static_values(ref, [field])[0]
+        raise JDWPEvalError("No static field %s in %s" % (name, self.vm.class_name(cls)))
+
+    def instance_field(self, value, name):
+        if value.tag in PRIMITIVE_FORMATS or value.tag == "$":
+            raise JDWPEvalError("Cannot access field %s of a primitive value" % name)
+        if value.value == 0:
+            raise JDWPEvalError("Null pointer accessing field %s" % name)
+        if value.tag == "[":
+            if name != "length":
+                raise JDWPEvalError("Arrays only have a length field")
+            return JDWPValue("I", self.vm.array_length(value.value))
+        for ref in self.vm.hierarchy(self.vm.object_type(value.value)):
+            for field in self.vm.fields(ref):
+                if field.name == name:
+                    if field.modifiers & 0x8:
+                        return self.vm.static_values(ref, [field])[0]
+                    return self.vm.object_values(value.value, [field])[0]
+        raise JDWPEvalError("No field %s" % name)
+
+    def find_method(self, cls, name, args):
+        """
+        (declaring class, method) of the first method of that name and arity, preferring one whose
+        primitive/reference parameters line up with the arguments
+        """
+        candidates = []
+        for ref in self.vm.hierarchy(cls):
+            for method in self.vm.methods(ref):
+                if method.name == name and len(parameter_signatures(method.signature)) == len(args):
+                    candidates.append((ref, method))
+        for ref, method in candidates:
+            params = parameter_signatures(method.signature)
+            if all((param in PRIMITIVE_FORMATS) == (arg.tag in PRIMITIVE_FORMATS) for param, arg in zip(params, args)):
+                return ref, method
+        if len(candidates) > 0:
+            return candidates[0]
+        raise JDWPEvalError("No method %s with %d argument(s) in %s" % (name, len(args), self.vm.class_name(cls)))
+
+    def convert_args(self, method, args):
+        converted = []
+        for param, arg in zip(parameter_signatures(method.signature), args):
+            if arg.tag == "$":
+                arg = JDWPValue("s", self.vm.create_string(arg.value))
+            if param in PRIMITIVE_FORMATS and arg.tag in PRIMITIVE_FORMATS and param != arg.tag:
+                value = arg.value
+                if param in ("F", "D"):
+                    value = float(value)
+                elif param == "Z":
+                    value = bool(value)
+                else:
+                    value = int(value)
+                arg = JDWPValue(param, value)
+            converted.append(arg)
+        return converted
+
+    def invoke(self, value, name, args):
+        if value.tag in PRIMITIVE_FORMATS:
+            raise JDWPEvalError("Cannot call %s() on a primitive value" % name)
+        if value.tag == "$":
+            value = JDWPValue("s", self.vm.create_string(value.value))
+        if value.value == 0:
+            raise JDWPEvalError("Null pointer calling %s()" % name)
+        ref, method = self.find_method(self.vm.object_type(value.value), name, args)
+        try:
+            result, exception = self.vm.invoke(value.value, self.thread, ref, method.id, self.convert_args(method, args))
+        finally:
+            self.invoked()
+        return self.invoke_result(result, exception)
+
+    def invoke_static(self, cls, name, args):
+        ref, method = self.find_method(cls, name, args)
+        if not method.modifiers & 0x8:
+            raise JDWPEvalError("%s() is not static" % name)
+        try:
+            result, exception = self.vm.invoke(None, self.thread, ref, method.id, self.convert_args(method, args),
+                                               static=True)
+        finally:
+            self.invoked()
+        return self.invoke_result(result, exception)
+
+    def invoked(self):
+        ## An invoke resumes the thread, which invalidates its frame ids.  The selected frame
+        ## stays, its id is looked up again when next needed
+        self.frames.pop(self.thread, None)
+
+    def invoke_result(self, result, exception):
+        if exception != 0:
+            raise JDWPEvalError("Exception in invoked method: %s" % self.vm.class_name(self.vm.object_type(exception)))
+        return result
+
+    def binary(self, op, left_node, right_node):
+        left = self.eval_node(left_node)
+        if op in ("&&", "||"):
+            if left.tag != "Z":
+                raise JDWPEvalError("Operands of %s must be boolean" % op)
+            if left.value == (op == "||"):
+                return left
+            right = self.eval_node(right_node)
+            if right.tag != "Z":
+                raise JDWPEvalError("Operands of %s must be boolean" % op)
+            return right
+        right = self.eval_node(right_node)
+        numeric = ("B", "C", "S", "I", "J", "F", "D")
+        if op == "+" and (left.tag in ("s", "$") or right.tag in ("s", "$")):
+            return JDWPValue("$", self.text(left) + self.text(right))
+        if op in ("==", "!="):
+            if left.tag in numeric and right.tag in numeric or left.tag == right.tag == "Z":
+                equal = left.value == right.value
+            elif left.tag in ("s", "$") and right.tag in ("s", "$") and left.value != 0 and right.value != 0:
+                equal = self.text(left) == self.text(right)
+            else:
+                equal = left.value == right.value and left.tag not in numeric and right.tag not in numeric
+            return JDWPValue("Z", equal == (op == "=="))
+        if left.tag not in numeric or right.tag not in numeric:
+            raise JDWPEvalError("Operands of %s must be numbers" % op)
+        a, b = left.value, right.value
+        if op in ("<", "<=", ">", ">="):
+            return JDWPValue("Z", {"<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b}[op])
+        tags = (left.tag, right.tag)
+        tag = "D" if "D" in tags else "F" if "F" in tags else "J" if "J" in tags else "I"
+        if tag in ("I", "J"):
+            if op in ("/", "%") and b == 0:
+                raise JDWPEvalError("Exception: java.lang.ArithmeticException: / by zero")
+            if op == "/":
+                result = abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+            elif op == "%":
+                result = a - b * (abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1))
+            else:
+                result = {"+": a + b, "-": a - b, "*": a * b}[op]
+            return JDWPValue(tag, wrap_integer(result, tag))
+        if op in ("/", "%") and b == 0:
+            return JDWPValue(tag, float("nan") if op == "%" or a == 0 else float("inf") if a > 0 else float("-inf"))
+        return JDWPValue(tag, {"+": a + b, "-": a - b, "*": a * b, "/": a / b, "%": a - b * int(a / b)}[op])
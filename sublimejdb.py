@@ -24,39 +24,77 @@ import sublime
 import sublime_plugin
 import subprocess
 import threading
-import time
 import traceback
 import os
 import sys
 import re
 import queue as Queue
+import logging
+import logging.handlers
+import codecs
+import collections
+import difflib
+import bisect
+import json
+import tempfile
+import hashlib
+import html
+try:
+    from . import jdwp
+except (ImportError, SystemError, ValueError):
+    import jdwp
 
 DEBUG = None
 
-jdb_lastresult = ""
-jdb_cursor = ""
-jdb_cursor_position = 0
-jdb_last_cursor_view = None
-jdb_bkp_layout = {}
-jdb_bkp_window = None
-jdb_bkp_view = None
-jdb_shutting_down = False
-jdb_process = None
-jdb_run_status = None
+## Max number of bytes taken from a JDB output pipe per read
+OUTPUT_CHUNK_SIZE = 65536
+
+class JDBViewScheduler(object):
+    """
+    Applies the queued updates of every debugger view from a single UI callback per frame,
+    however much output arrives in between
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = []
+        self.pending = False
+
+    def schedule(self, view):
+        with self.lock:
+            if view not in self.dirty:
+                self.dirty.append(view)
+            if self.pending:
+                return
+            self.pending = True
+        rate = get_settings().view_update_rate
+        sublime.set_timeout(self.flush, int(1000 / rate) if rate > 0 else 0)
+
+    def flush(self):
+        with self.lock:
+            views = self.dirty
+            self.dirty = []
+            self.pending = False
+        for view in views:
+            view.update()
+
+
+jdb_view_scheduler = JDBViewScheduler()
+
 
 class JDBView(object):
     """
     Base class for each view (tab) in the debugger
     """
-    def __init__(self, name, s=True, settingsprefix=None):
+    def __init__(self, session, name, s=True, settingsprefix=None):
         self.queue = Queue.Queue()
+        self.session = session
         self.name = name
         self.closed = True
         self.doScroll = s
         self.view = None
         self.settingsprefix = settingsprefix
-        self.timer = None
-        self.lines = ""
+        ## Text added since the last flush, applied as a single insert
+        self.lines = []
         self.lock = threading.RLock()
 
     def is_open(self):
@@ -64,76 +102,80 @@ class JDBView(object):
 
     def open_at_start(self):
         if self.settingsprefix is not None:
-            return get_setting("%s_open" % self.settingsprefix, False)
+            return getattr(get_settings(self.session), "%s_open" % self.settingsprefix)
         return False
 
     def open(self):
         if self.view is None or self.view.window() is None:
             if self.settingsprefix is not None:
-                sublime.active_window().focus_group(get_setting("%s_group" % self.settingsprefix, 0))
+                self.session.window.focus_group(getattr(get_settings(self.session), "%s_group" % self.settingsprefix))
             self.create_view()
 
     def close(self):
         if self.view is not None:
             if self.settingsprefix is not None:
-                sublime.active_window().focus_group(get_setting("%s_group" % self.settingsprefix, 0))
+                self.session.window.focus_group(getattr(get_settings(self.session), "%s_group" % self.settingsprefix))
             self.destroy_view()
 
     def should_update(self):
-        return self.is_open() and is_running() and jdb_run_status == "stopped"
+        return self.is_open() and self.session.is_running() and self.session.run_status == "stopped"
+
+    def is_visible(self):
+        """
+        Open and the selected tab of its group
+        """
+        window = self.view.window() if self.is_open() else None
+        if window is None:
+            return False
+        group, index = window.get_view_index(self.view)
+        active = window.active_view_in_group(group)
+        return active is not None and active.id() == self.view.id()
 
     def set_syntax(self, syntax):
         if self.is_open():
             self.get_view().set_syntax_file(syntax)
 
 
-    def timed_add(self):
-        try:
-            self.lock.acquire()
-            lines = self.lines
-            self.lines = ""
-            self.timer = None
-            self.queue.put((self.do_add_line, lines))
-            sublime.set_timeout(self.update, 0)
-        finally:
-            self.lock.release()
+    def enqueue(self, cmd, data):
+        """
+        Queue a change to the view, to be applied (after any pending text) on the next frame
+        """
+        with self.lock:
+            self.flush_lines()
+            self.queue.put((cmd, data))
+        jdb_view_scheduler.schedule(self)
 
+    def flush_lines(self):
+        with self.lock:
+            if len(self.lines) > 0:
+                self.queue.put((self.do_add_line, "".join(self.lines)))
+                self.lines = []
 
-    def add_line(self, line, now=True):
+    def add_line(self, line):
         if self.is_open():
-            try:
-                self.lock.acquire()
-                self.lines += line
-                if self.timer:
-                    self.timer.cancel()
-                if self.lines.count("\n") > 10 or now:
-                    self.timed_add()
-                else:
-                    self.timer = threading.Timer(0.1, self.timed_add)
-                    self.timer.start()
-            finally:
-                self.lock.release()
+            with self.lock:
+                self.lines.append(line)
+            jdb_view_scheduler.schedule(self)
 
     def scroll(self, line):
         if self.is_open():
-            self.queue.put((self.do_scroll, line))
-            sublime.set_timeout(self.update, 0)
+            self.enqueue(self.do_scroll, line)
 
     def set_viewport_position(self, pos):
         if self.is_open():
-            self.queue.put((self.do_set_viewport_position, pos))
-            sublime.set_timeout(self.update, 0)
+            self.enqueue(self.do_set_viewport_position, pos)
 
     def clear(self, now=False):
         if self.is_open():
             if not now:
-                self.queue.put((self.do_clear, None))
-                sublime.set_timeout(self.update, 0)
+                self.enqueue(self.do_clear, None)
             else:
+                with self.lock:
+                    self.lines = []
                 self.do_clear(None)
 
     def create_view(self):
-        self.view = sublime.active_window().new_file()
+        self.view = self.session.window.new_file()
         self.view.set_name(self.name)
         self.view.set_scratch(True)
         self.view.set_read_only(True)
@@ -143,8 +185,9 @@ class JDBView(object):
         self.closed = False
 
     def destroy_view(self):
-        sublime.active_window().focus_view(self.view)
-        sublime.active_window().run_command("close")
+        window = self.view.window() or self.session.window
+        window.focus_view(self.view)
+        window.run_command("close")
         self.view = None
         self.closed = True
 
@@ -156,7 +199,7 @@ class JDBView(object):
 
     def fold_all(self):
         if self.is_open():
-            self.queue.put((self.do_fold_all, None))
+            self.enqueue(self.do_fold_all, None)
 
     def get_view(self):
         return self.view
@@ -185,6 +228,7 @@ class JDBView(object):
     def update(self):
         if not self.is_open():
             return
+        self.flush_lines()
         try:
             while not self.queue.empty():
                 cmd, data = self.queue.get()
@@ -196,7 +240,7 @@ class JDBView(object):
             traceback.print_exc()
 
     def on_session_ended(self):
-        if get_setting("%s_clear_on_end" % self.settingsprefix, True):
+        if getattr(get_settings(self.session), "%s_clear_on_end" % self.settingsprefix):
             self.clear()
 
 
@@ -222,17 +266,83 @@ class JdbViewAddLine(sublime_plugin.TextCommand):
             self.view.show(self.view.size())
 
 
+array_regex = re.compile(r"^instance of .*\[(\d+)\](\[\])* \(id=\d+\)$")
+primitive_types = ("boolean", "byte", "char", "short", "int", "long", "float", "double")
+
+
+def clip_value(value, session=None):
+    """
+    Cut down huge values (long strings and such) before they reach the view, to the length the
+    given session is set up for
+    """
+    limit = get_settings(session).variables_max_value_length
+    if value is None or len(value) <= limit:
+        return value
+    return "%s... (%d chars)" % (value[:limit], len(value))
+
+
+class JdbViewReplaceLines(sublime_plugin.TextCommand):
+    """
+    Exposed command to replace ranges of lines in the view, given as [first, last, text] in
+    line numbers of the current content
+    """
+    def run(self, edit, edits):
+        self.view.set_read_only(False)
+        last_row = self.view.rowcol(self.view.size())[0]
+        for first, last, text in reversed(edits):
+            start = self.view.text_point(first, 0) if first <= last_row else self.view.size()
+            end = self.view.text_point(last, 0) if last <= last_row else self.view.size()
+            self.view.replace(edit, sublime.Region(start, end), text)
+        self.view.set_read_only(True)
+
+
 class JDBVariable:
     """
     Class representing a variable returned by JDB
     """
-    def __init__(self, vp):
+    def __init__(self, vp, expression=None, ref=None, parent=None, session=None):
         self.name = vp[0]
-        self.value = vp[1]
-        # self.parent = parent
+        self.value = clip_value(vp[1], session)
+        ## Expression JDB evaluates to get at this variable, and the "instance of ..."
+        ## description of the object it refers to, if known
+        self.expression = expression if expression is not None else self.name
+        self.ref = ref if ref is not None else self.value
+        self.parent = parent
+        ## Element count of a java.util.List, fetched when it is expanded
+        self.size = None
         self.children = []
+        self.children_loaded = False
         self.line = 0
         self.is_expanded = False
+        self.changed = False
+
+    def is_expandable(self):
+        if self.children_loaded:
+            return self.has_children()
+        return self.ref is not None and self.ref.startswith("instance of")
+
+    def array_length(self):
+        m = array_regex.match(self.ref or "")
+        if m is None:
+            return None
+        return int(m.group(1))
+
+    def type_name(self):
+        if self.ref is None or not self.ref.startswith("instance of "):
+            return None
+        return self.ref[len("instance of "):].split("(id=")[0].strip()
+
+    def is_list(self, session=None):
+        return self.type_name() in get_settings(session).variables_list_types
+
+    def element_count(self):
+        length = self.array_length()
+        return length if length is not None else self.size
+
+    def element_expression(self, index):
+        if self.array_length() is not None:
+            return "%s[%d]" % (self.expression, index)
+        return "%s.get(%d)" % (self.expression, index)
 
     def has_children(self):
         return len(self.children) > 0
@@ -240,45 +350,175 @@ class JDBVariable:
     def __str__(self):
         return "%s = %s" % (self.name, self.value)
 
-    def format(self, indent="", output="", line=0):
+    def format(self, parts, nodes, indent="", line=0):
+        """
+        Append the text for this node (and its visible children) to parts and the nodes
+        themselves to nodes, one per line.  Returns the next free line number
+        """
         icon = " "
-        if self.has_children():
+        if self.is_expandable():
             if self.is_expanded:
                 icon = "-"
             else:
                 icon = "+"
 
-        output += "%s%s%s\n" % (indent, icon, self)
+        parts.append("%s%s%s\n" % (indent, icon, self))
+        nodes.append(self)
         self.line = line
         line = line + 1
-        indent += "    "
         if self.is_expanded:
+            indent += "    "
             for child in self.children:
-                output, line = child.format(indent, output, line)
-        return (output, line)
+                line = child.format(parts, nodes, indent, line)
+        return line
+
+
+class JDBPageVariable(JDBVariable):
+    """
+    Placeholder before/after the page of elements currently shown for an array or list,
+    moves the window to the page starting at "start" when clicked
+    """
+    def __init__(self, owner, start, hidden, label):
+        super(JDBPageVariable, self).__init__(("...", None), parent=owner)
+        self.start = start
+        self.hidden = hidden
+        self.label = label
+
+    def is_expandable(self):
+        return False
+
+    def __str__(self):
+        return "... %d %s" % (self.hidden, self.label)
+
+
+class JDBWatch(object):
+    """
+    Expression evaluated on every stop and shown below the local variables
+    """
+    def __init__(self, expression, only_when_visible=False, timeout=None):
+        self.expression = expression
+        ## Skipped while the Variables view isn't the selected tab
+        self.only_when_visible = only_when_visible
+        ## Seconds to wait for the value before moving on without it, None for watch_timeout
+        self.timeout = timeout
+        self.project = None
+
+    def get_timeout(self, session=None):
+        return self.timeout if self.timeout is not None else get_setting("watch_timeout", 2, session)
+
+    def to_record(self):
+        record = {"expression": self.expression}
+        if self.only_when_visible:
+            record["only_when_visible"] = True
+        if self.timeout is not None:
+            record["timeout"] = self.timeout
+        return record
+
+    def format(self):
+        options = ""
+        if self.only_when_visible:
+            options += " (only when visible)"
+        if self.timeout is not None:
+            options += " (timeout %ss)" % self.timeout
+        return "%s%s" % (self.expression, options)
+
+
+## Watch expressions are shared by all sessions, like breakpoints
+jdb_watches = []
 
 
 class JDBVariablesView(JDBView):
     """
     Debugger view displaying local variables while at a breakpoint / stepping through
     """
-    def __init__(self):
-        super(JDBVariablesView, self).__init__("JDB Variables", False, settingsprefix="variables")
+    def __init__(self, session):
+        super(JDBVariablesView, self).__init__(session, "JDB Variables", False, settingsprefix="variables")
         self.variables = []
+        self.watch_variables = []
+        ## Set when watches were skipped for not being visible, to evaluate them once they are
+        self.watches_pending = False
+        ## Bumped whenever the VM resumes, watch values arriving for an older stop are dropped
+        self.watch_generation = 0
+        ## Lines currently in the view, and expression -> value for this and the previous stop
+        self.rendered_lines = []
+        self.line_starts = []
+        self.line_nodes = []
+        self.snapshot = {}
+        self.previous_snapshot = {}
+        self.frame = None
 
     def open(self):
+        if self.is_closed():
+            self.rendered_lines = []
         super(JDBVariablesView, self).open()
         self.set_syntax("Packages/Java/Java.tmLanguage")
-        if self.is_open() and jdb_run_status == "stopped":
-            self.update_variables(False)
+        if self.is_open() and self.session.run_status == "stopped":
+            self.update_variables()
 
     def update_view(self):
-        output = ""
+        parts = []
+        nodes = []
         line = 0
         for local in self.variables:
-            output, line = local.format(line=line)
-            self.add_line(output)
-        self.update()
+            line = local.format(parts, nodes, line=line)
+        if len(self.watch_variables) > 0:
+            parts.append("Watches:\n")
+            line += 1
+            for watch in self.watch_variables:
+                line = watch.format(parts, nodes, line=line)
+        ## Sorted line -> node index for lookups on click
+        self.line_starts = [node.line for node in nodes]
+        self.line_nodes = nodes
+        self.apply_diff("".join(parts).splitlines(True))
+        self.highlight_changed()
+
+    def redraw(self):
+        self.update_view()
+
+    def apply_diff(self, lines):
+        """
+        Rewrite only the lines that differ from what is currently shown
+        """
+        if not self.is_open():
+            return
+        edits = []
+        matcher = difflib.SequenceMatcher(None, self.rendered_lines, lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != "equal":
+                edits.append([i1, i2, "".join(lines[j1:j2])])
+        self.rendered_lines = lines
+        if len(edits) > 0:
+            self.enqueue(self.do_replace_lines, edits)
+
+    def highlight_changed(self):
+        if not self.is_open():
+            return
+        lines = [node.line for node in self.line_nodes if node.changed]
+        self.enqueue(self.do_highlight_changed, lines)
+
+    def track(self, var):
+        """
+        Remember the value for the next stop and flag it if it changed since the previous one
+        """
+        previous = self.previous_snapshot.get(var.expression)
+        var.changed = previous is not None and previous != var.value
+        self.snapshot[var.expression] = var.value
+        return var
+
+    def do_replace_lines(self, edits):
+        self.view.run_command("jdb_view_replace_lines", {"edits": edits})
+
+    def do_highlight_changed(self, lines):
+        regions = [self.view.full_line(self.view.text_point(line, 0)) for line in lines]
+        settings = get_settings(self.session)
+        self.view.add_regions("sublimejdb.changed_variables", regions,
+                              settings.changed_variable_scope,
+                              settings.changed_variable_icon,
+                              sublime.DRAW_NO_OUTLINE)
+
+    def clear(self, now=False):
+        self.rendered_lines = []
+        super(JDBVariablesView, self).clear(now)
 
     def add_variable(self, exp):
         v = self.create_variable(exp)
@@ -286,39 +526,172 @@ class JDBVariablesView(JDBView):
             self.variables.append(v)
 
     def create_variable(self, exp):
-        parts = exp.split(" = ")
-        return JDBVariable(parts)
+        parts = exp.strip().split(" = ", 1)
+        if len(parts) < 2:
+            return None
+        return JDBVariable(parts, session=self.session)
 
     def clear_view(self):
         self.variables = []
+        self.watch_variables = []
+        self.line_starts = []
+        self.line_nodes = []
         self.clear()
 
-    def update_variables(self):
+    def save_state(self):
+        """
+        What's needed to show the variables of a frame again without asking JDB
+        """
+        return (self.variables, self.watch_variables, self.snapshot, self.previous_snapshot, self.frame)
+
+    def restore_state(self, state):
+        self.variables, self.watch_variables, self.snapshot, self.previous_snapshot, self.frame = state
+        self.update_view()
+
+    def update_variables(self, frame=None):
         if not self.should_update():
             return
-        self.clear_view()
-        result = run_cmd("locals")
-        if not "No local variables" in result:
-            localLines = result.split("\n")
-            for ll in localLines:
-                if not "Method arguments:" in ll and not "Local variables:" in ll:
-                    parts = ll.split(" = ")
-                    var_vals = run_cmd("print %s" % parts[0])
-                    self.add_variable(var_vals)
-            self.update_view()
+        self.variables = []
+        ## Values are only comparable to those of the previous stop in the same method
+        if frame is not None:
+            self.previous_snapshot = self.snapshot if frame == self.frame else {}
+            self.frame = frame
+        else:
+            self.previous_snapshot = self.snapshot
+        self.snapshot = {}
+        for value in self.session.backend.locals(get_setting("variables_fast_refresh", True, self.session)):
+            self.variables.append(self.track(JDBVariable((value.name, value.value), ref=value.ref, session=self.session)))
+        self.evaluate_watches(self.watches_to_evaluate())
+        self.update_view()
 
-    def get_variable_at_line(self, line, var_list=None):
-        if var_list is None:
-            var_list = self.variables
-        if len(var_list) == 0:
-            return None
+    def watches_to_evaluate(self):
+        visible = self.is_visible()
+        watches = [watch for watch in jdb_watches if visible or not watch.only_when_visible]
+        self.watches_pending = len(watches) < len(jdb_watches)
+        return watches
+
+    def evaluate_watches(self, watches):
+        """
+        Rebuild the watch nodes and print the given watches in the background, without waiting
+        on them:  each node is filled in as its value arrives (or its timeout passes)
+        """
+        evaluated = set(watch.expression for watch in watches)
+        nodes = []
+        for watch in list(jdb_watches):
+            state = "<evaluating>" if watch.expression in evaluated else "<not evaluated>"
+            nodes.append(JDBVariable((watch.expression, state), session=self.session))
+            if watch.expression in evaluated:
+                self.print_watch(watch, nodes, len(nodes) - 1)
+        self.watch_variables = nodes
+
+    def print_watch(self, watch, nodes, index):
+        generation = self.watch_generation
+
+        def on_value(result):
+            with self.lock:
+                ## Stale once the VM moved on, or already timed out
+                if generation != self.watch_generation or nodes[index].value != "<evaluating>":
+                    return
+                if result is None:
+                    v = JDBVariable((watch.expression, "<timed out>"), session=self.session)
+                else:
+                    v = JDBVariable((watch.expression, result.text()), session=self.session)
+                current = nodes is self.watch_variables
+                nodes[index] = self.track(v) if current and result is not None else v
+            if current:
+                self.update_view()
+
+        def on_timeout():
+            if not request.done.is_set():
+                ## Still queued, its response gets dropped when it finally arrives
+                request.abandoned = True
+                on_value(None)
+
+        try:
+            request = self.session.backend.evaluate_async(watch.expression, on_value)
+        except ValueError as e:
+            log_debug(str(e))
+            return
+        sublime.set_timeout(on_timeout, int(watch.get_timeout(self.session) * 1000))
+
+    def cancel_watches(self):
+        """
+        Drop the values of watches still being evaluated, the VM is resuming
+        """
+        with self.lock:
+            self.watch_generation += 1
+
+    def refresh_watches(self):
+        """
+        Evaluate the watches alone, after they changed or the view became visible
+        """
+        if not self.should_update():
+            return
+        self.evaluate_watches(self.watches_to_evaluate())
+        self.update_view()
+
+    def toggle_variable(self, var):
+        """
+        Expand or collapse a node, fetching its children the first time it is expanded
+        """
+        if not self.should_update():
+            return
+        if isinstance(var, JDBPageVariable):
+            self.load_page(var.parent, var.start)
+        elif var.is_expanded:
+            var.is_expanded = False
+        elif var.is_expandable():
+            if not var.children_loaded:
+                self.load_children(var)
+            var.is_expanded = True
+        else:
+            return
+        self.redraw()
 
-        for i in range(len(var_list)):
-            if var_list[i].line == line:
-                return var_list[i]
-            elif var_list[i].line > line:
-                return self.get_variable_at_line(line, var_list[i - 1].children)
-        return self.get_variable_at_line(line, var_list[len(var_list) - 1].children)
+    def load_children(self, var):
+        if var.is_list(self.session) and var.size is None:
+            result = self.session.backend.evaluate(["%s.size()" % var.expression])[0]
+            try:
+                var.size = int(result.value)
+            except (AttributeError, TypeError, ValueError):
+                pass
+        if var.element_count() is not None:
+            self.load_page(var, 0)
+        else:
+            for field in self.session.backend.fields(var.expression):
+                ## jdb labels a shadowed field "Declaring.field", which isn't an expression on its own
+                expression = "%s.%s" % (var.expression, field.name.rsplit(".", 1)[-1])
+                var.children.append(self.track(JDBVariable((field.name, field.value), expression, field.ref, var, session=self.session)))
+        var.children_loaded = True
+
+    def load_page(self, var, start):
+        """
+        Replace the elements shown for an array or list with the page beginning at "start",
+        fetched as one batch, so only a single page is ever held/rendered per node
+        """
+        count = var.element_count()
+        page_size = get_setting("variables_page_size", 100, self.session)
+        end = min(count, start + page_size)
+        element_type = var.type_name().split("[")[0] if var.array_length() is not None else None
+        expressions = [var.element_expression(i) for i in range(start, end)]
+        var.children = []
+        if start > 0:
+            var.children.append(JDBPageVariable(var, max(0, start - page_size), start, "earlier"))
+        for i, expression, result in zip(range(start, end), expressions, self.session.backend.evaluate(expressions)):
+            value = result.text() if result is not None else "<unavailable>"
+            child = JDBVariable(("[%d]" % i, value), expression, parent=var, session=self.session)
+            ## Elements of object arrays and lists get printed through toString(), so keep them expandable
+            if element_type not in primitive_types and not value.startswith("instance of") and value != "null":
+                child.ref = "instance of %s" % (element_type or "java.lang.Object")
+            var.children.append(self.track(child))
+        if end < count:
+            var.children.append(JDBPageVariable(var, end, count - end, "more"))
+
+    def get_variable_at_line(self, line):
+        i = bisect.bisect_right(self.line_starts, line) - 1
+        if i < 0 or self.line_starts[i] != line:
+            return None
+        return self.line_nodes[i]
 
 
 class JDBBreakpoint(object):
@@ -328,517 +701,2167 @@ class JDBBreakpoint(object):
     def __init__(self, filename="", line=0):
         self.original_filename = normalize(filename)
         self.original_line = line
+        ## Looked up on every marker refresh, so keep the normalized form around
+        self.filename = self.original_filename
+        self.line = line
+        ## Only stop when the condition evaluates to true and it did so at least hit_count times
+        self.condition = None
+        self.hit_count = 0
+        self.hits = {}
+        ## Logpoints print this message, "{expression}" replaced by its value, instead of stopping
+        self.log_message = None
+        ## Key of the project whose breakpoint file this is saved to
+        self.project = None
         # self.clear()
-        self.add()
-
-    @property
-    def line(self):
-        return self.original_line
-
-    @property
-    def filename(self):
-        return normalize(self.original_filename)
-
-    def add(self):
-        if is_running():
-            break_cmd = "stop at"
-            class_name = determine_class_from_file(self.original_filename)
-            cmd = "%s %s:%d" % (break_cmd, class_name, self.original_line)
-            out = run_cmd(cmd)
-            if "is not a valid class name" in out or "Deferring breakpoint" in out:
-                sublime.error_message("%s: %s" % ("Cannot locate class", class_name))
-                return
 
-    def remove(self):
-        if is_running():
-            break_cmd = "clear"
-            class_name = determine_class_from_file(self.original_filename)
-            cmd = "%s %s:%d" % (break_cmd, class_name, self.original_line)
-            out = run_cmd(cmd)
-            if "Not found:" in out:
-                sublime.error_message("%s: %s:%d" % ("Cannot locate breakpoint", class_name, self.original_line))
+    def key(self):
+        return (self.filename, self.line)
+
+    def merge(self, other):
+        """
+        Take in a breakpoint whose line was merged into this one's, stopping (or logging)
+        whenever either of them would
+        """
+        if self.condition is None or other.condition is None:
+            self.condition = None
+        elif self.condition != other.condition:
+            self.condition = "(%s) || (%s)" % (self.condition, other.condition)
+        self.hit_count = min(self.hit_count, other.hit_count)
+        if self.log_message is None or other.log_message is None:
+            self.log_message = None
+        elif self.log_message != other.log_message:
+            self.log_message = "%s | %s" % (self.log_message, other.log_message)
+        self.hits = {}
+
+    def location(self):
+        return {"file": self.filename, "line": self.line}
+
+    def to_record(self):
+        """
+        What gets saved to the breakpoint file, leaving out the defaults
+        """
+        record = self.location()
+        if self.condition is not None:
+            record["condition"] = self.condition
+        if self.hit_count > 1:
+            record["hit_count"] = self.hit_count
+        if self.log_message is not None:
+            record["log"] = self.log_message
+        return record
+
+    def spec(self):
+        """
+        The location as given to JDB, and echoed back by it when the breakpoint gets set
+        """
+        class_name = determine_class_from_file(self.original_filename, self.original_line)
+        return "%s:%d" % (class_name, self.original_line)
+
+    def add_cmd(self):
+        return "stop at %s" % self.spec()
+
+    def remove_cmd(self):
+        return "clear %s" % self.spec()
+
+    def add(self, session):
+        if session.is_running():
+            self.on_added(session, session.backend.set_breakpoints([self])[0])
+
+    def on_added(self, session, result):
+        if result.status == "failed":
+            spec = self.spec()
+            sublime.set_timeout(lambda: sublime.error_message("%s: %s" % ("Cannot set breakpoint", spec)), 0)
+        elif result.status == "deferred":
+            ## The class isn't loaded yet, JDB reports back once it has set the breakpoint
+            session.deferred[self.spec()] = self
+            session.console_view.add_line("## %s is deferred until its class is loaded ##\n" % self.spec())
+
+    def remove(self, session):
+        if session.is_running():
+            session.deferred.pop(self.spec(), None)
+            if not session.backend.clear_breakpoint(self):
+                sublime.error_message("%s: %s" % ("Cannot locate breakpoint", self.spec()))
                 return
 
-    def format(self):
-        return "%s:%d\n" % (self.filename, self.line)
-
+    def is_deferred(self, session):
+        return session is not None and session.deferred.get(self.spec()) is self
 
-class JDBBreakpointView(JDBView):
-    """
-    Debugger view displaying all current breakpoints set in JDB
-    """
-    def __init__(self):
-        super(JDBBreakpointView, self).__init__("JDB Breakpoints", s=False, settingsprefix="breakpoints")
-        self.breakpoints = []
+    def is_filtered(self):
+        return self.condition is not None or self.hit_count > 1 or self.log_message is not None
 
-    def open(self):
-        super(JDBBreakpointView, self).open()
-        ## self.set_syntax("Packages/SublimeJDB/jdb_disasm.tmLanguage")
-        self.get_view().settings().set("word_wrap", False)
-        if self.is_open():
-            self.update_view()
+    def check_condition(self, session, result):
+        """
+        Whether the condition holds, given its evaluation
+        """
+        if result is None:
+            return True
+        value = result.text()
+        if value == "false":
+            return False
+        if value != "true":
+            ## Stop on a broken condition rather than silently never stopping
+            session.console_view.add_line("## Cannot evaluate condition \"%s\": %s ##\n" % (self.condition, value))
+        return True
+
+    def count_hit(self, session):
+        hits = self.hits.get(session.id, 0) + 1
+        self.hits[session.id] = hits
+        return hits >= self.hit_count
+
+    def should_stop(self, session):
+        """
+        Check the condition and hit count for a hit in the given session, with at most one "print"
+        """
+        if self.condition is not None:
+            result = session.backend.evaluate([self.condition])[0]
+            if not self.check_condition(session, result):
+                return False
+        return self.count_hit(session)
+
+    def log_expressions(self):
+        return log_expression_regex.findall(self.log_message)
+
+    def log(self, session):
+        """
+        Evaluate the condition and the message of a logpoint in one round trip, returning the
+        message to log or None if the condition/hit count says to skip this hit
+        """
+        expressions = self.log_expressions()
+        results = session.backend.evaluate(([self.condition] if self.condition is not None else []) + expressions)
+        if self.condition is not None and not self.check_condition(session, results.pop(0)):
+            return None
+        if not self.count_hit(session):
+            return None
+        values = {}
+        for expression, result in zip(expressions, results):
+            values[expression] = clip_value(result.text(), session) if result is not None else "<unavailable>"
+        return log_expression_regex.sub(lambda m: values[m.group(1)], self.log_message)
 
-    def on_session_ended(self):
-        ## Intentionally not calling super
-        # for bkpt in self.breakpoints:
-        #     bkpt.clear()
-        pass
+    def format(self, session=None):
+        return "%s:%d%s\n" % (self.filename, self.line, self.format_options(session))
 
-    def update_marker(self, view):
-        bps = []
-        fn = view.file_name()
-        if fn is None:
-            return
-        fn = normalize(fn)
-        for bkpt in self.breakpoints:
-            if bkpt.filename == fn and not (bkpt.line == jdb_cursor_position and fn == jdb_cursor):
-                bps.append(view.full_line(view.text_point(bkpt.line - 1, 0)))
+    def format_options(self, session=None):
+        options = ""
+        if self.condition is not None:
+            options += " if %s" % self.condition
+        if self.hit_count > 1:
+            options += " (hit count %d)" % self.hit_count
+        if self.log_message is not None:
+            options += " log \"%s\"" % self.log_message
+        if self.is_deferred(session):
+            options += " (deferred)"
+        return options
 
-        view.add_regions("sublimejdb.breakpoints", bps,
-                            get_setting("breakpoint_scope", "keyword.jdb"),
-                            get_setting("breakpoint_icon", "circle"),
-                            sublime.HIDDEN)
 
-    def find_breakpoint(self, filename, line):
-        filename = normalize(filename)
-        for bkpt in self.breakpoints:
-            if bkpt.filename == filename and bkpt.line == line:
-                return bkpt
-        return None
+class JDBMethodBreakpoint(JDBBreakpoint):
+    """
+    Breakpoint on entering a method, "Class.method"
+    """
+    def __init__(self, method):
+        super(JDBMethodBreakpoint, self).__init__(None, 0)
+        self.method = method
 
+    def key(self):
+        return "stop in %s" % self.method
 
-    def toggle_breakpoint(self, filename, line):
-        bkpt = self.find_breakpoint(filename, line)
-        if bkpt:
-            bkpt.remove()
-            self.breakpoints.remove(bkpt)
-        else:
-            self.breakpoints.append(JDBBreakpoint(filename, line))
-        self.update_view()
+    def location(self):
+        return {"kind": "method", "method": self.method}
 
-    def sync_breakpoints(self):
-        global breakpoints
-        for bkpt in self.breakpoints:
-            bkpt.add()
-        update_view_markers()
-        self.update_view()
+    def spec(self):
+        return self.method
 
-    def update_view(self):
-        if not self.is_open():
-            return
-        pos = self.get_view().viewport_position()
-        self.clear()
-        self.breakpoints.sort(key=lambda b: (b.filename, b.line))
-        for bkpt in self.breakpoints:
-            self.add_line(bkpt.format())
-        self.set_viewport_position(pos)
-        self.update()
+    def add_cmd(self):
+        return "stop in %s" % self.method
 
+    def format(self, session=None):
+        return "stop in %s%s\n" % (self.method, self.format_options(session))
 
-jdb_console_view = JDBView("JDB Console", settingsprefix="console")
-jdb_variables_view = JDBVariablesView()
-jdb_breakpoint_view = JDBBreakpointView()
-jdb_views = [jdb_console_view, jdb_variables_view, jdb_breakpoint_view]
 
-def update_view_markers(view=None):
+class JDBExceptionBreakpoint(JDBBreakpoint):
     """
-    Refresh the cursor position, breakpoint marker icons, etc
+    Breakpoint on an exception being thrown.  mode is one of "caught", "uncaught" or "all"
     """
-    if view is None:
-        view = sublime.active_window().active_view()
+    def __init__(self, class_name, mode="all"):
+        super(JDBExceptionBreakpoint, self).__init__(None, 0)
+        self.class_name = class_name
+        self.mode = mode
 
-    fn = view.file_name()
-    if fn is not None:
-        fn = normalize(fn)
-    pos_scope = get_setting("position_scope", "entity.name.class")
-    pos_icon = get_setting("position_icon", "bookmark")
+    def key(self):
+        return self.add_cmd()
+
+    def location(self):
+        return {"kind": "exception", "class": self.class_name, "mode": self.mode}
 
-    cursor = []
-    if fn == jdb_cursor and jdb_cursor_position != 0:
-        cursor.append(view.full_line(view.text_point(jdb_cursor_position - 1, 0)))
-    global jdb_last_cursor_view
-    if jdb_last_cursor_view is not None:
-        jdb_last_cursor_view.erase_regions("sublimejdb.position")
-    jdb_last_cursor_view = view
-    view.add_regions("sublimejdb.position", cursor, pos_scope, pos_icon, sublime.HIDDEN)
+    def spec(self):
+        return self.class_name
 
-    jdb_breakpoint_view.update_marker(view)
+    def add_cmd(self):
+        return "catch %s %s" % (self.mode, self.class_name)
 
+    def remove_cmd(self):
+        return "ignore %s %s" % (self.mode, self.class_name)
 
-count = 0
+    def format(self, session=None):
+        return "%s%s\n" % (self.add_cmd(), self.format_options(session))
 
 
-def run_cmd(cmd, block=True):
+class JDBWatchpoint(JDBBreakpoint):
     """
-    Send a command to JDB.  By default, will wait and return the response.  block=false to not wait for a response
+    Breakpoint on a field, "Class.field".  mode is "modification", "access" or "all"
     """
-    global count
-    global jdb_lastresult
-    if not is_running():
-        raise ValueError("Cannot run '%s'! JDB is not running" % cmd)
+    def __init__(self, field, mode="all"):
+        super(JDBWatchpoint, self).__init__(None, 0)
+        self.field = field
+        self.mode = mode
 
-    timeout = 10
-    timeoutcount = timeout/0.001
+    def key(self):
+        return self.add_cmd()
 
-    log_debug("jdb_%s: %s" % ("stdin", cmd))
-    cmd = "%s\n" % cmd
-    if jdb_console_view is not None:
-        jdb_console_view.add_line("-> %s" % cmd, False)
-    jdb_process.stdin.write(cmd.encode(sys.getdefaultencoding()))
-    if block:
-        count = count + 1
-        countstr = "%d^" % count
-        i = 0
-        while not jdb_lastresult.startswith(countstr) and i < timeoutcount:
-            i += 1
-            time.sleep(0.001)
-        if i >= timeoutcount:
-            raise ValueError("Command \"%s\" took longer than %d seconds to perform?" % (cmd, timeout))
-        return jdb_lastresult[len(countstr):]
+    def location(self):
+        return {"kind": "watch", "field": self.field, "mode": self.mode}
 
+    def spec(self):
+        return self.field
 
-def wait_until_loaded():
-    """
-    Sleep the main thread until JDB is ready to go
-    """
-    i = 0
-    log_debug("waiting until JDB is loaded...")
-    while not jdb_loaded and i < 50:
-        i = i + 1
-        time.sleep(0.1)
-        if i >= 50:
-            return False
-    log_debug("JDB is now loaded!")
-    return True
+    def watch_args(self):
+        ## Plain "watch" is for modification only
+        if self.mode == "modification":
+            return self.field
+        return "%s %s" % (self.mode, self.field)
 
+    def add_cmd(self):
+        return "watch %s" % self.watch_args()
 
-def update_cursor():
-    """
-    Update cursor/marker/views upon hitting a breakpoint or stepping
-    """
-    global jdb_cursor
-    global jdb_cursor_position
+    def remove_cmd(self):
+        return "unwatch %s" % self.watch_args()
 
-    if jdb_run_status != "running":
-        res = run_cmd("where")
+    def format(self, session=None):
+        return "%s%s\n" % (self.add_cmd(), self.format_options(session))
 
-        first_line = res.split("\n")[0]
-        c_start = first_line.find("] ") + 2
-        del_idx = first_line.find(" (")
-        c_end = first_line.rfind(".", 0, del_idx)
-        l_start = first_line.find(":") + 1
-        l_end = first_line.find(")")
-        class_name = first_line[c_start:c_end]
-        file_path = determine_file_from_class(class_name)
 
-        if os.path.exists(file_path):
-            jdb_cursor = file_path
-            jdb_cursor_position = int(first_line[l_start:l_end])
-            sublime.active_window().focus_group(get_setting("file_group", 0))
-            sublime.active_window().open_file("%s:%d" % (jdb_cursor, jdb_cursor_position), sublime.ENCODED_POSITION)
-            update_view_markers()
-            jdb_variables_view.update_variables()
-        else:
-            sublime.error_message("Unable to find class: %s" % class_name)
-            #TODO - need to figure out how to handle this situation better
-            sublime.active_window().run_command("jdb_continue")
+log_expression_regex = re.compile(r"\{([^{}]+)\}")
 
 
-def jdboutput(pipe):
+class JDBBreakpointStore(object):
     """
-    Handle output from JDB process
+    Breakpoints indexed by normalized file name, then line
     """
-    global count
-    global jdb_process
-    global jdb_loaded
-    global jdb_lastresult
-    global jdb_run_status
-    jdb_loaded = False
-    prev_lines = ""
-    current_line = ""
-    thread_out_regex = re.compile("^Thread-\d+\[\d+\]$")
-
-    while True:
-        try:
-            nextbyte = pipe.read(1)
-            if not nextbyte:
-                break
-            nextchar = nextbyte.decode(sys.getdefaultencoding())
-            countstr = "%d^" % count
-            if nextchar == ">" and len(current_line) == 0:
-                if jdb_loaded:
-                    log_debug("jdb_%s: %s" % ("stdout" if pipe == jdb_process.stdout else "stderr", prev_lines))
-                    jdb_console_view.add_line("<-%s\n" % prev_lines, False)
-                    jdb_lastresult = "%s%s" % (countstr, prev_lines)
-                    current_line = ""
-                    prev_lines = ""
-                    continue
-                else:
-                    current_line = ""
-                    prev_lines = ""
-                    jdb_loaded = True
-                    continue
-            if nextchar == "\n":
-                if len(prev_lines) > 0:
-                    prev_lines = "%s\n" % (prev_lines)
-                prev_lines = "%s%s" % (prev_lines, current_line)
-                current_line = ""
-            else:
-                current_line = current_line + nextchar
-
-            if thread_out_regex.match(current_line) is not None:
-                unsol_result = "%s%s" % (prev_lines, current_line)
-                log_debug("jdb_%s: %s" % ("stdout" if pipe == jdb_process.stdout else "stderr", unsol_result))
-                jdb_console_view.add_line("<-%s\n" % unsol_result, False)
-                if jdb_run_status == "running":
-                    jdb_run_status = "stopped"
-                    sublime.set_timeout(update_cursor, 0)
-                else:
-                    jdb_lastresult = "%s%s" % (countstr, prev_lines)
-                current_line = ""
-                prev_lines = ""
+    def __init__(self):
+        self.files = {}
+        ## Method, exception and field breakpoints, by key()
+        self.others = {}
 
+    def find(self, filename, line):
+        return self.files.get(filename, {}).get(line)
 
-        except:
-            traceback.print_exc()
-    if pipe == jdb_process.stdout:
-        log_debug("JDB session ended")
-        jdb_console_view.add_line("## JDB session ended ##\n")
-        sublime.status_message("JDB session ended")
-    global jdb_cursor_position
-    jdb_cursor_position = 0
-    jdb_run_status = None
-    sublime.set_timeout(update_view_markers, 0)
+    def find_key(self, key):
+        return self.others.get(key)
 
-    for view in jdb_views:
-        sublime.set_timeout(view.on_session_ended, 0)
-    sublime.set_timeout(cleanup, 0)
+    def in_file(self, filename):
+        return self.files.get(filename, {}).values()
 
+    def add(self, bkpt):
+        if bkpt.filename is None:
+            self.others[bkpt.key()] = bkpt
+            return
+        self.files.setdefault(bkpt.filename, {})[bkpt.line] = bkpt
 
-def cleanup():
-    """
-    Cleanup workspace after disconnecting from JDB
-    """
-    if get_setting("close_views", True):
-        for view in jdb_views:
-            view.close()
-    if get_setting("push_pop_layout", True):
-        jdb_bkp_window.set_layout(jdb_bkp_layout)
-        jdb_bkp_window.focus_view(jdb_bkp_view)
+    def remove(self, bkpt):
+        if bkpt.filename is None:
+            self.others.pop(bkpt.key(), None)
+            return
+        lines = self.files.get(bkpt.filename, {})
+        lines.pop(bkpt.line, None)
+        if len(lines) == 0:
+            self.files.pop(bkpt.filename, None)
 
+    def sorted(self):
+        return ([self.files[fn][line] for fn in sorted(self.files) for line in sorted(self.files[fn])] +
+                [self.others[key] for key in sorted(self.others)])
 
-def is_running():
-    """
-    Check JDB process state
-    """
-    return jdb_process is not None and jdb_process.poll() is None
+    def __iter__(self):
+        for lines in list(self.files.values()):
+            for bkpt in list(lines.values()):
+                yield bkpt
+        for bkpt in list(self.others.values()):
+            yield bkpt
 
+    def __len__(self):
+        return sum(len(lines) for lines in self.files.values()) + len(self.others)
 
-def go_to_run_state():
-    """
-    Toggle current JDB state to "running" and clear variables
-    """
-    global jdb_run_status
-    jdb_variables_view.clear_view()
-    jdb_run_status = "running"
+    def contains(self, bkpt):
+        if bkpt.filename is None:
+            return self.others.get(bkpt.key()) is bkpt
+        return self.find(bkpt.filename, bkpt.line) is bkpt
 
 
-class JdbLaunch(sublime_plugin.WindowCommand):
+def breakpoint_from_record(record):
     """
-    Launch the JDB process and add any breakpoints that may have been set prior
+    Recreate a breakpoint saved with to_record()
     """
-    def run(self):
-        global jdb_process
-        global jdb_run_status
-        global jdb_bkp_window
-        global jdb_bkp_view
-        global jdb_bkp_layout
-        global jdb_shutting_down
-        global DEBUG
-        view = self.window.active_view()
-        DEBUG = get_setting("debug", False, view)
+    kind = record.get("kind", "line")
+    if kind == "method":
+        bkpt = JDBMethodBreakpoint(record["method"])
+    elif kind == "exception":
+        bkpt = JDBExceptionBreakpoint(record["class"], record.get("mode", "all"))
+    elif kind == "watch":
+        bkpt = JDBWatchpoint(record["field"], record.get("mode", "all"))
+    else:
+        bkpt = JDBBreakpoint(record["file"], int(record["line"]))
+    bkpt.condition = record.get("condition")
+    bkpt.hit_count = int(record.get("hit_count", 0))
+    bkpt.log_message = record.get("log")
+    return bkpt
 
-        if jdb_process is None or jdb_process.poll() is not None:
-            commandline = get_setting("commandline", view=view)
-            path = get_setting("workingdir", "/tmp", view)
-            log_debug("Running: %s" % commandline)
-            log_debug("In directory: %s" % path)
-            if commandline == "notset" or path == "notset":
-                sublime.error_message("You have not configured the plugin correctly, the default configuration file and your user configuration file will open in a new window")
-                sublime.run_command("new_window")
-                wnd = sublime.active_window()
-                wnd.set_layout({
-                    "cols": [0.0, 0.5, 1.0],
-                    "rows": [0, 1.0],
-                    "cells": [[0,0,1,1], [1,0,2,1]],
-                })
-                v = wnd.open_file("%s/User/SublimeJDB.sublime-settings" % sublime.packages_path())
-                v2 = wnd.open_file("%s/SublimeJDB/SublimeJDB.sublime-settings" % sublime.packages_path())
-                wnd.set_view_index(v2, 1, 0)
-                return
-            if not os.path.exists(path):
-                sublime.error_message("The directory given does not exist: %s" % path)
-                return
-            jdb_process = subprocess.Popen(commandline, shell=True, cwd=path,
-                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-            log_debug("Process: %s" % jdb_process)
-            jdb_bkp_window = sublime.active_window()
-            ##back up current layout before opening the debug one
-            ##it will be restored when debug is finished
-            jdb_bkp_layout = jdb_bkp_window.get_layout()
-            jdb_bkp_view = jdb_bkp_window.active_view()
-            jdb_bkp_window.set_layout(
-                get_setting("layout",
-                    {
-                        "cols": [0.0, 0.5, 1.0],
-                        "rows": [0.0, 0.75, 1.0],
-                        "cells": [[0, 0, 2, 1], [0, 1, 1, 2], [1, 1, 2, 2]]
-                    }
-                )
-            )
+## Breakpoints are shared by all sessions, each one sets them in its own JVM
+jdb_breakpoints = JDBBreakpointStore()
 
-            for view in jdb_views:
-                if view.is_closed() and view.open_at_start():
-                    view.open()
-                view.clear()
 
-            jdb_shutting_down = False
+class JDBBreakpointView(JDBView):
+    """
+    Debugger view displaying all current breakpoints set in JDB
+    """
+    def __init__(self, session):
+        super(JDBBreakpointView, self).__init__(session, "JDB Breakpoints", s=False, settingsprefix="breakpoints")
+        self.breakpoints = jdb_breakpoints
 
-            t = threading.Thread(target=jdboutput, args=(jdb_process.stdout,))
-            t.start()
-            t = threading.Thread(target=jdboutput, args=(jdb_process.stderr,))
-            t.start()
+    def open(self):
+        super(JDBBreakpointView, self).open()
+        ## self.set_syntax("Packages/SublimeJDB/jdb_disasm.tmLanguage")
+        self.get_view().settings().set("word_wrap", False)
+        if self.is_open():
+            self.update_view()
 
-            jdb_console_view.add_line("## Attaching JDB... ##\n")
-            sublime.status_message("Attaching JDB...")
-            has_loaded = wait_until_loaded()
-            if not has_loaded:
-                sublime.error_message("JDB did not start.  Check that the Java process is running and listening and that your settings are correct")
-                run_cmd("quit", False)
-                return
-            go_to_run_state()
-            jdb_console_view.add_line("## JDB Attached ##\n")
-            sublime.status_message("JDB Attached")
-            jdb_breakpoint_view.sync_breakpoints()
-        else:
-            sublime.status_message("JDB is already running!")
+    def on_session_ended(self):
+        ## Intentionally not calling super
+        # for bkpt in self.breakpoints:
+        #     bkpt.clear()
+        pass
 
-    def is_enabled(self):
-        return not is_running()
+    def find_breakpoint(self, filename, line):
+        return self.breakpoints.find(normalize(filename), line)
 
-    def is_visible(self):
-        return not is_running()
+    def sync_breakpoints(self):
+        if self.session.is_running():
+            bkpts = list(self.breakpoints)
+            for bkpt in bkpts:
+                bkpt.hits.pop(self.session.id, None)
+            results = self.session.backend.set_breakpoints(bkpts)
+            for bkpt, result in zip(bkpts, results):
+                bkpt.on_added(self.session, result)
+        sublime.set_timeout(update_view_markers, 0)
+        sublime.set_timeout(self.update_view, 0)
 
+    def update_view(self):
+        if not self.is_open():
+            return
+        pos = self.get_view().viewport_position()
+        self.clear()
+        for bkpt in self.breakpoints.sorted():
+            self.add_line(bkpt.format(self.session))
+        self.set_viewport_position(pos)
 
-class JdbContinue(sublime_plugin.WindowCommand):
+
+def add_breakpoint(bkpt):
     """
-    Resume running the Java application if currently paused
+    Add a breakpoint, in every running session
     """
-    def run(self):
-        global jdb_cursor_position
-        jdb_cursor_position = 0
-        update_view_markers()
-        go_to_run_state()
-        run_cmd("cont", False)
-
-    def is_enabled(self):
-        return is_running() and jdb_run_status != "running"
-
-    def is_visible(self):
-        return is_running()
+    window = sublime.active_window()
+    ## Read the project's saved breakpoints first, so saving this one doesn't drop them
+    jdb_breakpoint_file.load(window)
+    if bkpt.project is None:
+        bkpt.project = jdb_breakpoint_file.project_key(window)
+    jdb_breakpoints.add(bkpt)
+    jdb_breakpoint_file.schedule_save()
+    for session in jdb_session_manager.running():
+        bkpt.add(session)
+    for session in jdb_session_manager:
+        session.breakpoint_view.update_view()
 
 
-class JdbExit(sublime_plugin.WindowCommand):
+def remove_breakpoint(bkpt):
     """
-    End the JDB session, if active
+    Remove a breakpoint, from every running session
     """
-    def run(self):
-        global jdb_shutting_down
-        jdb_shutting_down = True
-        # wait_until_stopped()
-        run_cmd("quit", False)
-
-    def is_enabled(self):
-        return is_running()
-
-    def is_visible(self):
-        return is_running()
+    for session in jdb_session_manager.running():
+        bkpt.remove(session)
+    jdb_breakpoints.remove(bkpt)
+    jdb_breakpoint_file.schedule_save()
+    for session in jdb_session_manager:
+        session.breakpoint_view.update_view()
 
 
-class JdbStepOver(sublime_plugin.WindowCommand):
+def toggle_breakpoint(filename, line):
     """
-    Step over, if currently paused
+    Add or remove the breakpoint at filename:line, in every running session
     """
-    def run(self):
-        go_to_run_state()
-        run_cmd("next", False)
-
-    def is_enabled(self):
-        return is_running() and jdb_run_status != "running"
-
-    def is_visible(self):
-        return is_running()
+    bkpt = jdb_breakpoints.find(normalize(filename), line)
+    if bkpt:
+        remove_breakpoint(bkpt)
+    else:
+        add_breakpoint(JDBBreakpoint(filename, line))
 
 
-class JdbStepInto(sublime_plugin.WindowCommand):
+def set_breakpoint_options(filename, line, **options):
     """
-    Step into, if currently paused
+    Change the condition/hit count of the breakpoint at filename:line, adding it first if needed.
+    Both are checked by the plugin on each hit, so JDB doesn't need to hear about it
     """
-    def run(self):
-        go_to_run_state()
-        run_cmd("step", False)
+    bkpt = jdb_breakpoints.find(normalize(filename), line)
+    if bkpt is None:
+        toggle_breakpoint(filename, line)
+        bkpt = jdb_breakpoints.find(normalize(filename), line)
+    for name, value in options.items():
+        setattr(bkpt, name, value)
+    bkpt.hits = {}
+    jdb_breakpoint_file.schedule_save()
+    for session in jdb_session_manager:
+        session.breakpoint_view.update_view()
 
-    def is_enabled(self):
-        return is_running() and jdb_run_status != "running"
 
-    def is_visible(self):
-        return is_running()
+## view id -> breakpoints of the file, in the order of its "sublimejdb.breakpoint_lines" regions
+jdb_breakpoint_lines = {}
 
 
-class JdbStepOut(sublime_plugin.WindowCommand):
+def tracked_breakpoint_lines(view):
     """
-    Step out, if currently paused
+    (breakpoint, line) of each breakpoint tracked in the view, the line being where its
+    "sublimejdb.breakpoint_lines" region is now
     """
-    def run(self):
-        go_to_run_state()
-        run_cmd("step up", False)
-
-    def is_enabled(self):
-        return is_running() and jdb_run_status != "running"
-
-    def is_visible(self):
-        return is_running()
+    tracked = jdb_breakpoint_lines.get(view.id())
+    regions = view.get_regions("sublimejdb.breakpoint_lines")
+    if not tracked or len(regions) != len(tracked):
+        return []
+    return [(bkpt, view.rowcol(region.begin())[0] + 1) for bkpt, region in zip(tracked, regions)]
 
 
-class JdbIgnored(sublime_plugin.WindowCommand):
+def sync_breakpoint_lines(view):
     """
-    Empty command, to be sure the keyboard shortcuts don't perform some other action
+    Move the breakpoints of a just saved file to wherever their lines ended up after editing.
+    Breakpoints whose lines were merged into one are merged too
     """
-    def run(self):
-        pass
+    moved = [(bkpt, line) for bkpt, line in tracked_breakpoint_lines(view)
+             if line != bkpt.line and jdb_breakpoints.contains(bkpt)]
+    if len(moved) == 0:
+        return
+    sessions = jdb_session_manager.running()
+    ## Take them all out first, one may move to a line another is leaving
+    for bkpt, line in moved:
+        for session in sessions:
+            bkpt.remove(session)
+        jdb_breakpoints.remove(bkpt)
+    for bkpt, line in moved:
+        existing = jdb_breakpoints.find(bkpt.filename, line)
+        if existing is not None:
+            existing.merge(bkpt)
+            continue
+        bkpt.line = bkpt.original_line = line
+        jdb_breakpoints.add(bkpt)
+        for session in sessions:
+            bkpt.add(session)
+    jdb_breakpoint_file.schedule_save()
+    for session in jdb_session_manager:
+        session.breakpoint_view.update_view()
+    update_view_markers(view)
 
 
-class JdbToggleBreakpoint(sublime_plugin.TextCommand):
+class JDBBreakpointFile(object):
     """
-    Set a breakpoint at the current cursor
+    Saves the breakpoints of each project to a file of its own in Sublime's cache directory.  The
+    file is read the first time a window of the project is used, and rewritten (atomically) once
+    the breakpoints have been left alone for breakpoints_save_delay ms
+    """
+    def __init__(self):
+        self.loaded = set()
+        self.generation = 0
+
+    def project_key(self, window):
+        if window is None:
+            return None
+        project = window.project_file_name()
+        if project:
+            return normalize(project)
+        folders = window.folders()
+        return normalize(folders[0]) if len(folders) > 0 else None
+
+    def path(self, key):
+        digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+        return os.path.join(sublime.cache_path(), "SublimeJDB", "breakpoints-%s.json" % digest)
+
+    def load(self, window):
+        key = self.project_key(window)
+        if key is None or key in self.loaded or not get_setting("persist_breakpoints", True):
+            return
+        self.loaded.add(key)
+        try:
+            with open(self.path(key), encoding="utf-8") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        for record in data.get("watches", []):
+            if "expression" in record and not any(watch.expression == record["expression"] for watch in jdb_watches):
+                watch = JDBWatch(record["expression"], record.get("only_when_visible", False), record.get("timeout"))
+                watch.project = key
+                jdb_watches.append(watch)
+        for record in data.get("breakpoints", []):
+            try:
+                bkpt = breakpoint_from_record(record)
+            except (KeyError, TypeError, ValueError):
+                log_debug("Skipping saved breakpoint: %s" % record)
+                continue
+            if bkpt.filename is not None and jdb_breakpoints.find(bkpt.filename, bkpt.line) is not None:
+                continue
+            if bkpt.filename is None and jdb_breakpoints.find_key(bkpt.key()) is not None:
+                continue
+            bkpt.project = key
+            jdb_breakpoints.add(bkpt)
+
+    def schedule_save(self):
+        ## Only the last change within the delay ends up writing
+        self.generation += 1
+        generation = self.generation
+        sublime.set_timeout(lambda: self.save(generation), get_setting("breakpoints_save_delay", 1000))
+
+    def save(self, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        if not get_setting("persist_breakpoints", True):
+            return
+        projects = dict((key, {"project": key, "breakpoints": [], "watches": []}) for key in self.loaded)
+        for bkpt in jdb_breakpoints.sorted():
+            if bkpt.project in projects:
+                projects[bkpt.project]["breakpoints"].append(bkpt.to_record())
+        for watch in jdb_watches:
+            if watch.project in projects:
+                projects[watch.project]["watches"].append(watch.to_record())
+        for key, data in projects.items():
+            self.write(self.path(key), data)
+
+    def write(self, path, data):
+        """
+        Write to a temporary file next to the real one, then swap it in
+        """
+        directory = os.path.dirname(path)
+        tmp = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(prefix=".breakpoints-", dir=directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            traceback.print_exc()
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+jdb_breakpoint_file = JDBBreakpointFile()
+
+
+class JdbViewEraseLines(sublime_plugin.TextCommand):
+    """
+    Exposed command to erase lines from the start of the view
+    """
+    def run(self, edit, count):
+        self.view.set_read_only(False)
+        self.view.erase(edit, sublime.Region(0, self.view.text_point(count, 0)))
+        self.view.set_read_only(True)
+
+
+class JDBConsoleView(JDBView):
+    """
+    Debugger view showing the raw JDB conversation.  Only the last console_max_lines lines
+    are kept in the view, older ones are dropped in batches (and optionally kept in a log file)
+    """
+    def __init__(self, session):
+        super(JDBConsoleView, self).__init__(session, "JDB Console", settingsprefix="console")
+        self.line_count = 0
+        self.log = None
+
+    def start_log(self):
+        self.stop_log()
+        filename = get_setting("console_log_file", "", self.session)
+        if not filename:
+            return
+        ## Sessions running side by side each need a file of their own
+        filename = os.path.expanduser(filename.replace("{session}", str(self.session.id)))
+        try:
+            handler = logging.handlers.RotatingFileHandler(filename,
+                        maxBytes=get_setting("console_log_max_bytes", 10 * 1024 * 1024, self.session),
+                        backupCount=get_setting("console_log_backups", 3, self.session),
+                        encoding="utf-8")
+        except (IOError, OSError):
+            traceback.print_exc()
+            return
+        handler.terminator = ""
+        self.log = logging.getLogger("SublimeJDB.console.%d" % self.session.id)
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log.addHandler(handler)
+
+    def stop_log(self):
+        if self.log is not None:
+            for handler in list(self.log.handlers):
+                self.log.removeHandler(handler)
+                handler.close()
+            self.log = None
+
+    def add_line(self, line):
+        if self.log is not None:
+            self.log.info(line)
+        if not self.is_open():
+            return
+        super(JDBConsoleView, self).add_line(line)
+        with self.lock:
+            self.line_count += line.count("\n")
+            max_lines = get_settings(self.session).console_max_lines
+            if max_lines > 0 and self.line_count > max_lines:
+                ## Trim a whole batch at once so this doesn't happen on every line
+                count = self.line_count - max_lines + get_settings(self.session).console_trim_lines
+                count = min(count, self.line_count)
+                self.line_count -= count
+                self.enqueue(self.do_erase_lines, count)
+
+    def do_erase_lines(self, count):
+        self.view.run_command("jdb_view_erase_lines", {"count": count})
+
+    def clear(self, now=False):
+        self.line_count = 0
+        super(JDBConsoleView, self).clear(now)
+
+    def on_session_ended(self):
+        super(JDBConsoleView, self).on_session_ended()
+        self.stop_log()
+
+
+class JDBStackView(JDBView):
+    """
+    Debugger view showing the call stack of the current thread, the selected frame marked with ">"
+    """
+    def __init__(self, session):
+        super(JDBStackView, self).__init__(session, "JDB Stack", s=False, settingsprefix="stack")
+
+    def open(self):
+        super(JDBStackView, self).open()
+        self.get_view().settings().set("word_wrap", False)
+        if self.is_open():
+            self.update_view()
+
+    def update_view(self):
+        if not self.is_open():
+            return
+        self.clear()
+        selected = self.session.current_frame
+        self.add_line("".join("%s %s\n" % (">" if i == selected else " ", frame_label(frame))
+                              for i, frame in enumerate(self.session.frames)))
+
+    def get_frame_at_line(self, line):
+        return line if line < len(self.session.frames) else None
+
+
+class JDBThreadsView(JDBView):
+    """
+    Debugger view listing the threads of the VM by thread group
+    """
+    def __init__(self, session):
+        super(JDBThreadsView, self).__init__(session, "JDB Threads", s=False, settingsprefix="threads")
+        self.line_threads = []
+
+    def open(self):
+        super(JDBThreadsView, self).open()
+        self.get_view().settings().set("word_wrap", False)
+        if self.is_open():
+            self.update_view()
+
+    def update_view(self):
+        if not self.is_open():
+            return
+        self.clear()
+        lines = []
+        self.line_threads = []
+        group = None
+        for thread in self.session.threads:
+            if thread.group != group:
+                group = thread.group
+                lines.append("%s:\n" % group)
+                self.line_threads.append(None)
+            lines.append("  %s %s\n" % (thread.id, thread.description))
+            self.line_threads.append(thread)
+        self.add_line("".join(lines))
+
+    def get_thread_at_line(self, line):
+        return self.line_threads[line] if line < len(self.line_threads) else None
+
+
+def update_view_markers(view=None):
+    """
+    Refresh the cursor position, breakpoint marker icons, etc
+    """
+    if view is None:
+        view = sublime.active_window().active_view()
+        if view is None:
+            return
+    ## Only look the session up, windows that never used the plugin don't get one
+    session = find_session(view.window(), None, False)
+
+    fn = view.file_name()
+    if fn is not None:
+        fn = normalize(fn)
+    if session is not None:
+        settings = get_settings(session)
+        cursor = []
+        if fn == session.cursor and session.cursor_position != 0:
+            cursor.append(view.full_line(view.text_point(session.cursor_position - 1, 0)))
+        if session.last_cursor_view is not None:
+            session.last_cursor_view.erase_regions("sublimejdb.position")
+        session.last_cursor_view = view
+        view.add_regions("sublimejdb.position", cursor, settings.position_scope, settings.position_icon, sublime.HIDDEN)
+    elif fn is not None and fn.endswith(".java") and view.window() is not None:
+        ## The project's saved breakpoints, loaded once per project
+        jdb_breakpoint_file.load(view.window())
+
+    update_breakpoint_markers(view, session)
+
+
+def update_breakpoint_markers(view, session=None):
+    """
+    Draw the breakpoint icons of a file, except on the line the given session is stopped at
+    """
+    fn = view.file_name()
+    if fn is None:
+        return
+    fn = normalize(fn)
+    ## Breakpoints already tracked stay wherever edits have moved them since the last save
+    lines = dict(tracked_breakpoint_lines(view))
+    bkpts = jdb_breakpoints.in_file(fn)
+    if len(lines) != len(bkpts) or any(bkpt not in lines for bkpt in bkpts):
+        for bkpt in bkpts:
+            lines.setdefault(bkpt, bkpt.line)
+        tracked = sorted(bkpts, key=lambda bkpt: lines[bkpt])
+        ## Sublime moves these along with edits, so the breakpoints can follow their line on save
+        view.add_regions("sublimejdb.breakpoint_lines",
+                         [view.line(view.text_point(lines[bkpt] - 1, 0)) for bkpt in tracked],
+                         "", "", sublime.HIDDEN)
+        jdb_breakpoint_lines[view.id()] = tracked
+    bps = []
+    for bkpt in bkpts:
+        line = lines[bkpt]
+        if session is None or not (line == session.cursor_position and fn == session.cursor):
+            bps.append(view.full_line(view.text_point(line - 1, 0)))
+
+    settings = get_settings(session)
+    view.add_regions("sublimejdb.breakpoints", bps,
+                        settings.breakpoint_scope,
+                        settings.breakpoint_icon,
+                        sublime.HIDDEN)
+
+
+class JDBRequest(object):
+    """
+    A command sent to JDB.  Completed by the output reader once the prompt following its response arrives
+    """
+    def __init__(self, request_id, cmd, timeout, callback=None):
+        self.id = request_id
+        self.cmd = cmd
+        self.timeout = timeout
+        ## Called from the output reader with the response (None if the session ended) instead of waiting
+        self.callback = callback
+        self.result = None
+        self.failed = False
+        self.abandoned = False
+        ## Sent while the VM was stopped, so JDB ends the response with a thread marker, even
+        ## when a step or cont sent after it has set the session running meanwhile
+        self.stopped = False
+        self.done = threading.Event()
+
+    def complete(self, result):
+        self.result = result
+        self.done.set()
+        if self.callback is not None:
+            self.callback(result)
+
+    def fail(self, reason="JDB session ended"):
+        self.failed = True
+        self.reason = reason
+        self.done.set()
+        if self.callback is not None:
+            self.callback(None)
+
+    def wait(self):
+        if not self.done.wait(self.timeout):
+            ## Still queued, so its response will be consumed (and dropped) when it finally arrives
+            self.abandoned = True
+            raise ValueError("Command \"%s\" took longer than %s seconds to perform?" % (self.cmd, self.timeout))
+        if self.failed:
+            raise ValueError("Command \"%s\" failed, %s" % (self.cmd, self.reason))
+        return self.result
+
+
+## Commands whose prompt is never seen by JDBOutputParser: the VM resumes and JDB echoes "> " onto the
+## line left over from the previous prompt, the next thing parsed being the unsolicited stop
+NO_PROMPT_COMMANDS = ("cont", "next", "step", "step up", "stepi", "quit")
+
+
+breakpoint_hit_regex = re.compile(r"Breakpoint hit: \"thread=[^\"]*\", (?P<method>[^\s(]+)\(\), line=(?P<line>[\d,]+)")
+frame_regex = re.compile(r"\[\d+\] (?P<method>\S+) \((?P<location>[^)]*)\)")
+thread_regex = re.compile(r"^\s*\((?P<type_name>[^)]+)\)(?P<id>\S+)\s+(?P<description>.*?)\s*$")
+
+JDBFrame = collections.namedtuple("JDBFrame", ["class_name", "method", "source_name", "line"])
+JDBThread = collections.namedtuple("JDBThread", ["group", "type_name", "id", "description"])
+## A variable or field:  the value shown, and the "instance of ..." description of the object if it is one
+JDBValue = collections.namedtuple("JDBValue", ["name", "value", "ref"])
+## status is "set", "deferred" (until its class is loaded) or "failed"
+JDBBreakpointResult = collections.namedtuple("JDBBreakpointResult", ["status", "message"])
+
+
+class JDBEvaluation(collections.namedtuple("JDBEvaluation", ["expression", "value", "error"])):
+    """
+    The value of an expression as "print" shows it, or the error evaluating it
+    """
+    def text(self):
+        return self.value if self.error is None else self.error
+
+
+def parse_frame(line):
+    """
+    Split a frame from "where" into (class_name, method, source_name, line).  source_name and
+    line are None for frames without line info ("native method", "unknown source"...)
+    """
+    m = frame_regex.search(line)
+    if m is None:
+        return None
+    class_name, method = m.group("method").rsplit(".", 1)
+    source_name, sep, line_number = m.group("location").partition(":")
+    if not sep or not line_number.replace(",", "").isdigit():
+        return JDBFrame(class_name, method, None, None)
+    return JDBFrame(class_name, method, source_name, int(line_number.replace(",", "")))
+
+
+def parse_frames(result):
+    """
+    All frames of the output of "where", innermost first
+    """
+    frames = []
+    for line in result.split("\n"):
+        frame = parse_frame(line)
+        if frame is not None:
+            frames.append(frame)
+    return frames
+
+
+def parse_threads(result):
+    """
+    The threads listed by "threads", as JDBThread records
+    """
+    threads = []
+    group = None
+    for line in result.split("\n"):
+        if line.strip().startswith("Group "):
+            group = line.strip()[len("Group "):].rstrip(":")
+            continue
+        m = thread_regex.match(line)
+        if m is not None:
+            threads.append(JDBThread(group, m.group("type_name"), m.group("id"), m.group("description")))
+    return threads
+
+
+def parse_locals(result):
+    """
+    Split the output of "locals" into (name, value) pairs
+    """
+    local_vars = []
+    for ll in result.split("\n"):
+        ll = ll.strip()
+        if len(ll) == 0 or "Method arguments:" in ll or "Local variables:" in ll:
+            continue
+        parts = ll.split(" = ", 1)
+        local_vars.append((parts[0], parts[1] if len(parts) > 1 else None))
+    return local_vars
+
+
+def needs_print(value):
+    ## "locals" already shows primitives and strings, objects only come back
+    ## with their toString() through "print".  Arrays are left alone, they're paged in on expansion
+    if value is not None and array_regex.match(value):
+        return False
+    return value is None or value.startswith("instance of")
+
+
+def parse_dump(result):
+    """
+    Split the output of "dump" into (field, value) pairs
+    """
+    fields = []
+    for ll in result.split("\n"):
+        name, sep, value = ll.strip().partition(": ")
+        if sep:
+            fields.append((name, value))
+    return fields
+
+
+def parse_evaluation(expression, result):
+    """
+    The response to "print", None if there was none
+    """
+    if result is None:
+        return None
+    if " = " not in result:
+        return JDBEvaluation(expression, None, result.strip())
+    return JDBEvaluation(expression, result.strip().split(" = ", 1)[1], None)
+
+
+def parse_breakpoint_result(result):
+    """
+    The response to "stop", "catch" or "watch"
+    """
+    if result is None or "is not a valid" in result or "Unable to set" in result:
+        return JDBBreakpointResult("failed", result)
+    if "Deferring" in result:
+        return JDBBreakpointResult("deferred", result)
+    return JDBBreakpointResult("set", result)
+
+
+def frame_label(frame):
+    if frame.line is None:
+        return "%s.%s (no line info)" % (frame.class_name, frame.method)
+    return "%s.%s (%s:%d)" % (frame.class_name, frame.method, frame.source_name, frame.line)
+
+
+class JDBTextBackend(object):
+    """
+    Frames, threads, variables and breakpoint results of a jdb process, parsed from the text
+    it answers commands with
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def stack(self):
+        """
+        (frames, threads) of the current stop, in one round trip
+        """
+        where, threads = self.session.run_cmds(["where", "threads"])
+        return parse_frames(where or ""), parse_threads(threads or "")
+
+    def frames(self):
+        return parse_frames(self.session.run_cmd("where") or "")
+
+    def threads(self):
+        return parse_threads(self.session.run_cmd("threads") or "")
+
+    def locals(self, fast=True):
+        """
+        JDBValues of the current frame.  Unless fast, every value goes through "print", not just objects
+        """
+        result = self.session.run_cmd("locals")
+        local_vars = [] if "No local variables" in result else parse_locals(result)
+        missing = [name for name, value in local_vars if not fast or needs_print(value)]
+        printed = dict(zip(missing, self.session.run_cmds(["print %s" % name for name in missing])))
+        values = []
+        for name, value in local_vars:
+            parts = printed[name].strip().split(" = ", 1) if printed.get(name) is not None else []
+            if len(parts) == 2:
+                values.append(JDBValue(parts[0], parts[1], value))
+            elif value is not None:
+                values.append(JDBValue(name, value, value))
+        return values
+
+    def fields(self, expression):
+        return [JDBValue(name, value, value) for name, value in parse_dump(self.session.run_cmd("dump %s" % expression))]
+
+    def evaluate(self, expressions, timeouts=None):
+        """
+        JDBEvaluations of the expressions, pipelined.  None for those that timed out
+        """
+        results = self.session.run_cmds(["print %s" % e for e in expressions], timeouts=timeouts)
+        return [parse_evaluation(e, result) for e, result in zip(expressions, results)]
+
+    def evaluate_async(self, expression, callback):
+        """
+        Evaluate without waiting, callback gets the JDBEvaluation (None if the session ended).
+        Returns the JDBRequest
+        """
+        return self.session.send_cmds(["print %s" % expression],
+                                      callback=lambda result: callback(parse_evaluation(expression, result)))[0]
+
+    def set_breakpoints(self, bkpts):
+        return [parse_breakpoint_result(result) for result in self.session.run_cmds([bkpt.add_cmd() for bkpt in bkpts])]
+
+    def clear_breakpoint(self, bkpt):
+        """
+        Whether there was such a breakpoint to clear
+        """
+        return "Not found:" not in self.session.run_cmd(bkpt.remove_cmd())
+
+
+class JDWPBackend(object):
+    """
+    Frames, threads, variables and breakpoint results as the JDWP process has them, queued in turn
+    with the commands sent to it
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def submit(self, name, args=(), timeout=None, callback=None):
+        """
+        Queue one of the structured requests of the JDWP process, returning a JDBRequest for it
+        """
+        session = self.session
+        if not session.is_running():
+            raise ValueError("Cannot run '%s'! JDB is not running" % name)
+        if timeout is None:
+            timeout = get_settings(session).command_timeout
+        with session.pending_lock:
+            session.request_id += 1
+            request = JDBRequest(session.request_id, name, timeout, callback)
+
+        def on_done(result, error):
+            if error is None:
+                request.complete(result)
+            else:
+                log_debug("JDWP %s failed: %s" % (name, error))
+                request.fail(str(error))
+        session.process.call(name, args, on_done)
+        return request
+
+    def results(self, requests):
+        ## Like run_cmds, a request that timed out or failed gets None
+        results = []
+        for request in requests:
+            try:
+                results.append(request.wait())
+            except ValueError as e:
+                log_debug(str(e))
+                results.append(None)
+        return results
+
+    def stack(self):
+        frames, threads = self.results([self.submit("stack_frames"), self.submit("thread_list")])
+        return [JDBFrame(*frame) for frame in frames or []], [JDBThread(*thread) for thread in threads or []]
+
+    def frames(self):
+        return [JDBFrame(*frame) for frame in self.submit("stack_frames").wait()]
+
+    def threads(self):
+        return [JDBThread(*thread) for thread in self.submit("thread_list").wait()]
+
+    def locals(self, fast=True):
+        ## Objects always come with their toString(), there's no round trip to save
+        return [JDBValue(*value) for value in self.submit("local_values").wait()]
+
+    def fields(self, expression):
+        return [JDBValue(*value) for value in self.submit("field_values", (expression,)).wait()]
+
+    def evaluate(self, expressions, timeouts=None):
+        if timeouts is None:
+            timeouts = [None] * len(expressions)
+        requests = [self.submit("evaluation", (e,), timeout) for e, timeout in zip(expressions, timeouts)]
+        return [JDBEvaluation(e, *result) if result is not None else None
+                for e, result in zip(expressions, self.results(requests))]
+
+    def evaluate_async(self, expression, callback):
+        return self.submit("evaluation", (expression,),
+                           callback=lambda result: callback(JDBEvaluation(expression, *result) if result is not None else None))
+
+    def set_breakpoints(self, bkpts):
+        results = self.results([self.submit("set_breakpoint", (bkpt.add_cmd(),)) for bkpt in bkpts])
+        return [JDBBreakpointResult(*result) if result is not None else JDBBreakpointResult("failed", None)
+                for result in results]
+
+    def clear_breakpoint(self, bkpt):
+        return self.submit("clear_breakpoint", (bkpt.remove_cmd(),)).wait()
+
+
+class JDBOutputParser(object):
+    """
+    Incremental parser for the JDB output stream.  Text is fed in chunks as it arrives and
+    prompts / thread markers are only looked for at line and chunk boundaries
+    """
+    thread_marker_regex = re.compile(r"^Thread-\d+\[\d+\]$")
+
+    def __init__(self, on_prompt, on_thread_marker):
+        self.on_prompt = on_prompt
+        self.on_thread_marker = on_thread_marker
+        self.decoder = codecs.getincrementaldecoder(sys.getdefaultencoding())(errors="replace")
+        self.prev_lines = []
+        self.current_line = []
+        self.bracket_seen = False
+
+    def feed(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        pos = 0
+        size = len(text)
+        while pos < size:
+            if text[pos] == ">" and not self.current_line:
+                self.on_prompt("\n".join(self.prev_lines))
+                self.reset()
+                pos += 1
+                continue
+
+            nl = text.find("\n", pos)
+            end = size if nl == -1 else nl
+
+            ## The marker has to make up the whole line so far, and since it can't contain a "]"
+            ## before its last character, only the first "]" of a line needs to be checked
+            if not self.bracket_seen:
+                bracket = text.find("]", pos, end)
+                if bracket != -1:
+                    self.bracket_seen = True
+                    candidate = "".join(self.current_line) + text[pos:bracket + 1]
+                    if self.thread_marker_regex.match(candidate) is not None:
+                        self.on_thread_marker("\n".join(self.prev_lines), candidate)
+                        self.reset()
+                        pos = bracket + 1
+                        continue
+
+            if end > pos:
+                self.current_line.append(text[pos:end])
+            if nl == -1:
+                break
+            self.end_line()
+            pos = nl + 1
+
+    def end_line(self):
+        ## Leading blank lines are dropped, just like before any output has been collected
+        line = "".join(self.current_line)
+        if line or self.prev_lines:
+            self.prev_lines.append(line)
+        self.current_line = []
+        self.bracket_seen = False
+
+    def reset(self):
+        self.prev_lines = []
+        self.current_line = []
+        self.bracket_seen = False
+
+class JDBSession(object):
+    """
+    A JDB process along with its output readers, the commands waiting on a response, its run
+    state and its views.  Every window gets a session of its own, so several JVMs can be
+    debugged side by side
+    """
+    def __init__(self, window):
+        self.id = window.id()
+        self.window = window
+        self.settings = JDBSettings(window)
+        self.process = None
+        ## Frames, threads, variables and breakpoint results, from jdb's text or straight over JDWP
+        self.backend = None
+        self.run_status = None
+        self.cursor = ""
+        self.cursor_position = 0
+        self.last_cursor_view = None
+        self.bkp_layout = {}
+        self.bkp_view = None
+        self.shutting_down = False
+        ## Set once JDB shows its first prompt
+        self.loaded = threading.Event()
+        self.attach = None
+        ## Breakpoints JDB is waiting on a class to be loaded for, by spec()
+        self.deferred = {}
+        self.request_id = 0
+        self.pending_requests = collections.deque()
+        self.pending_lock = threading.Lock()
+        ## Held over queueing and writing commands, so they're written in the order they're queued
+        self.write_lock = threading.Lock()
+        self.console_view = JDBConsoleView(self)
+        self.variables_view = JDBVariablesView(self)
+        self.breakpoint_view = JDBBreakpointView(self)
+        self.stack_view = JDBStackView(self)
+        self.threads_view = JDBThreadsView(self)
+        self.views = [self.console_view, self.variables_view, self.breakpoint_view, self.stack_view, self.threads_view]
+        ## Stack and threads of the current stop, along with the variables of the frames shown so far
+        self.frames = []
+        self.threads = []
+        self.current_frame = 0
+        self.frame_cache = {}
+        self.hover = JDBHover(self)
+        ## Whether the VM was last resumed by a step, and which stop the delayed refresh is for
+        self.stepped = False
+        self.step_generation = 0
+        self.logpoint_output = JDBLogpointOutput(self)
+
+    def is_running(self):
+        """
+        Check JDB process state
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def launch(self, commandline, path):
+        """
+        Start JDB in this session's window and attach to it in the background
+        """
+        if get_setting("backend", "jdb", self) == "jdwp":
+            ## Talk JDWP to the VM straight from here, there's no jdb process to start
+            self.process = jdwp.JDWPProcess(get_setting("jdwp_host", "localhost", self), get_setting("jdwp_port", 8000, self),
+                                            self, get_setting("command_timeout", 10, self))
+            self.backend = JDWPBackend(self)
+        else:
+            self.process = subprocess.Popen(commandline, shell=True, cwd=path,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.backend = JDBTextBackend(self)
+
+        log_debug("Process: %s" % self.process)
+        ##back up current layout before opening the debug one
+        ##it will be restored when debug is finished
+        self.bkp_layout = self.window.get_layout()
+        self.bkp_view = self.window.active_view()
+        self.window.set_layout(
+            get_setting("layout",
+                {
+                    "cols": [0.0, 0.5, 1.0],
+                    "rows": [0.0, 0.75, 1.0],
+                    "cells": [[0, 0, 2, 1], [0, 1, 1, 2], [1, 1, 2, 2]]
+                },
+                self
+            )
+        )
+
+        for view in self.views:
+            if view.is_closed() and view.open_at_start():
+                view.open()
+            view.clear()
+
+        self.shutting_down = False
+        self.deferred = {}
+        index_sources(self.window, refresh=True)
+        self.console_view.start_log()
+        self.logpoint_output.start()
+        self.loaded.clear()
+
+        if isinstance(self.process, jdwp.JDWPProcess):
+            self.process.start()
+        else:
+            t = threading.Thread(target=self.read_output, args=(self.process.stdout,))
+            t.start()
+            t = threading.Thread(target=self.read_output, args=(self.process.stderr,))
+            t.start()
+
+        self.attach = JDBAttach(self)
+        self.attach.start()
+
+    def send_cmds(self, cmds, timeout=None, callback=None):
+        """
+        Write one or more commands to JDB in a single flush, returning a JDBRequest for each.
+        callback, if given, gets each response as it arrives
+        """
+        if not self.is_running():
+            raise ValueError("Cannot run '%s'! JDB is not running" % "; ".join(cmds))
+        if timeout is None:
+            timeout = get_settings(self).command_timeout
+
+        requests = []
+        with self.write_lock:
+            with self.pending_lock:
+                for cmd in cmds:
+                    log_debug("jdb_%s: %s" % ("stdin", cmd))
+                    self.request_id += 1
+                    request = JDBRequest(self.request_id, cmd, timeout, callback)
+                    request.stopped = self.run_status == "stopped"
+                    if cmd not in NO_PROMPT_COMMANDS:
+                        self.pending_requests.append(request)
+                    requests.append(request)
+            ## Not under pending_lock:  a big batch can fill the pipes both ways, and JDB only
+            ## takes more input once the reader, which needs that lock, has drained its output
+            data = "".join("%s\n" % cmd for cmd in cmds)
+            self.process.stdin.write(data.encode(sys.getdefaultencoding()))
+            self.process.stdin.flush()
+        self.console_view.add_line("".join("-> %s\n" % cmd for cmd in cmds))
+        return requests
+
+    def run_cmd(self, cmd, block=True, timeout=None):
+        """
+        Send a command to JDB.  By default, will wait and return the response.  block=false to not wait for a response
+        """
+        request = self.send_cmds([cmd], timeout)[0]
+        if block:
+            return request.wait()
+
+    def run_cmds(self, cmds, timeout=None, timeouts=None):
+        """
+        Pipeline several commands to JDB and wait for all of them.  Responses are returned in the order
+        of the commands, a command that timed out or failed gets None.  timeouts optionally gives
+        each command a timeout of its own (None for the default)
+        """
+        if len(cmds) == 0:
+            return []
+        results = []
+        requests = self.send_cmds(cmds, timeout)
+        if timeouts is not None:
+            for request, request_timeout in zip(requests, timeouts):
+                if request_timeout is not None:
+                    request.timeout = request_timeout
+        for request in requests:
+            try:
+                results.append(request.wait())
+            except ValueError as e:
+                log_debug(str(e))
+                results.append(None)
+        return results
+
+    def complete_request(self, result):
+        """
+        Hand a response to the oldest command still waiting for one
+        """
+        with self.pending_lock:
+            request = self.pending_requests.popleft() if self.pending_requests else None
+        if request is None:
+            log_debug("Dropping unexpected JDB response: %s" % result)
+        else:
+            request.complete(result)
+
+    def fail_pending_requests(self):
+        """
+        Release everyone waiting on a response once the JDB session is gone
+        """
+        with self.pending_lock:
+            pending = list(self.pending_requests)
+            self.pending_requests.clear()
+        for request in pending:
+            request.fail()
+
+    def update_cursor(self):
+        """
+        Update cursor/marker/views upon hitting a breakpoint or stepping
+        """
+        if self.run_status != "running":
+            delay = get_setting("step_refresh_delay", 300, self)
+            if self.stepped and delay > 0:
+                ## Possibly one of many steps in a row: follow the cursor right away, but leave
+                ## the rest until stepping has been idle for a while
+                self.frames = self.backend.frames()
+                self.current_frame = 0
+                self.frame_cache = {}
+                self.hover.reset()
+                self.move_cursor(0)
+                self.step_generation += 1
+                generation = self.step_generation
+                sublime.set_timeout(lambda: self.refresh_after_step(generation), delay)
+                return
+            self.frames, self.threads = self.backend.stack()
+            self.current_frame = 0
+            self.frame_cache = {}
+            self.hover.reset()
+            self.stack_view.update_view()
+            self.threads_view.update_view()
+            self.show_frame(0)
+
+    def refresh_after_step(self, generation):
+        """
+        Bring the views up to date once no step has followed the one that made this stop
+        """
+        if generation != self.step_generation or self.run_status != "stopped" or not self.is_running():
+            return
+        self.threads = self.backend.threads()
+        self.stack_view.update_view()
+        self.threads_view.update_view()
+        self.show_variables(self.current_frame)
+
+    def step(self, cmd):
+        """
+        Resume with one of the step commands, keeping the variables around for the next stop
+        """
+        self.go_to_run_state(True)
+        self.stepped = True
+        self.run_cmd(cmd, False)
+
+    def show_frame(self, index):
+        """
+        Move the cursor to a frame of the stack and show its variables
+        """
+        self.move_cursor(index)
+        self.show_variables(index)
+
+    def move_cursor(self, index):
+        frame = self.frames[index] if index < len(self.frames) else None
+        file_path = None
+        if frame is not None and frame.line is not None:
+            file_path = determine_file_from_class(frame.class_name, frame.source_name, self.window)
+
+        if file_path is not None:
+            self.cursor = normalize(file_path)
+            self.cursor_position = frame.line
+            self.window.focus_group(get_setting("file_group", 0, self))
+            self.window.open_file("%s:%d" % (file_path, self.cursor_position), sublime.ENCODED_POSITION)
+        else:
+            ## No source for this frame (library code, native method...), stay stopped without a cursor
+            self.cursor_position = 0
+            sublime.status_message("No source for %s" % (frame.class_name if frame is not None else "current frame"))
+        update_view_markers(self.window.active_view())
+
+    def show_variables(self, index):
+        """
+        Show the variables of a frame, from the cache if it was already shown during this stop
+        """
+        frame = self.frames[index] if index < len(self.frames) else None
+        if frame is not None and self.variables_view.should_update():
+            state = self.frame_cache.get(index)
+            if state is not None:
+                self.variables_view.restore_state(state)
+            else:
+                self.variables_view.update_variables("%s.%s" % (frame.class_name, frame.method))
+                self.frame_cache[index] = self.variables_view.save_state()
+
+    def select_frame(self, index):
+        """
+        Make another frame of the stack the current one
+        """
+        if index == self.current_frame or not 0 <= index < len(self.frames):
+            return
+        delta = index - self.current_frame
+        ## "up" goes towards the callers.  Nothing to wait for, anything needing the frame queues up behind it
+        self.send_cmds(["up %d" % delta if delta > 0 else "down %d" % -delta])
+        self.current_frame = index
+        self.stack_view.update_view()
+        self.show_frame(index)
+
+    def select_thread(self, thread):
+        """
+        Make another thread the current one, refreshing the stack and variables for it
+        """
+        self.run_cmd("thread %s" % thread.id)
+        self.update_cursor()
+
+    def find_hit_breakpoint(self, output):
+        """
+        The filtered (conditional/hit count) breakpoint JDB reports as hit in a stop, if any
+        """
+        if not any(bkpt.is_filtered() for bkpt in jdb_breakpoints):
+            return None
+        m = breakpoint_hit_regex.search(output)
+        if m is None:
+            return None
+        class_name = m.group("method").rsplit(".", 1)[0]
+        file_path = determine_file_from_class(class_name, None, self.window)
+        if file_path is None:
+            return None
+        return jdb_breakpoints.find(normalize(file_path), int(m.group("line").replace(",", "")))
+
+    def on_stop(self, output):
+        """
+        Called by the output reader on every stop.  A breakpoint whose condition or hit count isn't
+        met resumes right away, without refreshing the cursor, views or variables
+        """
+        bkpt = self.find_hit_breakpoint(output)
+        if bkpt is None or not bkpt.is_filtered():
+            sublime.set_timeout(self.update_cursor, 0)
+        elif bkpt.condition is None and bkpt.log_message is None:
+            self.check_breakpoint(bkpt)
+        else:
+            ## The responses have to be read by the reader thread this is called from
+            threading.Thread(target=self.check_breakpoint, args=(bkpt,)).start()
+
+    def check_breakpoint(self, bkpt):
+        try:
+            if bkpt.log_message is not None:
+                message = bkpt.log(self)
+                if message is not None:
+                    self.logpoint_output.add("[%s:%d] %s\n" % (os.path.basename(bkpt.filename), bkpt.line, message))
+            elif bkpt.should_stop(self):
+                sublime.set_timeout(self.update_cursor, 0)
+                return
+            self.go_to_run_state(True)
+            self.run_cmd("cont", False)
+        except ValueError as e:
+            log_debug(str(e))
+
+    def check_deferred(self, output):
+        """
+        Pick up JDB reporting on deferred breakpoints once their class gets loaded
+        """
+        for line in output.split("\n"):
+            line = line.strip()
+            failed = line.startswith("Unable to set deferred ")
+            if not failed and not line.startswith("Set deferred "):
+                continue
+            words = line.split(" : ", 1)[0].split()
+            if len(words) > 0:
+                self.on_deferred(words[-1], line.split(" : ", 1)[-1] if failed else None)
+
+    def on_deferred(self, target, error):
+        """
+        A deferred breakpoint got set (error None) or failed to once its class was loaded.  target
+        is what the breakpoint is on, as given by its spec()
+        """
+        bkpt = self.deferred.pop(target, None)
+        if bkpt is None:
+            return
+        if error is not None:
+            self.console_view.add_line("## Cannot set %s : %s ##\n" % (target, error))
+        sublime.set_timeout(self.breakpoint_view.update_view, 0)
+
+    def on_prompt(self, prev_lines, pipe_name="jdwp"):
+        """
+        Output up to a prompt:  the response to the oldest pending command, or JDB coming up
+        """
+        if "deferred" in prev_lines:
+            self.check_deferred(prev_lines)
+        if self.loaded.is_set():
+            log_debug("jdb_%s: %s" % (pipe_name, prev_lines))
+            self.console_view.add_line("<-%s\n" % prev_lines)
+            self.complete_request(prev_lines)
+        else:
+            self.loaded.set()
+
+    def on_thread_marker(self, prev_lines, marker, pipe_name="jdwp"):
+        """
+        Output up to a thread marker:  the response to the oldest pending command if that was sent
+        while stopped (JDB answers in order, before any step/cont sent after it), else a stop if
+        the VM was running, otherwise a response
+        """
+        if "deferred" in prev_lines:
+            self.check_deferred(prev_lines)
+        unsol_result = "%s%s" % (prev_lines, marker)
+        log_debug("jdb_%s: %s" % (pipe_name, unsol_result))
+        self.console_view.add_line("<-%s\n" % unsol_result)
+        with self.pending_lock:
+            answer = len(self.pending_requests) > 0 and self.pending_requests[0].stopped
+        if answer:
+            self.complete_request(prev_lines)
+        elif self.run_status == "running":
+            self.run_status = "stopped"
+            self.on_stop(prev_lines)
+        else:
+            self.complete_request(prev_lines)
+
+    def on_notice(self, output):
+        """
+        Output that isn't the answer to any command
+        """
+        log_debug("jdb_notice: %s" % output)
+        self.console_view.add_line("## %s ##\n" % output)
+
+    def read_output(self, pipe):
+        """
+        Handle output from JDB process
+        """
+        pipe_name = "stdout" if pipe == self.process.stdout else "stderr"
+        parser = JDBOutputParser(lambda prev_lines: self.on_prompt(prev_lines, pipe_name),
+                                 lambda prev_lines, marker: self.on_thread_marker(prev_lines, marker, pipe_name))
+        while True:
+            try:
+                chunk = pipe.read1(OUTPUT_CHUNK_SIZE)
+                if not chunk:
+                    parser.feed(b"", True)
+                    break
+                parser.feed(chunk)
+            except:
+                traceback.print_exc()
+        if pipe == self.process.stdout:
+            self.on_output_ended()
+        else:
+            self.fail_pending_requests()
+
+    def on_output_ended(self):
+        """
+        Wind the session down once JDB (or the VM, over JDWP) is gone
+        """
+        self.fail_pending_requests()
+        log_debug("JDB session ended")
+        self.console_view.add_line("## JDB session ended ##\n")
+        sublime.status_message("JDB session ended")
+        self.cursor_position = 0
+        self.run_status = None
+        sublime.set_timeout(lambda: update_view_markers(self.window.active_view()), 0)
+
+        for view in self.views:
+            sublime.set_timeout(view.on_session_ended, 0)
+        sublime.set_timeout(self.logpoint_output.stop, 0)
+        sublime.set_timeout(self.cleanup, 0)
+
+    def cleanup(self):
+        """
+        Cleanup workspace after disconnecting from JDB
+        """
+        if get_setting("close_views", True, self):
+            for view in self.views:
+                view.close()
+        if get_setting("push_pop_layout", True, self):
+            self.window.set_layout(self.bkp_layout)
+            self.window.focus_view(self.bkp_view)
+
+    def go_to_run_state(self, keep_variables=False):
+        """
+        Toggle current JDB state to "running" and clear variables.  Stepping keeps them around
+        so the next stop only has to redraw what changed
+        """
+        self.variables_view.cancel_watches()
+        if not keep_variables:
+            self.variables_view.clear_view()
+            self.frames = []
+            self.stack_view.update_view()
+        self.stepped = False
+        self.run_status = "running"
+
+    def get_view(self, view):
+        """
+        The debugger view of this session shown in the given editor view, if any
+        """
+        for v in self.views:
+            if v.is_open() and view.id() == v.get_view().id():
+                return v
+        return None
+
+
+java_keywords = set(("abstract assert boolean break byte case catch char class const continue default do double " +
+                     "else enum extends false final finally float for goto if implements import instanceof int " +
+                     "interface long native new null package private protected public return short static " +
+                     "strictfp super switch synchronized throw throws transient true try void volatile while").split())
+hover_expression_regex = re.compile(r"[A-Za-z_$][\w$]*(?:\s*\.\s*[A-Za-z_$][\w$]*)*")
+
+
+def expression_at(view, point):
+    """
+    The variable/field chain under the mouse, up to the hovered name ("a.b" when over b in "a.b.c")
+    """
+    if view.match_selector(point, "comment, string"):
+        return None
+    line = view.line(point)
+    text = view.substr(line)
+    column = point - line.begin()
+    word_end = view.word(point).end() - line.begin()
+    for m in hover_expression_regex.finditer(text):
+        if m.start() <= column < m.end():
+            expression = re.sub(r"\s+", "", text[m.start():min(m.end(), word_end)])
+            if expression.split(".")[0] in java_keywords:
+                return None
+            return expression
+    return None
+
+
+class JDBHover(object):
+    """
+    Shows the value of what's under the mouse while stopped.  Values are cached for the stop by
+    (expression, frame), and evaluated asynchronously so a pending hover never holds up stepping
+    """
+    def __init__(self, session):
+        self.session = session
+        self.cache = {}
+        self.generation = 0
+
+    def reset(self):
+        self.cache = {}
+        self.cancel()
+
+    def cancel(self):
+        ## Pending hovers check this before they evaluate/show anything
+        self.generation += 1
+
+    def hover(self, view, point):
+        session = self.session
+        if not session.is_running() or session.run_status != "stopped":
+            return
+        expression = expression_at(view, point)
+        if expression is None:
+            return
+        self.cancel()
+        key = (expression, session.current_frame)
+        if key in self.cache:
+            self.show(view, point, expression, self.cache[key])
+            return
+        generation = self.generation
+        sublime.set_timeout(lambda: self.evaluate(view, point, key, generation), get_setting("hover_delay", 300, self.session))
+
+    def evaluate(self, view, point, key, generation):
+        session = self.session
+        if generation != self.generation or session.run_status != "stopped":
+            return
+
+        ## A new stop replaces the cache, so a late response can only land in the old one
+        cache = self.cache
+
+        def on_result(result):
+            if result is None:
+                return
+            value = clip_value(result.value, session)
+            cache[key] = value
+            if generation == self.generation:
+                sublime.set_timeout(lambda: self.show(view, point, key[0], value), 0)
+
+        try:
+            session.backend.evaluate_async(key[0], on_result)
+        except ValueError as e:
+            log_debug(str(e))
+
+    def show(self, view, point, expression, value):
+        if value is None or self.session.run_status != "stopped":
+            return
+        view.show_popup("<b>%s</b> = %s" % (html.escape(expression), html.escape(value)),
+                        sublime.HIDE_ON_MOUSE_MOVE_AWAY, point, 800)
+
+
+class JDBLogpointOutput(object):
+    """
+    Messages from logpoints, collected from the session's threads and written out to the console
+    and the logpoint_file (if set) in one go every logpoint_flush_interval ms
+    """
+    def __init__(self, session):
+        self.session = session
+        self.lines = []
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.file = None
+
+    def start(self):
+        self.stop()
+        filename = get_setting("logpoint_file", "", self.session)
+        if filename:
+            filename = os.path.expanduser(filename.replace("{session}", str(self.session.id)))
+            try:
+                self.file = open(filename, "a", encoding="utf-8")
+            except (IOError, OSError):
+                traceback.print_exc()
+
+    def stop(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def add(self, line):
+        with self.lock:
+            self.lines.append(line)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        sublime.set_timeout(self.flush, get_setting("logpoint_flush_interval", 250, self.session))
+
+    def flush(self):
+        with self.lock:
+            data = "".join(self.lines)
+            self.lines = []
+            self.scheduled = False
+        if not data:
+            return
+        self.session.console_view.add_line(data)
+        if self.file is not None:
+            self.file.write(data)
+            self.file.flush()
+
+
+class JDBSessionManager(object):
+    """
+    Keeps one JDBSession per window, created the first time the window needs one
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, window):
+        with self.lock:
+            session = self.sessions.get(window.id())
+            if session is None:
+                self.prune()
+                session = JDBSession(window)
+                self.sessions[session.id] = session
+                new = True
+            else:
+                new = False
+        if new:
+            ## First use of the plugin in this window
+            jdb_breakpoint_file.load(window)
+        return session
+
+    def find(self, session_id):
+        return self.sessions.get(session_id)
+
+    def prune(self):
+        ## Forget idle sessions of windows that have been closed since
+        window_ids = set(window.id() for window in sublime.windows())
+        for session_id, session in list(self.sessions.items()):
+            if session_id not in window_ids and not session.is_running():
+                del self.sessions[session_id]
+
+    def running(self):
+        return [session for session in self if session.is_running()]
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+
+jdb_session_manager = JDBSessionManager()
+
+
+def find_session(window, session_id=None, create=True):
+    """
+    The session given by id (as passed to the commands), else the one of the window.  Unless
+    create is set, None if the window has no session (yet)
+    """
+    if session_id is not None:
+        return jdb_session_manager.find(session_id)
+    if window is None:
+        window = sublime.active_window()
+    if not create:
+        return jdb_session_manager.find(window.id()) if window is not None else None
+    return jdb_session_manager.get(window)
+
+
+class JDBAttach(object):
+    """
+    Attach sequence for a freshly started JDB process, run off the UI thread so a slow
+    (remote) JVM never freezes the editor:  attaching -> syncing -> attached, or failed
+    """
+    def __init__(self, session):
+        self.session = session
+        self.state = None
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.start()
+
+    def set_state(self, state, message):
+        self.state = state
+        log_debug("JDB attach: %s" % state)
+        self.session.console_view.add_line("## %s ##\n" % message)
+        sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
+    def run(self):
+        session = self.session
+        try:
+            self.set_state("attaching", "Attaching JDB...")
+            if not session.loaded.wait(get_setting("attach_timeout", 5, session)):
+                self.set_state("failed", "JDB did not start")
+                sublime.set_timeout(lambda: sublime.error_message("JDB did not start.  Check that the Java process is running and listening and that your settings are correct"), 0)
+                if session.is_running():
+                    session.run_cmd("quit", False)
+                return
+            session.go_to_run_state()
+            self.set_state("syncing", "Setting %d breakpoint(s)..." % len(jdb_breakpoints))
+            session.breakpoint_view.sync_breakpoints()
+            if isinstance(session.process, jdwp.JDWPProcess):
+                ## A VM started with suspend=y has been waiting for the breakpoints
+                session.process.resume_attached()
+            self.set_state("attached", "JDB Attached")
+        except:
+            traceback.print_exc()
+            self.state = "failed"
+
+
+class JdbLaunch(sublime_plugin.WindowCommand):
+    """
+    Launch the JDB process and add any breakpoints that may have been set prior
+    """
+    def run(self, session=None):
+        global DEBUG
+        session = find_session(self.window, session)
+        if session is None:
+            return
+        if not session.is_running():
+            ## Pick up this window's project/view overrides for the whole session, sessions
+            ## already running in other windows keep theirs
+            session.settings.load(self.window.active_view())
+            DEBUG = get_setting("debug", False, session)
+            commandline = get_setting("commandline", None, session)
+            path = get_setting("workingdir", "/tmp", session)
+            log_debug("Running: %s" % commandline)
+            log_debug("In directory: %s" % path)
+            if commandline == "notset" or path == "notset":
+                sublime.error_message("You have not configured the plugin correctly, the default configuration file and your user configuration file will open in a new window")
+                sublime.run_command("new_window")
+                wnd = sublime.active_window()
+                wnd.set_layout({
+                    "cols": [0.0, 0.5, 1.0],
+                    "rows": [0, 1.0],
+                    "cells": [[0,0,1,1], [1,0,2,1]],
+                })
+                v = wnd.open_file("%s/User/SublimeJDB.sublime-settings" % sublime.packages_path())
+                v2 = wnd.open_file("%s/SublimeJDB/SublimeJDB.sublime-settings" % sublime.packages_path())
+                wnd.set_view_index(v2, 1, 0)
+                return
+            if not os.path.exists(path):
+                sublime.error_message("The directory given does not exist: %s" % path)
+                return
+            session.launch(commandline, path)
+        else:
+            sublime.status_message("JDB is already running!")
+
+    def is_enabled(self, session=None):
+        ## Only looked up, a window's session is made when it's launched
+        session = find_session(self.window, session, False)
+        return session is None or not session.is_running()
+
+    def is_visible(self, session=None):
+        return self.is_enabled(session)
+
+
+def is_stopped(window, session_id=None):
+    """
+    Whether the session is running and currently paused
+    """
+    session = find_session(window, session_id, False)
+    return session is not None and session.is_running() and session.run_status != "running"
+
+
+def is_running(window, session_id=None):
+    """
+    Whether the session given by id, or else the one of the window, is running
+    """
+    session = find_session(window, session_id, False)
+    return session is not None and session.is_running()
+
+
+class JdbContinue(sublime_plugin.WindowCommand):
+    """
+    Resume running the Java application if currently paused
+    """
+    def run(self, session=None):
+        session = find_session(self.window, session)
+        session.cursor_position = 0
+        update_view_markers(self.window.active_view())
+        session.go_to_run_state()
+        session.run_cmd("cont", False)
+
+    def is_enabled(self, session=None):
+        return is_stopped(self.window, session)
+
+    def is_visible(self, session=None):
+        return is_running(self.window, session)
+
+
+class JdbExit(sublime_plugin.WindowCommand):
+    """
+    End the JDB session, if active
+    """
+    def run(self, session=None):
+        session = find_session(self.window, session)
+        session.shutting_down = True
+        # wait_until_stopped()
+        session.run_cmd("quit", False)
+
+    def is_enabled(self, session=None):
+        return is_running(self.window, session)
+
+    def is_visible(self, session=None):
+        return is_running(self.window, session)
+
+
+class JdbStepOver(sublime_plugin.WindowCommand):
+    """
+    Step over, if currently paused
+    """
+    def run(self, session=None):
+        session = find_session(self.window, session)
+        session.step("next")
+
+    def is_enabled(self, session=None):
+        return is_stopped(self.window, session)
+
+    def is_visible(self, session=None):
+        return is_running(self.window, session)
+
+
+class JdbStepInto(sublime_plugin.WindowCommand):
+    """
+    Step into, if currently paused
+    """
+    def run(self, session=None):
+        session = find_session(self.window, session)
+        session.step("step")
+
+    def is_enabled(self, session=None):
+        return is_stopped(self.window, session)
+
+    def is_visible(self, session=None):
+        return is_running(self.window, session)
+
+
+class JdbStepOut(sublime_plugin.WindowCommand):
+    """
+    Step out, if currently paused
+    """
+    def run(self, session=None):
+        session = find_session(self.window, session)
+        session.step("step up")
+
+    def is_enabled(self, session=None):
+        return is_stopped(self.window, session)
+
+    def is_visible(self, session=None):
+        return is_running(self.window, session)
+
+
+class JdbIgnored(sublime_plugin.WindowCommand):
+    """
+    Empty command, to be sure the keyboard shortcuts don't perform some other action
+    """
+    def run(self):
+        pass
+
+
+class JdbToggleBreakpoint(sublime_plugin.TextCommand):
+    """
+    Set a breakpoint at the current cursor
     """
     def run(self, edit):
         fn = self.view.file_name()
         if fn is not None:
+            tracked = tracked_breakpoint_lines(self.view)
             for sel in self.view.sel():
                 line, col = self.view.rowcol(sel.a)
-                jdb_breakpoint_view.toggle_breakpoint(fn, line + 1)
+                ## The marker may have moved away from the breakpoint's line with unsaved edits
+                bkpt = next((bkpt for bkpt, at in tracked if at == line + 1 and jdb_breakpoints.contains(bkpt)), None)
+                if bkpt is not None:
+                    remove_breakpoint(bkpt)
+                else:
+                    toggle_breakpoint(fn, line + 1)
         update_view_markers(self.view)
 
 
+def prompt_breakpoint(window, caption, initial, create):
+    """
+    Ask for the location of a method/exception/field breakpoint and add it
+    """
+    def on_done(text):
+        text = text.strip()
+        if text:
+            bkpt = create(text)
+            if jdb_breakpoints.find_key(bkpt.key()) is None:
+                add_breakpoint(bkpt)
+
+    window.show_input_panel("%s:" % caption, initial, on_done, None, None)
+
+
+def class_at_cursor(view):
+    """
+    The class the first cursor is in, as a starting point for the breakpoint prompts
+    """
+    fn = view.file_name() if view is not None else None
+    if fn is None or not fn.endswith(".java"):
+        return ""
+    return determine_class_from_file(normalize(fn), view.rowcol(view.sel()[0].a)[0] + 1) + "."
+
+
+class JdbAddMethodBreakpoint(sublime_plugin.WindowCommand):
+    """
+    Stop on entering a method
+    """
+    def run(self):
+        prompt_breakpoint(self.window, "Stop in method (Class.method)", class_at_cursor(self.window.active_view()),
+                          JDBMethodBreakpoint)
+
+
+class JdbAddExceptionBreakpoint(sublime_plugin.WindowCommand):
+    """
+    Stop when an exception is thrown.  mode is "caught", "uncaught" or "all"
+    """
+    def run(self, mode="all"):
+        prompt_breakpoint(self.window, "Catch %s exception (Class)" % mode, "java.lang.Exception",
+                          lambda text: JDBExceptionBreakpoint(text, mode))
+
+
+class JdbAddWatchpoint(sublime_plugin.WindowCommand):
+    """
+    Stop when a field is modified and/or read, mode being "modification", "access" or "all"
+    """
+    def run(self, mode="all"):
+        prompt_breakpoint(self.window, "Watch %s (Class.field)" % mode, class_at_cursor(self.window.active_view()),
+                          lambda text: JDBWatchpoint(text, mode))
+
+
+class JdbRemoveBreakpoint(sublime_plugin.WindowCommand):
+    """
+    Pick any breakpoint to remove
+    """
+    def run(self):
+        bkpts = jdb_breakpoints.sorted()
+        session = find_session(self.window)
+
+        def on_done(index):
+            if index >= 0:
+                remove_breakpoint(bkpts[index])
+                update_view_markers(self.window.active_view())
+
+        self.window.show_quick_panel([bkpt.format(session).strip() for bkpt in bkpts], on_done)
+
+    def is_enabled(self):
+        return len(jdb_breakpoints) > 0
+
+
+def edit_breakpoint_option(view, caption, name, parse):
+    """
+    Prompt for a new value of a breakpoint option at the first cursor
+    """
+    fn = view.file_name()
+    if fn is None:
+        return
+    line = view.rowcol(view.sel()[0].a)[0] + 1
+    bkpt = jdb_breakpoints.find(normalize(fn), line)
+    current = getattr(bkpt, name) if bkpt is not None else None
+
+    def on_done(text):
+        try:
+            value = parse(text.strip())
+        except ValueError:
+            sublime.error_message("Invalid %s: %s" % (caption.lower(), text))
+            return
+        set_breakpoint_options(fn, line, **{name: value})
+        update_view_markers(view)
+
+    view.window().show_input_panel("%s:" % caption, str(current or ""), on_done, None, None)
+
+
+class JdbEditBreakpointCondition(sublime_plugin.TextCommand):
+    """
+    Only stop at the breakpoint at the cursor when a (Java) expression is true
+    """
+    def run(self, edit):
+        edit_breakpoint_option(self.view, "Breakpoint condition", "condition", lambda text: text or None)
+
+
+class JdbEditLogpoint(sublime_plugin.TextCommand):
+    """
+    Turn the breakpoint at the cursor into a logpoint, logging a message with "{expression}"s
+    in it and resuming instead of stopping
+    """
+    def run(self, edit):
+        edit_breakpoint_option(self.view, "Logpoint message", "log_message", lambda text: text or None)
+
+
+class JdbEditBreakpointHitCount(sublime_plugin.TextCommand):
+    """
+    Only stop at the breakpoint at the cursor once it has been hit a number of times
+    """
+    def run(self, edit):
+        edit_breakpoint_option(self.view, "Breakpoint hit count", "hit_count", lambda text: int(text or 0))
+
+
+def get_variables_view(view):
+    """
+    The Variables view of the session of the window of the given view, None if there is none
+    """
+    session = find_session(view.window(), None, False)
+    return session.variables_view if session is not None else None
+
+
 class JdbClick(sublime_plugin.TextCommand):
+    """
+    Expand/collapse the variable under the cursor in the Variables view, or select the
+    frame/thread under the cursor in the Stack/Threads view
+    """
     def run(self, edit):
-        # will eventually want this for expanding/collapsing variables
-        pass
+        session = find_session(self.view.window())
+        v = session.get_view(self.view)
+        row, col = self.view.rowcol(self.view.sel()[0].a)
+        if v is session.variables_view:
+            var = v.get_variable_at_line(row)
+            if var is not None:
+                threading.Thread(target=v.toggle_variable, args=(var,)).start()
+        elif v is session.stack_view:
+            index = v.get_frame_at_line(row)
+            if index is not None:
+                session.select_frame(index)
+        elif v is session.threads_view:
+            thread = v.get_thread_at_line(row)
+            if thread is not None:
+                session.select_thread(thread)
 
     def is_enabled(self):
-        return is_running() and (jdb_variables_view.is_open() and self.view.id() == jdb_variables_view.get_view().id())
+        session = find_session(self.view.window(), None, False)
+        if session is None or not session.is_running() or session.run_status != "stopped":
+            return False
+        return session.get_view(self.view) in (session.variables_view, session.stack_view, session.threads_view)
 
 
 class JdbDoubleClick(sublime_plugin.TextCommand):
@@ -847,7 +2870,8 @@ class JdbDoubleClick(sublime_plugin.TextCommand):
         pass
 
     def is_enabled(self):
-        return is_running() and (jdb_variables_view.is_open() and self.view.id() == jdb_variables_view.get_view().id())
+        v = get_variables_view(self.view)
+        return v is not None and v.session.is_running() and (v.is_open() and self.view.id() == v.get_view().id())
 
 
 class JdbEventListener(sublime_plugin.EventListener):
@@ -856,9 +2880,11 @@ class JdbEventListener(sublime_plugin.EventListener):
     """
     def on_query_context(self, view, key, operator, operand, match_all):
         if key == "jdb_running":
-            return is_running() == operand
+            return is_running(view.window()) == operand
         elif key.startswith("jdb_"):
-            v = jdb_variables_view
+            v = get_variables_view(view)
+            if v is None:
+                return False == operand
             if key.endswith("open"):
                 return v.is_open() == operand
             else:
@@ -870,14 +2896,40 @@ class JdbEventListener(sublime_plugin.EventListener):
     def on_activated(self, view):
         if view.file_name() is not None:
             update_view_markers(view)
+            return
+        session = jdb_session_manager.find(view.window().id()) if view.window() is not None else None
+        if session is not None and session.get_view(view) is session.variables_view and session.variables_view.watches_pending:
+            session.variables_view.refresh_watches()
 
     def on_load(self, view):
         if view.file_name() is not None:
             update_view_markers(view)
 
+    def on_hover(self, view, point, hover_zone):
+        if hover_zone != sublime.HOVER_TEXT:
+            return
+        session = find_session(view.window(), None, False)
+        if session is None or not session.is_running() or not get_setting("hover_evaluate", True, session):
+            return
+        fn = view.file_name()
+        if fn is not None and fn.endswith(".java"):
+            session.hover.hover(view, point)
+
+    def on_selection_modified(self, view):
+        session = jdb_session_manager.find(view.window().id()) if view.window() is not None else None
+        if session is not None and session.run_status == "stopped":
+            session.hover.cancel()
+
+    def on_post_save(self, view):
+        jdb_source_index.update_file(view.file_name())
+        sync_breakpoint_lines(view)
+
     def on_close(self, view):
-        for v in jdb_views:
-            if v.is_open() and view.id() == v.get_view().id():
+        jdb_breakpoint_lines.pop(view.id(), None)
+        ## The view may already be detached from its window, so look through every session
+        for session in jdb_session_manager:
+            v = session.get_view(view)
+            if v is not None:
                 v.was_closed()
                 break
 
@@ -886,42 +2938,149 @@ class JdbOpenConsoleView(sublime_plugin.WindowCommand):
     """
     Open the Console debugger view
     """
-    def run(self):
-        jdb_console_view.open()
+    def run(self, session=None):
+        find_session(self.window, session).console_view.open()
 
-    def is_enabled(self):
-        return not jdb_console_view.is_open()
+    def is_enabled(self, session=None):
+        session = find_session(self.window, session, False)
+        return session is None or not session.console_view.is_open()
 
-    def is_visible(self):
-        return not jdb_console_view.is_open()
+    def is_visible(self, session=None):
+        return self.is_enabled(session)
 
 
 class JdbOpenVariablesView(sublime_plugin.WindowCommand):
     """
     Open the Variables debugger view
     """
-    def run(self):
-        jdb_variables_view.open()
+    def run(self, session=None):
+        find_session(self.window, session).variables_view.open()
 
-    def is_enabled(self):
-        return not jdb_variables_view.is_open()
+    def is_enabled(self, session=None):
+        session = find_session(self.window, session, False)
+        return session is None or not session.variables_view.is_open()
 
-    def is_visible(self):
-        return not jdb_variables_view.is_open()
+    def is_visible(self, session=None):
+        return self.is_enabled(session)
 
 
 class JdbOpenBreakpointView(sublime_plugin.WindowCommand):
     """
     Open the Breakpoints debugger view
     """
+    def run(self, session=None):
+        find_session(self.window, session).breakpoint_view.open()
+
+    def is_enabled(self, session=None):
+        session = find_session(self.window, session, False)
+        return session is None or not session.breakpoint_view.is_open()
+
+    def is_visible(self, session=None):
+        return self.is_enabled(session)
+
+
+def watches_changed():
+    jdb_breakpoint_file.schedule_save()
+    for session in jdb_session_manager:
+        if session.is_running() and session.run_status == "stopped":
+            session.variables_view.refresh_watches()
+
+
+class JdbAddWatch(sublime_plugin.WindowCommand):
+    """
+    Add a watch expression, starting from the selected text.  only_when_visible to skip it
+    while the Variables view isn't showing
+    """
+    def run(self, only_when_visible=False):
+        view = self.window.active_view()
+        initial = view.substr(view.sel()[0]) if view is not None and len(view.sel()) > 0 else ""
+
+        def on_done(text):
+            text = text.strip()
+            if not text or any(watch.expression == text for watch in jdb_watches):
+                return
+            jdb_breakpoint_file.load(self.window)
+            watch = JDBWatch(text, only_when_visible)
+            watch.project = jdb_breakpoint_file.project_key(self.window)
+            jdb_watches.append(watch)
+            watches_changed()
+
+        self.window.show_input_panel("Watch expression:", initial, on_done, None, None)
+
+
+class JdbRemoveWatch(sublime_plugin.WindowCommand):
+    """
+    Pick a watch expression to remove
+    """
     def run(self):
-        jdb_breakpoint_view.open()
+        watches = list(jdb_watches)
+
+        def on_done(index):
+            if index >= 0:
+                jdb_watches.remove(watches[index])
+                watches_changed()
+
+        self.window.show_quick_panel([watch.format() for watch in watches], on_done)
 
     def is_enabled(self):
-        return not jdb_breakpoint_view.is_open()
+        return len(jdb_watches) > 0
 
-    def is_visible(self):
-        return not jdb_breakpoint_view.is_open()
+
+class JdbSetWatchTimeout(sublime_plugin.WindowCommand):
+    """
+    Pick a watch expression and set how long to wait for its value (empty for watch_timeout)
+    """
+    def run(self):
+        watches = list(jdb_watches)
+
+        def on_timeout(watch, text):
+            try:
+                watch.timeout = float(text) if text.strip() else None
+            except ValueError:
+                sublime.error_message("Invalid timeout: %s" % text)
+                return
+            watches_changed()
+
+        def on_done(index):
+            if index >= 0:
+                watch = watches[index]
+                self.window.show_input_panel("Timeout (seconds):", str(watch.timeout or ""),
+                                             lambda text: on_timeout(watch, text), None, None)
+
+        self.window.show_quick_panel([watch.format() for watch in watches], on_done)
+
+    def is_enabled(self):
+        return len(jdb_watches) > 0
+
+
+class JdbOpenStackView(sublime_plugin.WindowCommand):
+    """
+    Open the Stack debugger view
+    """
+    def run(self, session=None):
+        find_session(self.window, session).stack_view.open()
+
+    def is_enabled(self, session=None):
+        session = find_session(self.window, session, False)
+        return session is None or not session.stack_view.is_open()
+
+    def is_visible(self, session=None):
+        return self.is_enabled(session)
+
+
+class JdbOpenThreadsView(sublime_plugin.WindowCommand):
+    """
+    Open the Threads debugger view
+    """
+    def run(self, session=None):
+        find_session(self.window, session).threads_view.open()
+
+    def is_enabled(self, session=None):
+        session = find_session(self.window, session, False)
+        return session is None or not session.threads_view.is_open()
+
+    def is_visible(self, session=None):
+        return self.is_enabled(session)
 
 
 def normalize(filename):
@@ -943,37 +3102,408 @@ def log_debug(line):
         sys.stdout.flush()
 
 
-def get_setting(key, default=None, view=None):
+class JDBSettings(object):
+    """
+    Snapshot of the SublimeJDB settings with the view/project overrides ("sublimejdb_<key>")
+    merged in.  Resolved once and then read as plain attributes, reloaded after the settings
+    file changes.  Every session has its own, taken from its window when it starts
+    """
+    ## Every setting, with its default in SublimeJDB.sublime-settings
+    keys = (
+        "workingdir", "commandline", "source_path_prefix", "source_path_prefixes",
+        "push_pop_layout", "close_views", "debug", "command_timeout", "attach_timeout", "backend",
+        "jdwp_host", "jdwp_port", "layout", "breakpoint_scope", "breakpoint_icon", "position_scope",
+        "position_icon", "changed_variable_scope", "changed_variable_icon", "view_update_rate",
+        "file_group", "console_group", "console_open", "console_clear_on_end", "console_max_lines",
+        "console_trim_lines", "console_log_file", "console_log_max_bytes", "console_log_backups",
+        "logpoint_file", "logpoint_flush_interval", "variables_group", "variables_open",
+        "variables_clear_on_end", "variables_fast_refresh", "variables_page_size",
+        "variables_max_value_length", "variables_list_types", "breakpoints_group",
+        "breakpoints_open", "breakpoints_clear_on_end", "stack_group", "stack_open",
+        "stack_clear_on_end", "threads_group", "threads_open", "threads_clear_on_end",
+        "step_refresh_delay", "watch_timeout", "hover_evaluate", "hover_delay",
+        "persist_breakpoints", "breakpoints_save_delay"
+    )
+
+    ## Whether the settings file is being watched for changes, which invalidates every snapshot
+    watching = False
+
+    def __init__(self, window=None):
+        self.loaded = False
+        self.view = None
+        self.window = window
+
+    def load(self, view=None):
+        """
+        Resolve every setting, using the overrides of the given view (or the one used last time,
+        or the active view)
+        """
+        if view is not None:
+            self.view = view
+        settings = sublime.load_settings("SublimeJDB.sublime-settings")
+        if not JDBSettings.watching:
+            settings.add_on_change("sublimejdb", invalidate_settings)
+            JDBSettings.watching = True
+        view_settings = None
+        try:
+            if self.view is None or self.view.window() is None:
+                self.view = (self.window or sublime.active_window()).active_view()
+            view_settings = self.view.settings()
+        except:
+            pass
+        for key in self.keys:
+            value = settings.get(key)
+            if view_settings is not None and view_settings.has("sublimejdb_%s" % key):
+                value = view_settings.get("sublimejdb_%s" % key)
+            setattr(self, key, value)
+        self.loaded = True
+        return self
+
+    def invalidate(self):
+        self.loaded = False
+
+
+jdb_settings = JDBSettings()
+
+
+def invalidate_settings():
+    jdb_settings.invalidate()
+    for session in jdb_session_manager:
+        session.settings.invalidate()
+
+
+def get_settings(session=None):
     """
-    Read setting value from SublimeJDB settings file
+    Current settings snapshot of the given session (or, outside of any session, of the active
+    view), for reading settings as attributes on hot paths
     """
-    try:
-        if view is None:
-            view = sublime.active_window().active_view()
-        s = view.settings()
-        if s.has("sublimejdb_%s" % key):
-            return s.get("sublimejdb_%s" % key)
-    except:
-        pass
+    settings = session.settings if session is not None else jdb_settings
+    if not settings.loaded:
+        settings.load()
+    return settings
+
+
+def get_setting(key, default=None, session=None):
+    """
+    Read setting value from SublimeJDB settings file, as seen by the given session
+    """
+    if key in JDBSettings.keys:
+        value = getattr(get_settings(session), key)
+        return default if value is None else value
     return sublime.load_settings("SublimeJDB.sublime-settings").get(key, default)
 
 
-def determine_class_from_file(filename):
+java_token_regex = re.compile(r"""
+      (?P<comment>//[^\n]*|/\*.*?\*/)
+    | (?P<string>\"\"\".*?\"\"\"|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    | \bpackage\s+(?P<package>[\w.\s]+?)\s*;
+    | (?<![\w.])(?:class|interface|enum|record(?=\s+\w+\s*[(<]))\s+(?P<type>\w+)
+    | (?P<new>\bnew\b)
+    | (?P<punct>[{}();])
+""", re.S | re.X)
+
+
+def parse_java_types(text):
+    """
+    Find the package and every type declared in a Java source, including member, local and
+    anonymous classes, named the way javac names them (Outer$Inner, Outer$1, Outer$1Local).
+    Returns (package, [(binary_name, first_line, last_line), ...])
+    """
+    package = ""
+    types = []
+    used_names = set()
+    ## One entry per open brace, [binary_name, first_line, in_enum_constants] for types and None
+    ## for plain blocks
+    stack = []
+    pending_type = None
+    pending_enum = False
+    new_pending = False
+    new_parens = []
+    paren_depth = 0
+    anonymous_at = None
+    line = 1
+    pos = 0
+
+    def local_name(enclosing, suffix):
+        i = 1
+        while "%s$%d%s" % (enclosing, i, suffix) in used_names:
+            i += 1
+        return "%s$%d%s" % (enclosing, i, suffix)
+
+    for m in java_token_regex.finditer(text):
+        line += text.count("\n", pos, m.start())
+        pos = m.start()
+        kind = m.lastgroup
+        token = m.group(kind)
+        if kind in ("comment", "string"):
+            continue
+        if kind == "package":
+            package = re.sub(r"\s", "", token)
+        elif kind == "type":
+            pending_type = token
+            pending_enum = m.group(0).startswith("enum")
+        elif kind == "new":
+            new_pending = True
+        elif token == "(":
+            if new_pending:
+                new_parens.append(paren_depth)
+                new_pending = False
+            paren_depth += 1
+        elif token == ")":
+            paren_depth -= 1
+            if new_parens and new_parens[-1] == paren_depth:
+                new_parens.pop()
+                anonymous_at = m.end()
+                continue
+        elif token == ";":
+            new_pending = False
+            pending_type = None
+            if stack and stack[-1] is not None:
+                ## The constants of an enum end at the first ";" of its body
+                stack[-1][2] = False
+        elif token == "{":
+            enclosing = None
+            directly_enclosed = len(stack) > 0 and stack[-1] is not None
+            for scope in reversed(stack):
+                if scope is not None:
+                    enclosing = scope[0]
+                    break
+            name = None
+            if pending_type is not None:
+                if enclosing is None:
+                    name = "%s.%s" % (package, pending_type) if package else pending_type
+                elif directly_enclosed:
+                    name = "%s$%s" % (enclosing, pending_type)
+                else:
+                    name = local_name(enclosing, pending_type)
+            elif anonymous_at is not None and enclosing is not None and text[anonymous_at:m.start()].strip() == "":
+                name = local_name(enclosing, "")
+            elif directly_enclosed and stack[-1][2]:
+                ## The body of an enum constant is an anonymous class
+                name = local_name(enclosing, "")
+            if name is not None:
+                used_names.add(name)
+                stack.append([name, line, pending_type is not None and pending_enum])
+            else:
+                stack.append(None)
+            pending_type = None
+            new_pending = False
+        elif token == "}":
+            if stack:
+                scope = stack.pop()
+                if scope is not None:
+                    types.append((scope[0], scope[1], line))
+        anonymous_at = None
+
+    types.sort(key=lambda t: t[1])
+    return package, types
+
+
+class JDBSourceIndex(object):
+    """
+    Maps binary class names (including nested, local and anonymous classes) to source files and
+    back, for every Java file in the project folders of every window.  Each folder is indexed
+    in the background the first time a window asks for it.  Files are kept current as they are
+    saved, changes made outside of Sublime are picked up when a session starts
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        ## Binary class name -> [filename], more than one when several projects declare the class
+        self.classes = {}
+        self.files = {}
+        ## Folders indexed or being indexed
+        self.folders = set()
+
+    def source_roots(self, session=None):
+        settings = get_settings(session)
+        roots = [settings.source_path_prefix]
+        for root in settings.source_path_prefixes:
+            if root not in roots:
+                roots.append(root)
+        return roots
+
+    def build(self, folders, refresh=False):
+        """
+        Start indexing those of the given folders that aren't indexed yet in the background, or
+        with refresh, all of them again, reparsing the files whose mtime changed
+        """
+        with self.lock:
+            folders = [folder for folder in folders if refresh or folder not in self.folders]
+            if len(folders) == 0:
+                return
+            self.folders.update(folders)
+        t = threading.Thread(target=self.do_build, args=(folders,))
+        t.start()
+
+    def do_build(self, folders):
+        parsed = []
+        try:
+            for folder in folders:
+                for dirpath, dirnames, filenames in os.walk(folder):
+                    dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                    for f in filenames:
+                        if f.endswith(".java"):
+                            filename = os.path.join(dirpath, f)
+                            known = self.files.get(normalize(filename))
+                            if known is None or known[0] != self.mtime(filename):
+                                parsed.append((filename, known, self.parse_file(filename)))
+            log_debug("Indexed %d files in %s" % (len(parsed), ", ".join(folders)))
+        except:
+            traceback.print_exc()
+        with self.lock:
+            ## Unless it was reindexed while this ran, when it was saved
+            for filename, known, entry in parsed:
+                if self.files.get(normalize(filename)) is known:
+                    self.store(filename, entry)
+
+    def mtime(self, filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return None
+
+    def parse_file(self, filename):
+        """
+        (mtime, types) of a source file
+        """
+        mtime = self.mtime(filename)
+        try:
+            with open(filename, encoding="utf-8", errors="replace") as f:
+                _, types = parse_java_types(f.read())
+        except (IOError, OSError):
+            mtime, types = None, []
+        return mtime, types
+
+    def store(self, filename, entry):
+        """
+        Put a parsed file into files/classes, replacing whatever it declared before.  Called
+        with the lock held
+        """
+        key = normalize(filename)
+        old = self.files.get(key)
+        if old is not None:
+            for name, first, last in old[1]:
+                filenames = self.classes.get(name, [])
+                if filename in filenames:
+                    filenames.remove(filename)
+                    if len(filenames) == 0:
+                        del self.classes[name]
+        for name, first, last in entry[1]:
+            filenames = self.classes.setdefault(name, [])
+            if filename not in filenames:
+                filenames.append(filename)
+        self.files[key] = entry
+        return entry
+
+    def update_file(self, filename):
+        if filename is None or not filename.endswith(".java") or len(self.folders) == 0:
+            return
+        with self.lock:
+            self.reindex(filename)
+
+    def reindex(self, filename):
+        ## Called with the lock held
+        return self.store(filename, self.parse_file(filename))
+
+    def file_types(self, filename):
+        """
+        Types declared in a file, parsed here if it isn't indexed (yet).  This is on the hot path
+        of every breakpoint lookup, so it leaves checking the file on disk to saves and refreshes
+        """
+        entry = self.files.get(normalize(filename))
+        if entry is None:
+            with self.lock:
+                entry = self.reindex(filename)
+        return entry[1]
+
+    def file_for_class(self, class_name, folders=()):
+        """
+        The file declaring a class, preferring one within the given folders
+        """
+        filenames = self.classes.get(class_name)
+        if not filenames and "$" in class_name:
+            ## Synthetic classes (lambdas and such) live in their outermost class's file
+            filenames = self.classes.get(class_name.split("$")[0])
+        if not filenames:
+            return None
+        for folder in folders:
+            prefix = os.path.join(normalize(folder), "")
+            for filename in filenames:
+                if normalize(filename).startswith(prefix):
+                    return filename
+        return filenames[0]
+
+    def class_for_file(self, filename, line=None):
+        """
+        The innermost type declared around a line, or the file's main type if no line is given
+        """
+        types = self.file_types(filename)
+        if len(types) == 0:
+            return None
+        if line is None:
+            base = os.path.splitext(os.path.basename(filename))[0]
+            for name, first, last in types:
+                if name.split(".")[-1] == base:
+                    return name
+            return types[0][0]
+        found = None
+        for name, first, last in types:
+            if first > line:
+                break
+            if last >= line:
+                found = name
+        return found
+
+
+jdb_source_index = JDBSourceIndex()
+
+
+def index_sources(window=None, refresh=False):
+    """
+    Make sure the source index covers the folders of the given (or active) window, with refresh
+    also catching up with files changed outside of Sublime
     """
-    Figure out the Java package/class from absolute file name
+    if window is None:
+        window = sublime.active_window()
+    if window is not None:
+        jdb_source_index.build(window.folders(), refresh)
+
+
+def determine_class_from_file(filename, line=None):
     """
+    Figure out the Java package/class from absolute file name, and the line within it if given
+    """
+    class_name = jdb_source_index.class_for_file(filename, line)
+    if class_name is not None:
+        return class_name
     class_name = filename.replace("\\", "/")
-    src_prefix = get_setting("source_path_prefix", "/src/main/java/")
+    src_prefix = get_settings().source_path_prefix
     class_name = class_name[class_name.find(src_prefix) + len(src_prefix):]
     class_name = class_name.replace("/", ".").replace(".java","")
     return class_name
 
-def determine_file_from_class(class_name):
-    """
-    Figure out the absolute file name from a Java package/class
-    """
-    project_root = sublime.active_window().project_data()['folders'][0]['path']
-    src_prefix = project_root + get_setting("source_path_prefix", "/src/main/java/")
-    filename = class_name.replace(".", "/")
-    filename = src_prefix + filename + ".java"
-    return filename
\ No newline at end of file
+def determine_file_from_class(class_name, source_name=None, window=None):
+    """
+    Figure out the absolute file name from a Java package/class, None if there is no such file.
+    source_name is the file name JDB reports for a frame (e.g. "Outer.java"), if known.
+    Project folders are those of the given (or active) window
+    """
+    if window is None:
+        window = sublime.active_window()
+    session = find_session(window, None, False)
+    filename = jdb_source_index.file_for_class(class_name, window.folders())
+    if filename is not None:
+        return filename
+    ## Not indexed (yet), try each project folder directly
+    index_sources(window)
+    top_level = class_name.split("$")[0]
+    rel_paths = [top_level.replace(".", "/") + ".java"]
+    if source_name is not None and "." in top_level:
+        rel_paths.append(top_level.rsplit(".", 1)[0].replace(".", "/") + "/" + source_name)
+    for folder in window.folders():
+        for root in jdb_source_index.source_roots(session):
+            for rel_path in rel_paths:
+                filename = folder + root + rel_path
+                if os.path.exists(filename):
+                    return filename
+    return None
\ No newline at end of file
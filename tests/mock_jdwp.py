@@ -0,0 +1,371 @@
+"""
+A scripted VM at the other end of a JDWP connection, for the tests of jdwp.py.  It answers the
+commands JDWPProcess sends for a tiny program:
+
+    class com.ex.Main            main(String[] args) at lines 10-12, line 12 twice as in a finally
+                                 block, work(int) at lines 20-21
+                                 static int count
+    class com.ex.Foo             String toString() returning "Foo!", int plus(int) adding 7
+                                 int x = 7, String label = "lbl"
+    class com.ex.Lazy            run() at line 30, only loaded once the VM has been resumed
+
+Each resume of the VM fires the next thing the debugger asked for:  a pending step, the class
+prepare of com.ex.Lazy, an unfired breakpoint, else the VM dies.  Like HotSpot, resuming the VM
+or invoking a method gives the frames of the thread new ids, the old ones are then refused
+"""
+import socket
+import struct
+import threading
+
+HANDSHAKE = b"JDWP-Handshake"
+
+MAIN, FOO, LAZY, STRING, THREAD, INT_ARRAY = 100, 101, 102, 103, 104, 105
+MAIN_THREAD, MAIN_GROUP = 1, 50
+FOO_OBJECT, INT_ARRAY_OBJECT = 500, 700
+NATIVE_INDEX = 0xffffffffffffffff
+
+BREAKPOINT, SINGLE_STEP, CLASS_PREPARE, VM_START, VM_DEATH = 2, 1, 8, 90, 99
+ERROR_INVALID_FRAMEID = 30
+
+
+def pack_int(value):
+    return struct.pack(">i", value)
+
+
+def pack_long(value):
+    return struct.pack(">q", value)
+
+
+def pack_id(value):
+    return struct.pack(">Q", value)
+
+
+def pack_string(value):
+    data = value.encode("utf-8")
+    return pack_int(len(data)) + data
+
+
+def pack_location(class_id, method_id, index):
+    return b"\x01" + pack_id(class_id) + pack_id(method_id) + struct.pack(">Q", index)
+
+
+def tagged(tag, data):
+    return tag.encode("ascii") + data
+
+
+class MockVM(object):
+    """
+    Listens on a free local port, serving a single debugger connection from a thread of its own.
+    suspend makes it announce a VM_START that suspended the VM, as with suspend=y.  fragment
+    sends every packet in pieces of a few bytes, handshake replaces the handshake answer
+    """
+    def __init__(self, suspend=False, fragment=False, handshake=HANDSHAKE):
+        self.suspend = suspend
+        self.fragment = fragment
+        self.handshake = handshake
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.sock = None
+        self.lock = threading.Lock()
+        self.packet_id = 1000000
+        ## (command set, command) of every command received, in order
+        self.commands = []
+        ## request id -> [event kind, location, fired]
+        self.event_requests = {}
+        ## (size, depth) of every step requested
+        self.steps = []
+        ## Bumped by whatever resumes the thread, frame ids are 900 and 901 plus ten times this
+        self.frame_generation = 0
+        self.next_request = 1
+        self.classes = {
+            MAIN: "Lcom/ex/Main;", FOO: "Lcom/ex/Foo;", STRING: "Ljava/lang/String;",
+            THREAD: "Ljava/lang/Thread;", INT_ARRAY: "[I"
+        }
+        self.methods = {
+            MAIN: [(1, "main", "([Ljava/lang/String;)V", 9), (2, "work", "(I)I", 1)],
+            FOO: [(10, "toString", "()Ljava/lang/String;", 1), (11, "plus", "(I)I", 1)],
+            LAZY: [(20, "run", "()V", 1)]
+        }
+        self.line_tables = {
+            (MAIN, 1): (0, 20, [(0, 10), (4, 11), (8, 12), (14, 12)]),
+            (MAIN, 2): (0, 9, [(0, 20), (3, 21)]),
+            (LAZY, 20): (0, 5, [(0, 30)]),
+            (FOO, 10): (0, 3, [(0, 40)]),
+            (FOO, 11): (0, 3, [(0, 41)])
+        }
+        self.variable_tables = {
+            (MAIN, 1): (1, [(0, "args", "[Ljava/lang/String;", 20, 0), (4, "n", "I", 16, 1),
+                            (4, "s", "Ljava/lang/String;", 16, 2), (4, "foo", "Lcom/ex/Foo;", 16, 3),
+                            (4, "arr", "[I", 16, 4)])
+        }
+        self.fields = {MAIN: [(30, "count", "I", 8)], FOO: [(31, "x", "I", 0), (32, "label", "Ljava/lang/String;", 0)]}
+        self.strings = {600: "Foo!", 601: "hello", 602: "lbl"}
+        self.objects = {FOO_OBJECT: FOO, 600: STRING, 601: STRING, 602: STRING, MAIN_THREAD: THREAD,
+                        INT_ARRAY_OBJECT: INT_ARRAY}
+        self.next_string = 650
+        self.location = (MAIN, 1, 0)
+
+    def start(self):
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        for sock in (self.sock, self.server):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+    def serve(self):
+        try:
+            self.sock, address = self.server.accept()
+            if self.receive(len(HANDSHAKE)) != HANDSHAKE:
+                return
+            self.send(self.handshake)
+            if self.suspend:
+                self.event(2, [bytes([VM_START]) + pack_int(0) + pack_id(MAIN_THREAD)])
+            while True:
+                header = self.receive(11)
+                length, packet_id, flags, command_set, command = struct.unpack(">IIBBB", header)
+                self.handle(packet_id, (command_set, command), self.receive(length - 11))
+        except (EOFError, OSError):
+            pass
+
+    def receive(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def send(self, data):
+        with self.lock:
+            if not self.fragment:
+                self.sock.sendall(data)
+                return
+            for i in range(0, len(data), 3):
+                self.sock.sendall(data[i:i + 3])
+
+    def reply(self, packet_id, data=b"", error=0):
+        self.send(struct.pack(">IIBH", 11 + len(data), packet_id, 0x80, error) + data)
+
+    def event(self, suspend_policy, events):
+        data = bytes([suspend_policy]) + pack_int(len(events)) + b"".join(events)
+        with self.lock:
+            self.packet_id += 1
+            packet_id = self.packet_id
+        self.send(struct.pack(">IIBBB", 11 + len(data), packet_id, 0, 64, 100) + data)
+
+    ## What a resume sets off
+
+    def pending(self, kind):
+        return [(request_id, request) for request_id, request in sorted(self.event_requests.items())
+                if request[0] == kind and not request[2]]
+
+    def resumed(self):
+        steps = self.pending(SINGLE_STEP)
+        if steps:
+            request_id, request = steps[0]
+            self.location = (MAIN, 1, 8)
+            self.event(2, [bytes([SINGLE_STEP]) + pack_int(request_id) + pack_id(MAIN_THREAD) + pack_location(*self.location)])
+            return
+        prepares = self.pending(CLASS_PREPARE)
+        if prepares and LAZY not in self.classes:
+            self.classes[LAZY] = "Lcom/ex/Lazy;"
+            request_id, request = prepares[0]
+            request[2] = True
+            self.event(2, [bytes([CLASS_PREPARE]) + pack_int(request_id) + pack_id(MAIN_THREAD) + b"\x01" +
+                           pack_id(LAZY) + pack_string("Lcom/ex/Lazy;") + pack_int(7)])
+            return
+        breakpoints = self.pending(BREAKPOINT)
+        if breakpoints:
+            request_id, request = breakpoints[0]
+            request[2] = True
+            self.location = request[1]
+            self.event(2, [bytes([BREAKPOINT]) + pack_int(request_id) + pack_id(MAIN_THREAD) + pack_location(*self.location)])
+            return
+        self.event(0, [bytes([VM_DEATH]) + pack_int(0)])
+        self.stop()
+
+    def frame_ids(self):
+        return 900 + 10 * self.frame_generation, 901 + 10 * self.frame_generation
+
+    def frame_values(self, slots):
+        values = {0: tagged("[", pack_id(0)), 1: tagged("I", pack_int(42)), 2: tagged("s", pack_id(601)),
+                  3: tagged("L", pack_id(FOO_OBJECT)), 4: tagged("[", pack_id(INT_ARRAY_OBJECT))}
+        return pack_int(len(slots)) + b"".join(values[slot] for slot in slots)
+
+    def handle(self, packet_id, cmd, data):
+        self.commands.append(cmd)
+        pos = [0]
+
+        def take(size):
+            pos[0] += size
+            return data[pos[0] - size:pos[0]]
+
+        def read_int():
+            return struct.unpack(">i", take(4))[0]
+
+        def read_id():
+            return struct.unpack(">Q", take(8))[0]
+
+        def read_string():
+            return take(read_int()).decode("utf-8")
+
+        if cmd == (1, 7):
+            ## ID sizes
+            return self.reply(packet_id, pack_int(8) * 5)
+        if cmd == (1, 1):
+            return self.reply(packet_id, pack_string("Mock VM") + pack_int(1) + pack_int(8) +
+                              pack_string("1.8.0") + pack_string("MockVM"))
+        if cmd == (1, 2):
+            signature = read_string()
+            found = [ref for ref, sig in self.classes.items() if sig == signature]
+            return self.reply(packet_id, pack_int(len(found)) + b"".join(b"\x01" + pack_id(ref) + pack_int(7) for ref in found))
+        if cmd == (1, 4):
+            return self.reply(packet_id, pack_int(1) + pack_id(MAIN_THREAD))
+        if cmd == (1, 6):
+            self.reply(packet_id)
+            return self.stop()
+        if cmd == (1, 9):
+            self.frame_generation += 1
+            self.reply(packet_id)
+            threading.Timer(0.05, self.resumed).start()
+            return
+        if cmd == (1, 11):
+            self.next_string += 1
+            self.strings[self.next_string] = read_string()
+            self.objects[self.next_string] = STRING
+            return self.reply(packet_id, pack_id(self.next_string))
+        if cmd == (2, 1):
+            return self.reply(packet_id, pack_string(self.classes[read_id()]))
+        if cmd == (2, 4):
+            fields = self.fields.get(read_id(), [])
+            return self.reply(packet_id, pack_int(len(fields)) + b"".join(
+                pack_id(i) + pack_string(name) + pack_string(sig) + pack_int(mods) for i, name, sig, mods in fields))
+        if cmd == (2, 5):
+            methods = self.methods.get(read_id(), [])
+            return self.reply(packet_id, pack_int(len(methods)) + b"".join(
+                pack_id(i) + pack_string(name) + pack_string(sig) + pack_int(mods) for i, name, sig, mods in methods))
+        if cmd == (2, 6):
+            read_id()
+            count = read_int()
+            return self.reply(packet_id, pack_int(count) + tagged("I", pack_int(3)) * count)
+        if cmd == (2, 7):
+            ref = read_id()
+            if ref == FOO:
+                ## No source file attribute
+                return self.reply(packet_id, error=101)
+            return self.reply(packet_id, pack_string(self.classes[ref].split("/")[-1][:-1] + ".java"))
+        if cmd == (3, 1):
+            read_id()
+            return self.reply(packet_id, pack_id(0))
+        if cmd == (6, 1):
+            table = self.line_tables.get((read_id(), read_id()))
+            if table is None:
+                return self.reply(packet_id, error=101)
+            return self.reply(packet_id, pack_long(table[0]) + pack_long(table[1]) + pack_int(len(table[2])) +
+                              b"".join(pack_long(index) + pack_int(line) for index, line in table[2]))
+        if cmd == (6, 2):
+            table = self.variable_tables.get((read_id(), read_id()))
+            if table is None:
+                return self.reply(packet_id, error=101)
+            return self.reply(packet_id, pack_int(table[0]) + pack_int(len(table[1])) + b"".join(
+                pack_long(index) + pack_string(name) + pack_string(sig) + pack_int(length) + pack_int(slot)
+                for index, name, sig, length, slot in table[1]))
+        if cmd == (9, 1):
+            return self.reply(packet_id, b"\x01" + pack_id(self.objects[read_id()]))
+        if cmd == (9, 2):
+            read_id()
+            values = []
+            for i in range(read_int()):
+                values.append(tagged("I", pack_int(7)) if read_id() == 31 else tagged("s", pack_id(602)))
+            return self.reply(packet_id, pack_int(len(values)) + b"".join(values))
+        if cmd == (9, 6):
+            read_id()
+            read_id()
+            read_id()
+            method = read_id()
+            read_int()
+            self.frame_generation += 1
+            if method == 10:
+                return self.reply(packet_id, tagged("s", pack_id(600)) + tagged("L", pack_id(0)))
+            if method == 11:
+                take(1)
+                return self.reply(packet_id, tagged("I", pack_int(read_int() + 7)) + tagged("L", pack_id(0)))
+            return self.reply(packet_id, error=23)
+        if cmd == (10, 1):
+            return self.reply(packet_id, pack_string(self.strings[read_id()]))
+        if cmd == (11, 1):
+            return self.reply(packet_id, pack_string("main"))
+        if cmd == (11, 4):
+            return self.reply(packet_id, pack_int(1) + pack_int(1))
+        if cmd == (11, 5):
+            return self.reply(packet_id, pack_id(MAIN_GROUP))
+        if cmd == (11, 6):
+            ## The current location, called from a native method of Foo
+            frame_ids = self.frame_ids()
+            return self.reply(packet_id, pack_int(2) + pack_id(frame_ids[0]) + pack_location(*self.location) +
+                              pack_id(frame_ids[1]) + pack_location(FOO, 10, NATIVE_INDEX))
+        if cmd == (12, 1):
+            return self.reply(packet_id, pack_string("main"))
+        if cmd == (13, 1):
+            return self.reply(packet_id, pack_int(3))
+        if cmd == (13, 2):
+            read_id()
+            first = read_int()
+            count = read_int()
+            return self.reply(packet_id, b"I" + pack_int(count) + b"".join(pack_int((first + i) * 10) for i in range(count)))
+        if cmd == (15, 1):
+            kind = take(1)[0]
+            take(1)
+            location = None
+            for i in range(read_int()):
+                modifier = take(1)[0]
+                if modifier == 1:
+                    read_int()
+                elif modifier in (5, 6):
+                    read_string()
+                elif modifier == 7:
+                    take(1)
+                    location = (read_id(), read_id(), struct.unpack(">Q", take(8))[0])
+                elif modifier == 8:
+                    read_id()
+                    take(2)
+                elif modifier == 9:
+                    read_id()
+                    read_id()
+                elif modifier == 10:
+                    read_id()
+                    self.steps.append((read_int(), read_int()))
+            request_id = self.next_request
+            self.next_request += 1
+            self.event_requests[request_id] = [kind, location, False]
+            return self.reply(packet_id, pack_int(request_id))
+        if cmd == (15, 2):
+            take(1)
+            self.event_requests.pop(read_int(), None)
+            return self.reply(packet_id)
+        if cmd in ((16, 1), (16, 3)):
+            read_id()
+            if read_id() not in self.frame_ids():
+                return self.reply(packet_id, error=ERROR_INVALID_FRAMEID)
+        if cmd == (16, 1):
+            slots = []
+            for i in range(read_int()):
+                slots.append(read_int())
+                take(1)
+            return self.reply(packet_id, self.frame_values(slots))
+        if cmd == (16, 3):
+            return self.reply(packet_id, tagged("L", pack_id(0)))
+        ## Not implemented
+        self.reply(packet_id, error=99)
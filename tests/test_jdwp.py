@@ -0,0 +1,236 @@
+"""
+Tests of the JDWP backend against the scripted VM of mock_jdwp.py.  Run from the repository
+root with:  python -m unittest discover tests
+"""
+import os
+import queue
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import jdwp
+import mock_jdwp
+
+TIMEOUT = 5
+
+
+class Listener(object):
+    """
+    Collects what a JDWPProcess hands to its session, in order
+    """
+    def __init__(self):
+        self.items = queue.Queue()
+
+    def on_prompt(self, output):
+        self.items.put(("prompt", output))
+
+    def on_thread_marker(self, output, marker):
+        self.items.put(("stop", output))
+
+    def on_deferred(self, target, error):
+        self.items.put(("deferred", (target, error)))
+
+    def on_notice(self, output):
+        self.items.put(("notice", output))
+
+    def on_output_ended(self):
+        self.items.put(("ended", None))
+
+    def next(self, kind):
+        """
+        The next item of the given kind, skipping the others
+        """
+        while True:
+            item_kind, value = self.items.get(timeout=TIMEOUT)
+            if item_kind == kind:
+                return value
+
+
+def call(process, name, *args):
+    done = threading.Event()
+    outcome = []
+
+    def callback(result, error):
+        outcome.append((result, error))
+        done.set()
+    process.call(name, args, callback)
+    if not done.wait(TIMEOUT):
+        raise AssertionError("%s was never answered" % name)
+    result, error = outcome[0]
+    if error is not None:
+        raise error
+    return result
+
+
+class PacketTest(unittest.TestCase):
+    def test_round_trip(self):
+        sizes = {"field": 4, "method": 8, "object": 8, "reference_type": 2, "frame": 8}
+        location = jdwp.JDWPLocation(1, 0x1234, 42, 7)
+        data = (jdwp.JDWPWriter(sizes).byte(3).boolean(True).int(-5).long(1 << 40).string("hé")
+                .id("field", 9).location(location).value(jdwp.JDWPValue("I", 12)).value(jdwp.JDWPValue("L", 77))
+                .data())
+        reader = jdwp.JDWPReader(data, sizes)
+        self.assertEqual(reader.byte(), 3)
+        self.assertEqual(reader.boolean(), True)
+        self.assertEqual(reader.int(), -5)
+        self.assertEqual(reader.long(), 1 << 40)
+        self.assertEqual(reader.string(), "hé")
+        self.assertEqual(reader.id("field"), 9)
+        self.assertEqual(reader.location(), location)
+        self.assertEqual(reader.value(), jdwp.JDWPValue("I", 12))
+        self.assertEqual(reader.value(), jdwp.JDWPValue("L", 77))
+        self.assertEqual(reader.pos, len(data))
+
+    def test_truncated(self):
+        reader = jdwp.JDWPReader(b"\x00\x00", {})
+        self.assertRaises(jdwp.JDWPError, reader.int)
+
+
+class ConnectionTest(unittest.TestCase):
+    def connect(self, vm):
+        self.vm = vm.start()
+        self.connection = jdwp.JDWPConnection(lambda reader: None, lambda: None)
+        self.addCleanup(self.vm.stop)
+        self.connection.connect("127.0.0.1", self.vm.port, TIMEOUT)
+        self.addCleanup(self.connection.close)
+        return jdwp.JDWPVirtualMachine(self.connection, TIMEOUT)
+
+    def test_handshake(self):
+        vm = self.connect(mock_jdwp.MockVM())
+        ## The ID sizes come first, everything else depends on them
+        self.assertEqual(self.vm.commands[0], (1, 7))
+        self.assertEqual(vm.version()[2], "MockVM")
+
+    def test_bad_handshake(self):
+        vm = mock_jdwp.MockVM(handshake=b"JDWP-Nope-Shake").start()
+        self.addCleanup(vm.stop)
+        connection = jdwp.JDWPConnection(lambda reader: None, lambda: None)
+        self.assertRaises(jdwp.JDWPError, connection.connect, "127.0.0.1", vm.port, TIMEOUT)
+
+    def test_fragmented_packets(self):
+        vm = self.connect(mock_jdwp.MockVM(fragment=True))
+        self.assertEqual(vm.version()[2], "MockVM")
+        self.assertEqual(vm.class_name(vm.find_class("com.ex.Main")[1]), "com.ex.Main")
+
+    def test_error_code(self):
+        self.connect(mock_jdwp.MockVM())
+        with self.assertRaises(jdwp.JDWPError) as caught:
+            self.connection.command((99, 1), timeout=TIMEOUT)
+        self.assertEqual(caught.exception.code, 99)
+
+
+class ProcessTest(unittest.TestCase):
+    def start(self, **options):
+        self.vm = mock_jdwp.MockVM(**options).start()
+        self.addCleanup(self.vm.stop)
+        self.listener = Listener()
+        self.process = jdwp.JDWPProcess("127.0.0.1", self.vm.port, self.listener, TIMEOUT)
+        self.process.start()
+        self.assertIn("MockVM", self.listener.next("prompt"))
+
+    def command(self, line):
+        self.process.write(("%s\n" % line).encode("utf-8"))
+
+    def stop_at_main(self):
+        self.start(suspend=True)
+        self.assertEqual(call(self.process, "set_breakpoint", "stop at com.ex.Main:11")[0], "set")
+        self.process.resume_attached()
+        self.assertIn("Breakpoint hit: \"thread=main\", com.ex.Main.main(), line=11", self.listener.next("stop"))
+
+    def test_breakpoints(self):
+        self.start(suspend=True)
+        self.assertEqual(call(self.process, "set_breakpoint", "stop at com.ex.Main:11")[0], "set")
+        self.assertEqual(call(self.process, "set_breakpoint", "stop at com.ex.Main:99")[0], "failed")
+        self.assertEqual(call(self.process, "set_breakpoint", "stop in com.ex.Lazy.run")[0], "deferred")
+        self.assertEqual(call(self.process, "set_breakpoint", "catch all com.ex.Foo")[0], "set")
+        self.assertTrue(call(self.process, "clear_breakpoint", "ignore all com.ex.Foo"))
+        self.assertFalse(call(self.process, "clear_breakpoint", "clear com.ex.Nope:3"))
+        ## The text commands answer in jdb's words
+        self.command("stop at com.ex.Main:12")
+        self.assertEqual(self.listener.next("prompt"), "Set breakpoint com.ex.Main:12")
+        ## One request for each piece of code on the line
+        self.assertEqual(sorted(request[1] for request in self.vm.event_requests.values()
+                                if request[0] == mock_jdwp.BREAKPOINT and request[1][0] == mock_jdwp.MAIN),
+                         [(mock_jdwp.MAIN, 1, 4), (mock_jdwp.MAIN, 1, 8), (mock_jdwp.MAIN, 1, 14)])
+        self.assertTrue(call(self.process, "clear_breakpoint", "clear com.ex.Main:12"))
+        self.assertEqual(len(self.vm.event_requests), 2)
+
+    def test_events(self):
+        self.stop_at_main()
+        call(self.process, "set_breakpoint", "stop in com.ex.Lazy.run")
+        self.command("next")
+        self.assertIn("Step completed: \"thread=main\", com.ex.Main.main(), line=12", self.listener.next("stop"))
+        self.command("cont")
+        self.assertEqual(self.listener.next("deferred"), ("com.ex.Lazy.run", None))
+        self.assertIn("com.ex.Lazy.run(), line=30", self.listener.next("stop"))
+        self.command("cont")
+        self.listener.next("ended")
+
+    def test_step_sizes(self):
+        self.stop_at_main()
+        self.command("next")
+        self.listener.next("stop")
+        self.command("stepi")
+        self.listener.next("stop")
+        self.assertEqual(self.vm.steps, [(1, 1), (0, 0)])
+
+    def test_frames_and_threads(self):
+        self.stop_at_main()
+        self.assertEqual(call(self.process, "stack_frames"),
+                         [("com.ex.Main", "main", "Main.java", 11), ("com.ex.Foo", "toString", None, None)])
+        self.assertEqual(call(self.process, "thread_list"),
+                         [("main", "java.lang.Thread", "0x1", "main running (at breakpoint)")])
+        self.command("where")
+        self.assertEqual(self.listener.next("prompt"),
+                         "  [1] com.ex.Main.main (Main.java:11)\n  [2] com.ex.Foo.toString (native method)")
+
+    def test_variables(self):
+        self.stop_at_main()
+        self.assertEqual(call(self.process, "local_values"), [
+            ("args", "null", "null"),
+            ("n", "42", "42"),
+            ("s", "\"hello\"", "\"hello\""),
+            ("foo", "\"Foo!\"", "instance of com.ex.Foo(id=500)"),
+            ("arr", "instance of int[3] (id=700)", "instance of int[3] (id=700)")
+        ])
+        self.assertEqual(call(self.process, "field_values", "foo"), [("x", "7", "7"), ("label", "\"lbl\"", "\"lbl\"")])
+        self.assertEqual(call(self.process, "field_values", "n"), [])
+        self.assertEqual(call(self.process, "evaluation", "foo.plus(5)"), ("12", None))
+        self.assertEqual(call(self.process, "evaluation", "arr[2] + 0x1F"), ("51", None))
+        self.assertEqual(call(self.process, "evaluation", "s + n"), ("\"hello42\"", None))
+        self.assertEqual(call(self.process, "evaluation", "nope"), (None, "Name unknown: nope"))
+
+    def test_frames_after_invoke(self):
+        self.stop_at_main()
+        ## toString() of foo resumes the thread, the frame ids fetched before are gone then
+        self.assertEqual(call(self.process, "local_values")[3][1], "\"Foo!\"")
+        self.assertEqual(call(self.process, "evaluation", "n"), ("42", None))
+        self.assertEqual(call(self.process, "evaluation", "foo.toString() + n"), ("\"Foo!42\"", None))
+        ## The selected frame stays selected
+        self.command("up")
+        self.listener.next("prompt")
+        self.assertEqual(call(self.process, "evaluation", "foo"), (None, "Name unknown: foo"))
+        self.command("down")
+        self.listener.next("prompt")
+        self.assertEqual(call(self.process, "evaluation", "foo.plus(1) + n"), ("50", None))
+
+    def test_closed(self):
+        self.start()
+        self.command("quit")
+        self.listener.next("ended")
+        self.assertRaises(jdwp.JDWPError, call, self.process, "stack_frames")
+
+
+class ExpressionTest(unittest.TestCase):
+    def test_hex_literals(self):
+        self.assertEqual(jdwp.tokenize("0x1F"), [("number", "0x1F")])
+        self.assertEqual(jdwp.parse_number("0x1F"), jdwp.JDWPValue("I", 31))
+        self.assertEqual(jdwp.parse_number("0xFFFFFFFF"), jdwp.JDWPValue("I", -1))
+        self.assertEqual(jdwp.parse_number("0xFFL"), jdwp.JDWPValue("J", 255))
+
+
+if __name__ == "__main__":
+    unittest.main()